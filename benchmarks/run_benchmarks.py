@@ -0,0 +1,307 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Benchmarks of LAVA server on synthetic data.
+
+Generates instrument.db of given scale (files, probes, finished sessions, builds, hits per session) in a work dir,
+starts the server there, replays probe traffic of a live session against /send_instrumentation_stats with
+several concurrent clients and times the main endpoints. Results are saved as json, so runs of different commits
+can be compared:
+
+    python benchmarks/run_benchmarks.py --files 500 --sessions 20 --output results.json
+'''
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+from create_database import create_db  # noqa: E402
+import stats_table  # noqa: E402
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def generate_db(path, args):
+    '''
+    synthetic db: files in modules, finished sessions spread across builds with their hits and visited routes
+    :return: dict with names of generated files (name -> path) and routes
+    '''
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    create_db(cursor)
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now_us = time.time_ns() // 1000  # hit times are unix epoch microseconds
+    rnd = random.Random(args.seed)
+
+    files = {}
+    executable_lines = ",".join(str(line) for line in range(1, args.probes_per_file + 1))
+    content = "\n".join("line %d" % line for line in range(1, args.probes_per_file + 1)).encode("utf-8")
+    for i in range(args.files):
+        name = "file_%d.js" % i
+        path = "/src/dir_%d/%s" % (i % 20, name)
+        cursor.execute("INSERT INTO files(name,path,type,should_instrument,is_history) VALUES(?,?,?,?,?)", (name, path, ".js", 1, 0))
+        file_id = cursor.lastrowid
+        cursor.execute("INSERT INTO file_details(file_id,file_content,executable_lines_count,updated,executable_lines) VALUES(?,?,?,?,?)",
+                       (file_id, content, args.probes_per_file, now, executable_lines))
+        files[file_id] = (name, cursor.lastrowid)
+
+    file_ids = list(files.keys())
+    modules_count = max(1, args.files // 50)
+    for m in range(modules_count):
+        cursor.execute("INSERT INTO modules(module_name,last_update,is_removed,operation,is_history) VALUES(?,?,?,?,?)",
+                       ("module_%d" % m, now, 0, "add", 0))
+        module_id = cursor.lastrowid
+        cursor.execute("UPDATE modules SET module_key=? WHERE ID=?", (module_id, module_id))
+        cursor.executemany("INSERT INTO module_files(module_key,file_id,added_in) VALUES(?,?,?)",
+                           [(module_id, f, module_id) for f in file_ids[m::modules_count]])
+
+    routes = ["http://localhost/page_%d" % r for r in range(args.routes)]
+    for route in routes:
+        cursor.execute("INSERT INTO routes(route,is_history) VALUES(?,?)", (route, 0))
+
+    for b in range(1, args.builds + 1):
+        cursor.execute("INSERT INTO builds(build,tag_id,update_date) VALUES(?,?,?)", (b, 0, now))
+
+    for s in range(args.sessions):
+        build_id = 1 + s % args.builds
+        cursor.execute("INSERT INTO sessions(is_over,name,total_coverage,start_time,end_time,current_active_modules_count,total_executable,total_executed) VALUES(?,?,?,?,?,?,?,?)",
+                       (1, "session_%d" % s, "0", now, now, modules_count, 0, 0))
+        session_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO sessions_files VALUES(?,?,?)", [(session_id, f, files[f][1]) for f in file_ids])
+        cursor.executemany("INSERT INTO covered_modules(module_id,session_id) VALUES(?,?)", [(m + 1, session_id) for m in range(modules_count)])
+        cursor.execute("INSERT INTO sessions_builds(session_id,build_id) VALUES(?,?)", (session_id, build_id))
+        cursor.execute("INSERT INTO sessions_users_tags(session_id,user_id,tag_id) VALUES(?,?,?)", (session_id, 0, 0))
+        hits = []
+        for h in range(args.hits_per_session):
+            file_id = rnd.choice(file_ids)
+            line = rnd.randint(1, args.probes_per_file)
+            hits.append((file_id, session_id, now_us, files[file_id][0], line, "%d_%d" % (file_id, line), "statement", now_us, "undefined"))
+        stats_table.insert_stats_rows(cursor, hits)
+        cursor.executemany("INSERT INTO visited_routes(route_visited,session_id) VALUES(?,?)", [(rnd.choice(routes), session_id) for r in range(10)])
+
+    for name, value in (("SOURCE_ABSOLUTE_PATH", "/src"), ("CURRENT_INJECT_MODE", "web"), ("BUFFER_TIME_BEFORE_CLOSING_SESSION_SECONDS", -1)):
+        cursor.execute("UPDATE config SET value=? WHERE name=?", (value, name))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO config(name,value) VALUES(?,?)", (name, value))
+    connection.commit()
+    connection.close()
+    return {"files": {files[f][0]: f for f in file_ids}, "routes": routes}
+
+
+def set_config(path, values):
+    connection = sqlite3.connect(path)
+    for name, value in values.items():
+        if connection.execute("UPDATE config SET value=? WHERE name=?", (value, name)).rowcount == 0:
+            connection.execute("INSERT INTO config(name,value) VALUES(?,?)", (name, value))
+    connection.commit()
+    connection.close()
+
+
+def start_server(work_dir, port):
+    server = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, "Instrument_server.py")], cwd=work_dir,
+                              stdout=open(os.path.join(work_dir, "server.log"), "w"), stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get("http://127.0.0.1:%d/get_test_session_status" % port, timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start, see " + os.path.join(work_dir, "server.log"))
+
+
+def summarize(durations):
+    '''
+    :param durations: list of seconds
+    :return: dict with count and min/median/p95/max in milliseconds
+    '''
+    durations = sorted(durations)
+    return {"count": len(durations), "min_ms": round(durations[0] * 1000, 2),
+            "median_ms": round(statistics.median(durations) * 1000, 2),
+            "p95_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 2),
+            "max_ms": round(durations[-1] * 1000, 2)}
+
+
+def replay_probe_traffic(base_url, data, args):
+    '''
+    live session with args.live_hits probe hits sent by args.clients concurrent clients (keep-alive connections)
+    '''
+    rnd = random.Random(args.seed)
+    names = list(data["files"].keys())
+    hits = []
+    for h in range(args.live_hits):
+        name = rnd.choice(names)
+        line = rnd.randint(1, args.probes_per_file)
+        hits.append({"file": name, "line_guid_p": "%s_%d" % (name, line), "related_code_line": line, "route": rnd.choice(data["routes"]),
+                     "inject_type": "statement", "send_date": str(time.time_ns() // 1000), "custom_value": "undefined"})
+
+    latencies = []
+    errors = []
+
+    def client(client_hits):
+        session = requests.Session()
+        for hit in client_hits:
+            start = time.perf_counter()
+            response = session.get(base_url + "/send_instrumentation_stats", params=hit)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or response.text != "saved":
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(hits[c::args.clients],)) for c in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    result = {"hits": len(hits), "clients": args.clients, "errors": len(errors), "duration_s": round(duration, 3),
+              "hits_per_second": round(len(hits) / duration, 1)}
+    result.update(summarize(latencies))
+    return result
+
+
+def time_endpoint(method, url, repeat, **kwargs):
+    durations = []
+    status_codes = set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = requests.request(method, url, **kwargs)
+        response.content  # streamed responses are timed until the last byte
+        durations.append(time.perf_counter() - start)
+        status_codes.add(response.status_code)
+    result = summarize(durations)
+    result["status_codes"] = sorted(status_codes)
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="lava_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    db_path = os.path.join(work_dir, "instrument.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    start = time.perf_counter()
+    data = generate_db(db_path, args)
+    results = {"commit": get_commit(), "date": datetime.datetime.now().isoformat(), "scale": {
+        "files": args.files, "probes_per_file": args.probes_per_file, "sessions": args.sessions, "builds": args.builds,
+        "hits_per_session": args.hits_per_session, "routes": args.routes, "live_hits": args.live_hits},
+        "generate_db_s": round(time.perf_counter() - start, 3), "db_size_bytes": os.path.getsize(db_path)}
+
+    port = get_free_port()
+    set_config(db_path, {"PORT": port, "SERVER_HOST": "127.0.0.1", "INGEST_PORT": 0})
+    base_url = "http://127.0.0.1:%d" % port
+    server = start_server(work_dir, port)
+    try:
+        requests.post(base_url + "/set_test_session_start", data=json.dumps(
+            {"test_session_name": "benchmark", "test_session_build": args.builds, "test_session_owner_id": 0, "test_session_tag_id": 0})).raise_for_status()
+        live_session_id = args.sessions + 1
+        results["ingest"] = replay_probe_traffic(base_url, data, args)
+
+        endpoints = {}
+        endpoints["get_current_coverage"] = time_endpoint("GET", base_url + "/get_current_coverage", args.repeat, params={"session_id": live_session_id})
+        endpoints["report_live_session"] = time_endpoint("GET", base_url + "/report/%d" % live_session_id, args.repeat)
+        time.sleep(1)
+        endpoints["stop_test_session"] = time_endpoint("GET", base_url + "/set_test_session_end", 1, params={"session_id": live_session_id})
+        endpoints["report_session"] = time_endpoint("GET", base_url + "/report/1", args.repeat)
+        endpoints["report_build"] = time_endpoint("GET", base_url + "/report/build/1/tag/general", args.repeat)
+        endpoints["dashboard"] = time_endpoint("GET", base_url + "/dashboard", args.repeat)
+        endpoints["get_sources"] = time_endpoint("GET", base_url + "/get_sources", args.repeat)
+        endpoints["get_modules"] = time_endpoint("GET", base_url + "/get_modules", args.repeat, params={"with_files_only": "False", "session_id": "None"})
+        detected_files = {str(i): "/src/dir_%d/file_%d.js" % (i % 20, i) for i in range(args.files)}
+        endpoints["set_detected_files"] = time_endpoint("POST", base_url + "/set_detected_files", args.repeat, data=json.dumps(detected_files))
+        results["endpoints"] = endpoints
+    finally:
+        server.terminate()
+        server.wait()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAVA server benchmarks on synthetic db")
+    parser.add_argument("--files", type=int, default=200, help="number of source files")
+    parser.add_argument("--probes-per-file", type=int, default=100, help="executable lines (probes) in each file")
+    parser.add_argument("--sessions", type=int, default=10, help="number of finished sessions")
+    parser.add_argument("--builds", type=int, default=3, help="number of builds the sessions are spread across")
+    parser.add_argument("--hits-per-session", type=int, default=5000, help="stats rows of each finished session")
+    parser.add_argument("--routes", type=int, default=20, help="number of routes")
+    parser.add_argument("--live-hits", type=int, default=2000, help="probe hits sent to live session")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients sending probe hits")
+    parser.add_argument("--repeat", type=int, default=5, help="how many times each endpoint is called")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--work-dir", help="where db is generated and server runs, temporary dir (removed afterwards) if not set")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file with results")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,8 @@ import shutil
 
 import datetime
 import subprocess
+import time
+import cProfile
 
 import requests
 import uuid
@@ -131,10 +133,16 @@ class Instrumenter:
         # source file name, b64 original content (before injecting probes)
         self.SOURCE_ORIGINAL_CONTENT = {}
 
+        # timing of the run, saved next to lava.log (see start_stage and save_run_report)
+        self.RUN_REPORT_PATH = 'lava_run_report.json'
+        self.RUN_REPORT = {"stages": [], "files": {}}
+        self.CURRENT_STAGE = None
+
         # init logging 
         logging.basicConfig(filename='lava.log',level=logging.INFO)
 
     def prepare(self, config_path):
+        self.start_stage("load_config")
         self.CONFIG_PATH = config_path
         # open config and parse
         with open(self.CONFIG_PATH) as config_file:
@@ -155,7 +163,7 @@ class Instrumenter:
             config_entry = {}
             config_entry["SOURCE_ABSOLUTE_PATH"] = self.SOURCE_ABSOLUTE_PATH
             config_entry["CURRENT_INJECT_MODE"] = self.INJECT_MODE
-            requests.post(url, data=config_entry, headers=headers)
+            self.send_request("POST", url, data=config_entry, headers=headers)
 
             for rti in config["web_routes_available"]:
                 self.ROUTES_TO_INSTRUMENT.append(rti)
@@ -185,10 +193,12 @@ class Instrumenter:
             return  # if source of user's app was already instrumented, cancel.
 
      
+        self.start_stage("detect_sources")
         self.detect_sources()
         self.detect_templates()
 
         
+        self.start_stage("inject")
         self.print_info("injecting...")
         self.inject_required_scripts()  # to index.html (applies to web & angular only)
         self.insert_instrument_function_into_templates()  # to other templates if exist
@@ -197,10 +207,13 @@ class Instrumenter:
         self.print_info("uploading...")
         # update list of the files in the project root [js and html only]
         # send current file list that is under instrumentation to backend
+        self.start_stage("upload_file_list")
         self.update_file_list()
+        self.start_stage("upload_routes")
         self.set_routes()  # end routes that are being instrumented
         # self.set_modules()  # modules that app has and can be visited ; OBSOLETE since version 2
         # upload executable lines
+        self.start_stage("upload_executable_lines")
         self.upload_executable_lines_count()
 
         
@@ -209,7 +222,9 @@ class Instrumenter:
         # show summary of upload
         self.print_table(["Upload to lava DB", "Status"], self.UPLOAD_ENTRIES)
 
+        self.start_stage("save_token")
         self.save_instrument_token()
+        self.end_stage()
 
     def check_if_instrument_exists(self):
         '''
@@ -547,8 +562,9 @@ class Instrumenter:
 
         # send to backend
         url = self.SERVER_URL + "/" + self.SET_DETECTED_FILES_API_METHOD
-        requests.post(url, data=json.dumps(files), headers={'content-type': 'application/json'})
+        self.send_request("POST", url, data=json.dumps(files), headers={'content-type': 'application/json'})
 
+        self.start_stage("upload_file_contents")
         self.send_file_contents(files)
 
         if len(skipped_files) > 0:
@@ -582,7 +598,7 @@ class Instrumenter:
                 # send to backend
                 headers = {'content-type': 'application/x-www-form-urlencoded'}
                 url = self.SERVER_URL + "/" + self.SET_FILE_CONTENT_METHOD
-                r = requests.post(url, data=file_contents, headers=headers)
+                r = self.send_request("POST", url, file=v, data=file_contents, headers=headers)
                 # print "file content upload status: " + r.text
 
                 # color status in green,if not 200 then red to indicate problem
@@ -606,7 +622,7 @@ class Instrumenter:
 
         # send to backend
         url = self.SERVER_URL + "/" + self.SET_ROUTES_API_METHOD
-        r = requests.get(url, params=routes)
+        r = self.send_request("GET", url, params=routes)
         #print("setting routes result: "+r.text)
         self.UPLOAD_ENTRIES.append(
             [Color('{autoblue}Routes upload (' + str(len(routes)) + '){/autoblue}'), Color('{autogreen}' + r.text + '{/autogreen}')])
@@ -619,7 +635,7 @@ class Instrumenter:
             if record["count"] > 0:
                 # send request
                 url = self.SERVER_URL + "/" + self.SET_EXECUTABLE_LINES_COUNT_METHOD
-                r = requests.get(url, params=record)
+                r = self.send_request("GET", url, file=record["file"], params=record)
 
                 self.show_progress(ct, len(self.FILES_LINE_COUNT), Color(
                     '{autogreen}' + record["file"] + ":" + str(record["count"]) + '{/autogreen}'))
@@ -655,8 +671,8 @@ class Instrumenter:
 
     def insert_instrument_function_into_csharp(self):
         for source_file in self.SOURCE_FILES_TO_INSTRUMENT:
-            subprocess.call('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=cs "' +
-                            self.convert_path_to_unix(source_file) + '"', shell=True)
+            self.run_subprocess('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=cs "' +
+                            self.convert_path_to_unix(source_file) + '"', source_file)
             self.store_original_content(source_file)
 
             line_count = 0
@@ -664,6 +680,7 @@ class Instrumenter:
 
             file_content = []
             filename = os.path.basename(source_file)
+            inject_start = time.perf_counter()  # regex scanning and injecting, without formatting
             with open(source_file, 'r+') as f:
                 file_content = f.readlines()
                 class_name = ''
@@ -713,9 +730,11 @@ class Instrumenter:
                 # inject
                 f.writelines(file_content)
 
+            self.add_to_run_report("inject_seconds", time.perf_counter() - inject_start, source_file)
+
             # format after inejction
-            output = subprocess.call('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=cs "' +
-                                     self.convert_path_to_unix(source_file) + '"', shell=True)
+            output = self.run_subprocess('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=cs "' +
+                                     self.convert_path_to_unix(source_file) + '"', source_file)
 
             if output == 2 or output == 1:
                 self.print_info(Color(
@@ -733,8 +752,8 @@ class Instrumenter:
 
     def insert_instrument_function_into_java(self):
         for source_file in self.SOURCE_FILES_TO_INSTRUMENT:
-            subprocess.call('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=java "' +
-                            self.convert_path_to_unix(source_file) + '"', shell=True)
+            self.run_subprocess('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=java "' +
+                            self.convert_path_to_unix(source_file) + '"', source_file)
             self.store_original_content(source_file)
 
             line_count = 0
@@ -743,6 +762,7 @@ class Instrumenter:
 
             file_content = []
             filename = os.path.basename(source_file)
+            inject_start = time.perf_counter()  # regex scanning and injecting, without formatting
             with open(source_file, 'r+') as f:
                 file_content = f.readlines()
                 class_name = ''
@@ -810,9 +830,11 @@ class Instrumenter:
                 # inject
                 f.writelines(file_content)
 
+            self.add_to_run_report("inject_seconds", time.perf_counter() - inject_start, source_file)
+
             # format after inejction
-            output = subprocess.call('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=java "' +
-                                     self.convert_path_to_unix(source_file) + '"', shell=True)
+            output = self.run_subprocess('AStyle --style=java --break-one-line-headers --add-braces --delete-empty-lines --mode=java "' +
+                                     self.convert_path_to_unix(source_file) + '"', source_file)
 
             if output == 2 or output == 1:
                 self.print_info(Color(
@@ -839,14 +861,15 @@ class Instrumenter:
             executable_lines = ''
 
             # format file to be sure regex expressions work as expected
-            subprocess.call('prettier --write "' +
-                            self.convert_path_to_unix(js_file) + '"', shell=True)
+            self.run_subprocess('prettier --write "' +
+                            self.convert_path_to_unix(js_file) + '"', js_file)
 
             file_content = []
             filename = os.path.basename(js_file)
 
             self.store_original_content(js_file)
 
+            inject_start = time.perf_counter()  # regex scanning and injecting, without formatting
             with open(js_file, 'r+') as f:
 
                 file_content = f.readlines()
@@ -881,9 +904,11 @@ class Instrumenter:
                 f.truncate()
                 f.writelines(file_content)
 
+            self.add_to_run_report("inject_seconds", time.perf_counter() - inject_start, js_file)
+
             # format once again, after injections
-            output = subprocess.call(
-                'prettier --write "' + self.convert_path_to_unix(js_file) + '"', shell=True)
+            output = self.run_subprocess(
+                'prettier --write "' + self.convert_path_to_unix(js_file) + '"', js_file)
 
             if output == 2:
                 self.print_info(Color('\n {autored}[INJECTION ERROR]{/autored}') + ": FILE STRUCTURE BROKEN AFTER INJECTION: " +
@@ -912,8 +937,8 @@ class Instrumenter:
             self.ANGULAR_INSTANTIATE_FILE)
 
         # format before injection
-        subprocess.call('prettier --write "' +
-                        self.ANGULAR_INSTANTIATE_FILE + '"', shell=True)
+        self.run_subprocess('prettier --write "' +
+                        self.ANGULAR_INSTANTIATE_FILE + '"', self.ANGULAR_INSTANTIATE_FILE)
 
         self.store_original_content(self.ANGULAR_INSTANTIATE_FILE)
 
@@ -932,13 +957,13 @@ class Instrumenter:
             f0.writelines(content)
 
         # format after injection
-        subprocess.call('prettier --write "' +
-                        self.ANGULAR_INSTANTIATE_FILE + '"', shell=True)
+        self.run_subprocess('prettier --write "' +
+                        self.ANGULAR_INSTANTIATE_FILE + '"', self.ANGULAR_INSTANTIATE_FILE)
 
         # then inject instrument function
         for source_file in self.SOURCE_FILES_TO_INSTRUMENT:
-            subprocess.call(
-                'prettier --write "' + self.convert_path_to_unix(source_file) + '"', shell=True)
+            self.run_subprocess(
+                'prettier --write "' + self.convert_path_to_unix(source_file) + '"', source_file)
             self.store_original_content(source_file)
 
             executable_lines = ''
@@ -946,6 +971,7 @@ class Instrumenter:
 
             file_content = []
             filename = os.path.basename(source_file)
+            inject_start = time.perf_counter()  # regex scanning and injecting, without formatting
             with open(source_file, 'r+') as f:
                 file_content = f.readlines()
 
@@ -985,9 +1011,11 @@ class Instrumenter:
                 # inject
                 f.writelines(file_content)
 
+            self.add_to_run_report("inject_seconds", time.perf_counter() - inject_start, source_file)
+
             # format after inejction
-            output = subprocess.call(
-                'prettier --write "' + self.convert_path_to_unix(source_file) + '"', shell=True)
+            output = self.run_subprocess(
+                'prettier --write "' + self.convert_path_to_unix(source_file) + '"', source_file)
 
             if output == 2:
                 self.print_info(Color('\n {autored}[INJECTION ERROR]{/autored}') + ": FILE STRUCTURE BROKEN AFTER INJECTION: " +
@@ -1043,12 +1071,78 @@ class Instrumenter:
         print(msg)
         logging.info(msg)
 
+    def start_stage(self, name):
+        '''
+        end current stage of the run and start the next one;
+        wall time, cpu time, time in formatter subprocesses and bytes uploaded are measured per stage
+        '''
+        self.end_stage()
+        self.CURRENT_STAGE = {"name": name, "wall_seconds": time.perf_counter(), "cpu_seconds": time.process_time(),
+                              "subprocess_seconds": 0, "subprocess_calls": 0, "requests": 0, "request_seconds": 0, "bytes_uploaded": 0}
+        self.RUN_REPORT["stages"].append(self.CURRENT_STAGE)
+
+    def end_stage(self):
+        if self.CURRENT_STAGE is None:
+            return
+        self.CURRENT_STAGE["wall_seconds"] = time.perf_counter() - self.CURRENT_STAGE["wall_seconds"]
+        self.CURRENT_STAGE["cpu_seconds"] = time.process_time() - self.CURRENT_STAGE["cpu_seconds"]
+        self.CURRENT_STAGE = None
+
+    def add_to_run_report(self, key, value, file=None):
+        '''
+        add value to current stage and, if given, to the file (by file name)
+        '''
+        if self.CURRENT_STAGE is not None:
+            self.CURRENT_STAGE[key] = self.CURRENT_STAGE.get(key, 0) + value
+        if file is not None:
+            file_entry = self.RUN_REPORT["files"].setdefault(os.path.basename(file), {})
+            file_entry[key] = file_entry.get(key, 0) + value
+
+    def run_subprocess(self, command, file):
+        '''
+        run formatter (prettier, AStyle) for the file, its time goes to the run report
+        :return: exit code
+        '''
+        start = time.perf_counter()
+        output = subprocess.call(command, shell=True)
+        self.add_to_run_report("subprocess_seconds", time.perf_counter() - start, file)
+        self.add_to_run_report("subprocess_calls", 1, file)
+        return output
+
+    def send_request(self, method, url, file=None, **kwargs):
+        '''
+        send request to the server, its time and size (url and body) go to the run report
+        '''
+        start = time.perf_counter()
+        r = requests.request(method, url, **kwargs)
+        body = r.request.body
+        self.add_to_run_report("requests", 1, file)
+        self.add_to_run_report("request_seconds", time.perf_counter() - start, file)
+        self.add_to_run_report("bytes_uploaded", len(r.request.url) + (len(body) if body is not None else 0), file)
+        return r
+
+    def save_run_report(self):
+        '''
+        save timing of stages and files as json next to lava.log
+        '''
+        self.end_stage()
+        for entry in self.RUN_REPORT["stages"] + list(self.RUN_REPORT["files"].values()):
+            for key, value in entry.items():
+                if isinstance(value, float):
+                    entry[key] = round(value, 4)
+        self.RUN_REPORT["total_wall_seconds"] = round(sum(stage["wall_seconds"] for stage in self.RUN_REPORT["stages"]), 4)
+        with open(self.RUN_REPORT_PATH, "w") as f:
+            json.dump(self.RUN_REPORT, f, indent=4)
+        logging.info('Run report saved to ' + os.path.abspath(self.RUN_REPORT_PATH))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Get test coverage for specified app.')
     parser.add_argument('configPath', metavar='J', type=str, nargs='+',
                         help='Absolute path to config json file. Required')
+    parser.add_argument('--profile', metavar='FILE', type=str,
+                        help='Save cProfile stats of the run to FILE (e.g. lava.prof, view with snakeviz or pstats). Optional')
     args = parser.parse_args()
 
     # store config json path
@@ -1056,4 +1150,15 @@ if __name__ == "__main__":
     print((Color('{autoblue}[Parsing JSON Config]{/autoblue}') + ":" + json_path))
 
     instrumenter = Instrumenter()
-    instrumenter.prepare(json_path)
+    try:
+        if args.profile:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(instrumenter.prepare, json_path)
+            finally:
+                profile.dump_stats(args.profile)
+        else:
+            instrumenter.prepare(json_path)
+    finally:
+        # also when prepare fails, the report shows how far it got
+        instrumenter.save_run_report()
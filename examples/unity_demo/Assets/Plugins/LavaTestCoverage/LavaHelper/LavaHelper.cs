@@ -157,7 +157,7 @@ public class LavaHelper : MonoBehaviour
         //add to queue only if this stat is not already waiting to be sent to backend
         if(!DoesQueueContainStat(file,line_guid))
         {
-            string sendDate= System.String.Format("{0:yyyy-MM-dd HH:mm:ss:FF}", System.DateTime.Now);
+            string sendDate= (System.DateTimeOffset.UtcNow.ToUnixTimeMilliseconds()*1000).ToString(); //unix epoch microseconds
 
             Queue.Add(new string[] { file, line_guid, file_line, probe_type,custom,sendDate });
         }
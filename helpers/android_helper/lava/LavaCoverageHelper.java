@@ -3,13 +3,11 @@ package [YOUR PACKAGE NAME HERE]
 
 import java.io.IOException;
 import java.net.URLEncoder;
-import java.text.SimpleDateFormat;
 import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.Iterator;
 import java.util.List;
 import java.util.Map;
-import java.util.Date;
 
 import okhttp3.Call;
 import okhttp3.Callback;
@@ -21,6 +19,7 @@ import okhttp3.ResponseBody;
 public class LavaCoverageHelper {
 
     private static String _LavaUrl = "http://[YOUR LAVA HOST HERE]:5000/send_instrumentation_stats";
+    private static String _SessionKey = ""; // routing key of the test session, leave empty if LAVA runs only 1 session at the time
     private static List<String> _processedLineGuids = new ArrayList<String>();
 
 
@@ -43,6 +42,9 @@ public class LavaCoverageHelper {
                 }
                 //remove last &
                 paramString = paramString.substring(0, paramString.length() - 1);
+                if (!_SessionKey.isEmpty()) {
+                    paramString += "&session_key=" + URLEncoder.encode(_SessionKey, "UTF-8");
+                }
 
 
                 //send
@@ -92,7 +94,7 @@ public class LavaCoverageHelper {
         params.put("related_code_line",fileLine);
         params.put("inject_type",probeType);
         params.put("custom_value",custom);
-        params.put("send_date",new SimpleDateFormat("yyyy-MM-dd HH:mm:ss:SS").format(new Date()));
+        params.put("send_date",String.valueOf(System.currentTimeMillis()*1000)); //unix epoch microseconds
 
         if(!_processedLineGuids.contains(lineGuid))
         {
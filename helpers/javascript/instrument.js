@@ -37,9 +37,11 @@ DAMAGE.
 //does not require jquery
 //usage:var instrumenter=new jsInstrument(params here);
 //method call example: instrumenter.InstrumentCode();
-var jsInstrument = function(serverURL_p) {
+//sessionKey_p is optional - routing key of the test session stats should go to, when LAVA runs many sessions at once
+var jsInstrument = function(serverURL_p, sessionKey_p) {
   //save values for later use
   this.serverURL = serverURL_p;
+  this.sessionKey = sessionKey_p;
 
   this.executed_count = 0;
   this.executed_lines = [];
@@ -62,26 +64,15 @@ var jsInstrument = function(serverURL_p) {
       custom_value:custom_value
     });
 
-    var currentDate=new Date();
-	var month=currentDate.getMonth();
-	//ass getMonth() returns just months from 0-11 0 being jan and 11 dec, need to process it:
-	month+=1;
-	month=month.toString();
-	if (month.length==1)
-	{
-		month="0"+month;
-	}
-	//the same with the day...I should probably use something like moment.js in the future
-	day=currentDate.getDate();
-	day=day.toString();
-	if (day.length==1)
-	{
-		day="0"+day;
-	}
-	
-    var sendDate=currentDate.getFullYear()+"-"+month+"-"+day+" "+currentDate.getHours()+":"+currentDate.getMinutes()+":"+currentDate.getSeconds()+":"+currentDate.getMilliseconds();
+    //unix epoch microseconds
+    var sendDate=Date.now()*1000;
 
 		
+    var sessionKeyParam = "";
+    if (this.sessionKey) {
+      sessionKeyParam = "&session_key=" + encodeURIComponent(this.sessionKey);
+    }
+
     //send to backend
     var request = new XMLHttpRequest();
     request.open(
@@ -101,7 +92,8 @@ var jsInstrument = function(serverURL_p) {
         "&send_date="+
         sendDate+
         "&custom_value="+
-        custom_value,
+        custom_value+
+        sessionKeyParam,
       true
     );
     request.send();
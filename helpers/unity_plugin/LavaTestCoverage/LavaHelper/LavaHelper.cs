@@ -49,6 +49,7 @@ public class LavaHelper : MonoBehaviour
 
     #region declare
     private string _LavaUrl = "http://localhost:5000/send_instrumentation_stats";
+    private string _SessionKey = ""; // routing key of the test session, leave empty if LAVA runs only 1 session at the time
     private static List<string> _SentStats;
     private bool _SendingLocked;
     public static List<string[]> Queue;
@@ -95,7 +96,7 @@ public class LavaHelper : MonoBehaviour
     IEnumerator ExecuteGET(string[] statDetails)
     {
         _SendingLocked = true;
-        using (UnityWebRequest www = UnityWebRequest.Get(_LavaUrl + "?file=" + statDetails[0] + "&line_guid_p=" + statDetails[1] + "&route=None&related_code_line=" + statDetails[2] + "&inject_type=" + statDetails[3]+"&custom_value="+statDetails[4]+"&send_date="+statDetails[5]))
+        using (UnityWebRequest www = UnityWebRequest.Get(_LavaUrl + "?file=" + statDetails[0] + "&line_guid_p=" + statDetails[1] + "&route=None&related_code_line=" + statDetails[2] + "&inject_type=" + statDetails[3]+"&custom_value="+statDetails[4]+"&send_date="+statDetails[5]+(_SessionKey.Length>0 ? "&session_key="+UnityWebRequest.EscapeURL(_SessionKey) : "")))
         {
 
             Debug.Log("[LavaTestCoverage] Sending stat:" + statDetails[0] + "_" + statDetails[1]);
@@ -157,7 +158,7 @@ public class LavaHelper : MonoBehaviour
         //add to queue only if this stat is not already waiting to be sent to backend
         if(!DoesQueueContainStat(file,line_guid))
         {
-            string sendDate= System.String.Format("{0:yyyy-MM-dd HH:mm:ss:FF}", System.DateTime.Now);
+            string sendDate= (System.DateTimeOffset.UtcNow.ToUnixTimeMilliseconds()*1000).ToString(); //unix epoch microseconds
 
             Queue.Add(new string[] { file, line_guid, file_line, probe_type,custom,sendDate });
         }
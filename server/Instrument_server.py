@@ -37,19 +37,45 @@ DAMAGE.
 import datetime
 import os
 import sqlite3
-import uuid
 import base64
+import hmac
 import json
+import multiprocessing
+import signal
+import sys
+import time
+import gevent
+from gevent.queue import Queue, Empty
 from flask_cors import CORS
-from flask import render_template, request, Flask, jsonify, redirect,abort
+from flask import render_template, request, Flask, jsonify, redirect,abort,Response,stream_with_context,g
 from gevent.pywsgi import WSGIServer
 from flask_api import FlaskAPI, status, exceptions
 
-from create_database import create_connection, create_db, close_connection, create_tags_table
-
-
-CONNECTION_STRING = 'instrument.db'
-CONFIG = {}  # dict holding key/value of config entries
+from create_database import create_connection, create_db, close_connection, create_tags_table, create_probe_hits_table, create_hit_logs_table, create_compacted_sessions_table, create_ingest_counters_table, create_session_last_hits_table, create_stats_indexes, update_session_tests_times_to_epoch, update_stats_table_to_slim, create_file_details_indexes, create_test_impact_tables, create_module_files_table, update_sessions_table_to_v3_2, update_modules_table_to_v3_3, update_file_details_table_to_v3_3
+import hit_log
+import stats_table
+import stats_export
+import metrics
+import sql_trace
+import profiler
+import memory
+from db import CONFIG, CONNECTION_STRING, execute_query, execute_select, get_cached_config_value, get_config, get_config_value, iter_select, set_config_value
+from probe_hits import ACTIVE_SESSIONS, COVERAGE_SUBSCRIBERS, HIT_LOG_DIR, NEW_COVERED_PROBES, PENDING_TEST_PROBES, PROBE_HIT_COUNTS, SESSION_LAST_HITS, SESSION_CHANGES, \
+    count_session_change, flush_pending_rows, flush_probe_hit_counts, flush_test_probes, forget_seen_probes, get_cached_active_test_sessions, \
+    forget_unsaved_hits, get_file_id_by_filename, get_ingest_counters, get_ingest_policy, get_session_build, process_probe_hit, \
+    reset_ingest_counters, route_request_to_session, save_stats_rows, save_visited_route
+
+
+LAST_PUSHED_COVERAGE = {}  # session id -> coverage last pushed to subscribers, to compute deltas
+REPORT_MODELS = {}  # (session ids,data version) -> report model, see get_report_model
+REPORT_MODELS_CACHE_SIZE = 20
+LAST_PUSHED_LOG_SIZE = {}  # session id -> size of its hit log at last coverage push
+LAST_PUSHED_STATS_COUNT = {}  # stats_counter at the time of last push, detects hits saved by ingest service process
+REPORT_CHUNK_SIZE = 64 * 1024  # rendered report is streamed in pieces of about this many characters
+RETENTION_BATCH_ROWS = 10000  # retention deletes about this many rows per transaction, other greenlets run in between
+VACUUM_BATCH_PAGES = 1000  # free pages returned to the file system per incremental vacuum step
+STATS_MIGRATION = {"done": False}  # set when stats table from before current layout is gone, see stats_migration_pending
+STATS_MIGRATION_PENDING_MESSAGE = "Stats saved before the upgrade are still being moved to the new stats table, try again later"
 
 
 
@@ -58,6 +84,45 @@ CORS(app)
 app.config['PROPAGATE_EXCEPTIONS'] = True
 
 
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.memory_started = memory.start()
+    g.sql_statements = 0
+    if get_cached_config_value("SQL_TRACE_ENABLED", "0") == "1" or sql_trace.is_forced():
+        g.sql_trace = []
+    if profiler.is_profiling_requests() and request.url_rule is not None:
+        g.profile_token = profiler.request_started(request.url_rule.rule, request.path)
+    metrics.request_started()
+
+
+@app.after_request
+def set_request_metrics_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    '''
+    runs when the request context is gone, for streamed responses after the last chunk
+    '''
+    if "metrics_start" not in g:
+        return
+    if g.get("profile_token") is not None:
+        profiler.request_finished(g.profile_token)
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.request_finished(route, request.method, g.get("metrics_status", 500), time.perf_counter() - g.metrics_start, g.sql_statements)
+    memory.finish("request", route, g.memory_started)
+    if "sql_trace" in g:
+        try:
+            slow_query_ms = float(get_cached_config_value("SQL_SLOW_QUERY_MS", "100"))
+        except ValueError:
+            slow_query_ms = None
+        # path without query string, params like admin token must not end up in the trace or slow query log
+        sql_trace.finish_request(request.method, request.path, route, g.sql_trace, slow_query_ms)
+
+
 ############################# VIEWS ######################################
 
 ######################### API ############################################
@@ -68,13 +133,18 @@ def hello():
 
 @app.route("/set_test_session_start", methods=["POST"])
 def start_test_session():
-    active_session=get_active_test_session()
-    if active_session is not None:
-        return 'There currently be only 1 active session at the time. Please finish active session named ['+active_session[2]+'] and retry',status.HTTP_400_BAD_REQUEST
-
     data = json.loads(request.data)
     test_session_name = data["test_session_name"]
 
+    # many sessions can be live at the same time, each one with different routing key.
+    # Probes carrying session_key are saved to the session with that key, probes without it go to the session without key.
+    routing_key = None
+    if "test_session_routing_key" in data and data["test_session_routing_key"] not in (None, ""):
+        routing_key = str(data["test_session_routing_key"])
+    for active_session in get_cached_active_test_sessions():
+        if active_session[9] == routing_key:
+            return 'There can be only 1 active session with the same routing key at the time. Please finish active session named ['+active_session[2]+'] and retry',status.HTTP_400_BAD_REQUEST
+
     modules_list = None
     if "test_session_modules" in data:
         modules_list = data["test_session_modules"]
@@ -86,23 +156,37 @@ def start_test_session():
     test_session_tag=int(data["test_session_tag_id"])
 
 
-    make_all_sessions_inactive()
-    reset_active_test()
+    if len(get_cached_active_test_sessions()) == 0:
+        reset_active_test()
 
-    if create_new_test_session(test_session_name, modules_list,test_session_build_number,test_session_owner,test_session_tag):
+    if create_new_test_session(test_session_name, modules_list,test_session_build_number,test_session_owner,test_session_tag,routing_key):
         return '',status.HTTP_200_OK
     return "Session with specified name already exists! Choose unique name for your session.",status.HTTP_400_BAD_REQUEST
 
 
 @app.route("/set_test_session_end")
 def stop_test_session():
+    '''
+    end live session given by session_id or session_key param;
+    if none given, session without routing key is ended
+    '''
+    active_session = route_request_to_session(request.args)
+    if active_session is None:
+        return 'No matching active session found.',status.HTTP_400_BAD_REQUEST
+
     # first,make sure that stats are not coming anymore
-    if not can_session_be_ended():
+    if not can_session_be_ended(active_session[0]):
         return 'Cannot end this session because stats are still coming. Please retry in a few seconds.',status.HTTP_400_BAD_REQUEST
 
-    session_coverage = 0
+    # stop routing hits to the session before its hits are counted, so late hits are rejected instead of missing from totals
+    live_session_id = active_session[0]
+    end_session_test(live_session_id)
+    make_session_inactive(live_session_id)
+    compact_hit_log(live_session_id)
+    flush_probe_hit_counts()
+    flush_test_probes()
 
-    session_coverage, live_session_id,total_executed,total_executable = calculate_total_coverage_for_active_session()
+    session_coverage, total_executed, total_executable = calculate_total_coverage_for_session(live_session_id)
 
     # save test session coverage when it's over
 
@@ -110,11 +194,10 @@ def stop_test_session():
     params = {"sc": str(session_coverage), "sid": live_session_id,"total_executable":total_executable,"te":total_executed}
     execute_query(sql, params)
 
-    make_all_sessions_inactive()
+    gevent.spawn(after_session_end, live_session_id)
 
     # save report
-    with open("report.html", "wb") as f:
-        f.write(prepare_report_page(live_session_id,use_embeded_template=True).encode('utf-8').strip())
+    write_report("report.html", prepare_report_page(live_session_id,use_embeded_template=True))
 
     return '',status.HTTP_200_OK
 
@@ -227,28 +310,19 @@ def set_detected_files():
 @app.route("/send_instrumentation_stats", methods=["GET"])
 def send_instrumentation_stats():
 
-    active_session = get_active_test_session()
+    active_session = route_request_to_session(request.args)
 
-    file_id = None
     if active_session is not None:
-        data = request.args
-
+        route_row, stats_row = process_probe_hit(active_session, request.args)
         try:
-            save_visited_route(data["route"], active_session[0])
-        except:
-            print("route not present in stats. Skipping saving route.")
-        file_id = get_file_id_by_filename(data["file"], True)[0]
-
-        if file_id is not None:
-            d=datetime.datetime.strptime(data["send_date"], '%Y-%m-%d %H:%M:%S:%f')
-            sql = "INSERT INTO stats(file_id,session_id,date,filename,line,line_guid,coverage_type,send_time,custom_value) VALUES(?,?,?,?,?,?,?,?,?)"
-            try:
-                execute_query(sql, (
-                    file_id, active_session[0], datetime.datetime.now().strftime(
-                        "%Y-%m-%d %H:%M:%S"), data["file"],
-                    int(data["related_code_line"]), data["line_guid_p"], data["inject_type"],datetime.datetime.strptime(data["send_date"], '%Y-%m-%d %H:%M:%S:%f'),data["custom_value"]))
-            except Exception as e:
-                print(e)
+            if route_row is not None:
+                save_visited_route(route_row[0], route_row[1])
+            if stats_row is not None:
+                save_stats_rows([stats_row])
+                metrics.count("stats_rows_written")
+        except Exception as e:
+            print(e)
+            forget_unsaved_hits([active_session[0]])
 
     else:
         print("No active test session found")
@@ -256,8 +330,157 @@ def send_instrumentation_stats():
     return "saved"
 
 
+@app.route("/get_ingest_stats", methods=["GET"])
+def get_ingest_stats():
+    '''
+    how many probe hits were received, stored and dropped by ingest policy since server start,
+    by this process and by ingest service up to its last flush (PROBE_HITS_FLUSH_INTERVAL_SECONDS)
+    '''
+    counters = get_ingest_counters()
+    return jsonify(ingest_policy=get_ingest_policy(), received=counters["received"], first_hits=counters["first_hits"],
+                   repeats_stored=counters["repeats_stored"], dropped=counters["dropped"])
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    '''
+    server metrics in Prometheus text format, see metrics.py
+    '''
+    return Response(metrics.render(get_metrics_gauges()), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/sql_trace", methods=["GET"])
+def get_sql_trace():
+    '''
+    statements of recently traced requests with N+1 candidates and totals per statement shape, see sql_trace.py.
+    Requests are traced when SQL_TRACE_ENABLED is 1. Optional param: limit. Admin endpoint, see is_admin_request
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    limit = request.args.get("limit")
+    return jsonify(enabled=get_cached_config_value("SQL_TRACE_ENABLED", "0") == "1", **sql_trace.get_report(int(limit) if limit else None))
+
+
+@app.route("/debug/sql_trace/reset", methods=["POST"])
+def reset_sql_trace():
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    sql_trace.reset()
+    return '', status.HTTP_200_OK
+
+
+@app.route("/admin/profile", methods=["GET"])
+def profile_server():
+    '''
+    profile the server for given number of seconds, see profiler.py. Admin endpoint, see is_admin_request
+    params: seconds (default 10, max 300), mode: sampling (default) or cprofile, interval_ms: sampling interval (default 5),
+    route: cprofile mode - url rule or path prefix of profiled requests, top: length of functions table (default 30),
+    format: json (default) or collapsed (only collapsed stacks as text, for flamegraph tools)
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    try:
+        seconds = min(float(request.args.get("seconds", 10)), 300)
+        interval = max(float(request.args.get("interval_ms", 5)), 1) / 1000
+        top = int(request.args.get("top", 30))
+    except ValueError:
+        return "seconds, interval_ms and top have to be numbers", status.HTTP_400_BAD_REQUEST
+    if top < 0:
+        return "top can't be negative", status.HTTP_400_BAD_REQUEST
+    mode = request.args.get("mode", "sampling")
+    if mode not in ("sampling", "cprofile"):
+        return "mode has to be sampling or cprofile", status.HTTP_400_BAD_REQUEST
+
+    if not profiler.start(mode, interval, request.args.get("route")):
+        return "Profiler is already running", status.HTTP_409_CONFLICT
+    try:
+        gevent.sleep(seconds)  # other greenlets keep handling requests meanwhile
+    finally:
+        result = profiler.stop(top)
+    if request.args.get("format") == "collapsed":
+        return Response(result["collapsed"], mimetype="text/plain")
+    return jsonify(result)
+
+
+@app.route("/admin/memory", methods=["GET"])
+def get_memory_stats():
+    '''
+    RSS and peak RSS of the process, memory used by each route and background job, tracemalloc state. Admin endpoint
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    return jsonify(memory.get_stats())
+
+
+@app.route("/admin/memory/snapshot", methods=["POST"])
+def take_memory_snapshot():
+    '''
+    take tracemalloc snapshot (tracing starts with the first one), optional params: frames (default 1), top (default 30)
+    :return: snapshot id and source lines holding most memory
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    try:
+        frames = int(request.args.get("frames", 1))
+        top = int(request.args.get("top", 30))
+    except ValueError:
+        return "frames and top have to be numbers", status.HTTP_400_BAD_REQUEST
+    if not 1 <= frames <= 65535 or top < 0:
+        return "frames has to be from 1 to 65535 and top can't be negative", status.HTTP_400_BAD_REQUEST
+    return jsonify(memory.take_snapshot(frames, top))
+
+
+@app.route("/admin/memory/diff", methods=["GET"])
+def diff_memory_snapshots():
+    '''
+    params: from - snapshot id, to - snapshot id (optional, default: new snapshot), top (default 30)
+    :return: source lines sorted by memory allocated between the snapshots
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    if "from" not in request.args:
+        return "from param with snapshot id is required", status.HTTP_400_BAD_REQUEST
+    try:
+        from_id = int(request.args["from"])
+        to_id = int(request.args["to"]) if request.args.get("to") else None
+        top = int(request.args.get("top", 30))
+    except ValueError:
+        return "from, to and top have to be numbers", status.HTTP_400_BAD_REQUEST
+    if top < 0:
+        return "top can't be negative", status.HTTP_400_BAD_REQUEST
+    diff = memory.diff_snapshots(from_id, to_id, top)
+    if diff is None:
+        return "Snapshot not found", status.HTTP_404_NOT_FOUND
+    return jsonify(diff)
+
+
+@app.route("/admin/memory/stop", methods=["POST"])
+def stop_memory_tracing():
+    '''
+    stop tracemalloc and drop snapshots
+    '''
+    if not is_admin_request():
+        return "Admin endpoint: call it from localhost or with token matching ADMIN_TOKEN config", status.HTTP_403_FORBIDDEN
+    memory.stop_tracing()
+    return '', status.HTTP_200_OK
+
+
+@app.route("/export_stats", methods=["GET"])
+def export_stats_view():
+    '''
+    export finished sessions to columnar files for offline analysis (see stats_export.py).
+    With session_id only that session is exported (again), otherwise all finished sessions that are not exported yet.
+    '''
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
+    exported = export_stats(request.args.get("session_id"))
+    return jsonify(exported_sessions=exported, export_dir=get_config_value("STATS_EXPORT_DIR") or "exports")
+
+
 @app.route("/get_total_coverage_for_specific_build", methods=["GET"])
 def get_total_coverage_for_specific_build():
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     data = request.args
     build_id=data["build_id"]
     total_coverage=calculate_total_coverage_for_build(int(build_id))
@@ -283,7 +506,7 @@ def set_files_content():
 
     if file_details is not None:
         # insert file content
-        sql = "UPDATE file_details SET file_content= :v WHERE ID=:id"
+        sql = "UPDATE file_details SET file_content= :v,changes=changes+1 WHERE ID=:id"
         param = {"v": data["file_content"], "id": int(file_details[0])}
         execute_query(sql, param)
         return "200"
@@ -293,6 +516,8 @@ def set_files_content():
 
 @app.route("/get_file_content")
 def get_files_content():
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     filename = request.args["filename"]
     session = request.args["session_id"]
 
@@ -323,54 +548,125 @@ def get_files_content():
             else:
                 stats = get_stats_for_file(f[0][0], session)
             for s in stats:
-                executed_line_numbers_list.append(s[5])
+                executed_line_numbers_list.append(s[4])
             break
     decoded_content = base64.b64decode(content).decode("utf-8")
     return jsonify(decoded_content_string=decoded_content, executed_lines=executed_line_numbers_list, executable_lines=executable_lines)
 
 
+@app.route("/get_probe_hit_counts")
+def get_probe_hit_counts():
+    '''
+    how many times each line of the file was executed in given session (or comma separated sessions of a build).
+    Available when COUNT_PROBE_HITS is enabled, empty otherwise.
+    '''
+    filename = request.args["filename"]
+    session = request.args["session_id"]
+    sessions_list = [int(s) for s in session.split(',')]
+
+    line_hits = {}
+    file_id = None
+    for f in get_all_files_for_sessions(sessions_list):
+        if f[0][2] == filename:
+            file_id = f[0][0]
+            break
+
+    if file_id is not None:
+        line_hits = get_hit_counts_by_line(file_id, sessions_list)
+
+    max_hits = 0
+    if len(line_hits) > 0:
+        max_hits = max(line_hits.values())
+    return jsonify(line_hits=line_hits, max_hits=max_hits, hit_count_enabled=get_cached_config_value("COUNT_PROBE_HITS", "0") == "1")
+
+
+@app.route("/get_coverage_diff")
+def get_coverage_diff():
+    '''
+    compare coverage of 2 sessions, 2 builds or session and build:
+    base_session_id or base_build_id and target_session_id or target_build_id (build ids, not build numbers).
+    Returns probes and lines covered only by target (newly covered) and only by base (newly uncovered)
+    for each file and module that changed, and coverage delta.
+    '''
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
+    base_sessions = get_diff_side_sessions(request.args, "base")
+    target_sessions = get_diff_side_sessions(request.args, "target")
+    if base_sessions is None or target_sessions is None:
+        return 'base_session_id or base_build_id and target_session_id or target_build_id are required',status.HTTP_400_BAD_REQUEST
+    if len(base_sessions) == 0 or len(target_sessions) == 0:
+        return 'No sessions found for given base or target.',status.HTTP_404_NOT_FOUND
+    return jsonify(calculate_coverage_diff(base_sessions, target_sessions))
+
+
 @app.route("/set_current_test", methods=["GET"])
 def set_active_test():
+    '''
+    test that runs now in the session (routed like probe hits); probes hit from now on are attributed to it
+    '''
     data = request.args
-    current_test = get_config_value("CURRENT_TEST_NAME")
-    if current_test == None:
-        sql = "INSERT INTO config(name,value) VALUES(?,?)"
-        param = ("CURRENT_TEST_NAME", data["name"])
-        execute_query(sql, param)
-        sql = "INSERT INTO config(name,value) VALUES(?,?)"
-        param = ("CURRENT_TEST_ID", data["test_id"])
-        execute_query(sql, param)
-    else:
-        sql = "UPDATE config SET value= :v WHERE name= :n"
-        params = {"n": "CURRENT_TEST_NAME", "v": data["name"]}
-        execute_query(sql, params)
-        sql = "UPDATE config SET value= :v WHERE name= :n"
-        params = {"n": "CURRENT_TEST_ID", "v": data["test_id"]}
-        execute_query(sql, params)
-    refresh_config()
     # also save what module is touched by this test
-    active_test_session = get_active_test_session()
+    active_test_session = route_request_to_session(data)
     if active_test_session == None:
         active_test_session = -1
     else:
         active_test_session = active_test_session[0]
-    sql = "INSERT INTO visited_modules(module_touched,session_id) VALUES(?,?)"
-    params = (data["touched_module"], active_test_session)
-    execute_query(sql, params)
+        start_session_test(active_test_session, data["test_id"], data["name"])
+    if "touched_module" in data:
+        try:
+            sql = "INSERT INTO visited_modules(module_touched,session_id) VALUES(?,?)"
+            params = (data["touched_module"], active_test_session)
+            execute_query(sql, params)
+        except:
+            print("visited modules not available. Skipping saving touched module.")
 
     return "200"
 
 
 @app.route("/reset_current_test", methods=["GET"])
 def reset_active_test():
-    sql = 'DELETE FROM config WHERE name="CURRENT_TEST_NAME"'
-    execute_query(sql)
-    sql = 'DELETE FROM config WHERE name="CURRENT_TEST_ID"'
-    execute_query(sql)
-    refresh_config()
+    active_test_session = route_request_to_session(request.args)
+    if active_test_session is not None:
+        end_session_test(active_test_session[0])
     return "200"
 
 
+@app.route("/get_covering_tests", methods=["POST"])
+def get_covering_tests():
+    '''
+    which tests executed given files or lines: {"files": {"<file name or path>": [lines], ...}}, empty list means any line.
+    Optional "session_ids" limit the answer to tests run in those sessions.
+    '''
+    data = json.loads(request.data)
+    tests = {}
+    for file_name, lines in data["files"].items():
+        for test_id, test_name, line in find_tests_for_file(file_name, lines, data.get("session_ids")):
+            test = tests.setdefault(test_id, {"test_id": test_id, "test_name": test_name, "files": {}})
+            test["files"].setdefault(file_name, []).append(line)
+    return jsonify(tests=sorted(tests.values(), key=lambda t: t["test_id"]))
+
+
+@app.route("/get_impacted_tests", methods=["POST"])
+def get_impacted_tests():
+    '''
+    tests to rerun for changed files: {"changed_files": ["<file name or path>", ...]}.
+    Changed files that no test executed are in files_without_tests - they are either not covered or were changed
+    before any test was attributed to them, CI should decide whether to run the whole suite then.
+    '''
+    data = json.loads(request.data)
+    tests = {}
+    files_without_tests = []
+    for file_name in data["changed_files"]:
+        file_tests = find_tests_for_file(file_name, [], data.get("session_ids"))
+        if len(file_tests) == 0:
+            files_without_tests.append(file_name)
+        for test_id, test_name, line in file_tests:
+            test = tests.setdefault(test_id, {"test_id": test_id, "test_name": test_name, "changed_files": []})
+            if file_name not in test["changed_files"]:
+                test["changed_files"].append(file_name)
+    return jsonify(tests=sorted(tests.values(), key=lambda t: t["test_id"]), files_without_tests=files_without_tests)
+
+
 @app.route("/set_executable_lines_count_for_file", methods=["GET", "POST"])
 def set_executable_lines_count_for_file():
 
@@ -381,7 +677,7 @@ def set_executable_lines_count_for_file():
 
     if file_details is not None:
         # insert file content
-        sql = "UPDATE file_details SET executable_lines_count= :v,executable_lines= :el WHERE ID=:id"
+        sql = "UPDATE file_details SET executable_lines_count= :v,executable_lines= :el,changes=changes+1 WHERE ID=:id"
         param = {"v": data["count"], "el": data[
             "executable"], "id": int(file_details[0])}
         execute_query(sql, param)
@@ -391,39 +687,16 @@ def set_executable_lines_count_for_file():
 
 @app.route("/get_sources", methods=["GET"])
 def get_sources():
-    sources = get_all_active_files_without_module()
-    sources_json = []
-
-    parents = []
-    # first need tgo find parents
-    for row in sources:
-        dir_name = os.path.dirname(row[2])
-        if dir_name not in parents:
-            parents.append(dir_name)
-
-    # now files
-    for parent in parents:
-
-        parent_id = "parent_folder_" + str(uuid.uuid4())
-        # create folder
-        source_data = {}
-        source_data["id"] = parent_id
-        source_data["text"] = parent
-        source_data["parent"] = "#"
-        sources_json.append(json.dumps(source_data))
-
-        # add related files
-        for row in sources:
-            source_dir = os.path.dirname(row[2])
-            if parent == source_dir:
-                source_data = {}
-                source_data["id"] = row[0]
-                source_data["text"] = row[1]
-                source_data["parent"] = parent_id
-                source_data["type"] = "source"
-                sources_json.append(json.dumps(source_data))
-
-    return jsonify(sources=sources_json, sources_count=len(sources))
+    '''
+    tree of sources without module: folders with their files.
+    Optional param node: # - folders only, folder id - its files; returned as json array of nodes for lazy loading
+    '''
+    node = request.args.get("node")
+    if node is not None:
+        return jsonify(get_sources_tree(node))
+    sources_tree = get_sources_tree()
+    sources_json = [json.dumps(source_data) for source_data in sources_tree]
+    return jsonify(sources=sources_json, sources_count=len([s for s in sources_tree if s.get("type") == "source"]))
 
 
 @app.route("/create_module", methods=["POST"])
@@ -477,29 +750,14 @@ def assign_file_to_module():
 
     # update list of related files
     module = get_module(module_id)
-    related_files = module[2]
-
-    if related_files == None:
-        related_files = []
-    else:
-        # because related files are stored as comma separated string
-        related_files = related_files.split(',')
-
-    for f in param_files:
-        if f not in related_files:
-            related_files.append(f)
+    related_files = set(get_related_files_from_module(module_id))
+    new_files = [int(f) for f in param_files if int(f) not in related_files]
 
     # make current module a history, a reference only because there might be a related session to the files in that
     # module and the file state needs to stay the same for this module instance, for reference.
-    # create a copy of the module with new files that will be active from now
+    # new version of the module with new files will be active from now
     # on until another update
-    sql = "UPDATE modules SET is_history=1,last_update=:lupd,operation=:op WHERE ID=:mid"
-    param = {"mid": int(module_id), "lupd": datetime.datetime.now().strftime(
-        "%Y-%m-%d %H:%M:%S"), "op": "add_sources"}
-    execute_query(sql, param)
-
-    # now new one
-    insert_new_module(module[1], related_files)
+    save_module_version(module[1], new_files, module=module, operation="add_sources")
 
     return '',status.HTTP_200_OK
 
@@ -518,12 +776,8 @@ def assign_new_files_to_module():
         if module == None:
             insert_new_module(module_name, sources_without_module)
         else:
-            # make found module a history, it will be updated via new entry
-            sql = "UPDATE modules SET is_history=1,last_update=:lupd,operation=:op WHERE ID=:mid"
-            param = {"mid": int(module[0]), "lupd": datetime.datetime.now().strftime(
-                "%Y-%m-%d %H:%M:%S"), "op": "add_sources"}
-            execute_query(sql, param)
-            insert_new_module(module_name, sources_without_module)
+            # make found module a history, it will be updated via new version with files it had and new ones
+            save_module_version(module_name, sources_without_module, module=module, operation="add_sources")
     else:
         return "No new sources.",status.HTTP_204_NO_CONTENT
 
@@ -551,9 +805,6 @@ def remove_module():
     modules_to_remove = data["modules"]
 
     for m in modules_to_remove:
-        module = get_module(m)
-        related_files = module[2]
-
         # make current module a history
         sql = "UPDATE modules SET is_history=1,is_removed=1,last_update=:lupd,operation=:op WHERE ID=:mid"
         param = {"mid": int(m), "lupd": datetime.datetime.now().strftime(
@@ -605,89 +856,39 @@ def get_modules():
 
     :return:
     '''
-    modules_jsons = []
-
     with_files_only = False
     session_id = None
 
     if request.args is not None and len(request.args) > 0:
 
-        with_files_only = request.args["with_files_only"]
-        session_id = request.args["session_id"]
+        with_files_only = request.args.get("with_files_only", "False")
+        session_id = request.args.get("session_id", "None")
 
     if session_id != 'None':
         modules_list = get_session_modules(session_id)
     else:
         modules_list = get_all_modules()
 
-    modules_count = len(modules_list)
-
-    # prepare modules json
-    for row in modules_list:
-        has_related_files = False
-        if row[2] is not None and len(row[2]) > 0:
-            has_related_files = True
-
-        if with_files_only == "True" and has_related_files == False:
-            continue  # skip as we want all modules with files and this entry has no files
-
-        modules_data = {}
-        modules_data["id"] = row[0]
-        modules_data["text"] = row[1]
-        modules_data["parent"] = "#"
-        modules_jsons.append(json.dumps(modules_data))
-
-
-        # get related files
-        if with_files_only == "False":  # if want 'with_files_only' then do not return related files,just modules that have files
-            if has_related_files:
-                related_files = row[2].split(',')
-                for related_file in related_files:
-
-                    modules_data = {}
-                    modules_data["text"], is_history = get_filename_by_id(
-                        related_file, False)
-
-                    if is_history and session_id == 'None':
-                        continue  # if file is history,skip it; we want to show only active sources in module
-
-                    modules_data["id"] = str(row[0]) + "_" + str(related_file)
-                    modules_data["parent"] = row[0]
-                    modules_data["type"] = "module_source"
-                    modules_data["state"] = {
-                        "opened": False, "disabled": False, "selected": False}
-                    modules_jsons.append(json.dumps(modules_data))
-                   
+    # optional param node: # - modules only, module id - its files; returned as json array of nodes for lazy loading
+    node = request.args.get("node")
+    if node is not None:
+        return jsonify(get_modules_tree(modules_list, with_files_only == "True", session_id == 'None', node))
 
+    modules_count = len(modules_list)
+    modules_jsons = [json.dumps(modules_data) for modules_data in get_modules_tree(modules_list, with_files_only == "True", session_id == 'None')]
     return jsonify(modules=modules_jsons, modules_count=modules_count)
 
 
 @app.route("/get_available_builds", methods=["GET"])
 def get_available_builds():
-    builds_json=[] # in a form of : tag - child builds[]
-    all_tags=get_all_active_tags()
-    for tag_row in all_tags:
-        tag_data={}
-        tag_data["id"]="tag_"+str(tag_row[0])
-        tag_data["tag_id"]=tag_row[0]
-        tag_data["parent"]="#"
-        tag_data["text"]=tag_row[1]
-        tag_data["a_attr"]={"class":"jstree_hide_checkbox"}
-        builds_json.append(json.dumps(tag_data)) #parents must be present too
-        # get all builds for the tag
-        builds=get_build_for_tag(tag_row[0])
-        for build_row in builds:
-            build_data={}
-            build_data["id"]="build_"+str(build_row[0])
-            build_data["build_id"]=build_row[0]
-            build_data["text"]=str(build_row[1])
-            build_data["parent"]="tag_"+str(tag_row[0])
-            build_data["parent_tag"]=tag_row[1]
-            build_data["type"] = "build"
-            build_data["state"] = {
-                "opened": False, "disabled": False, "selected": False}
-            builds_json.append(json.dumps(build_data))
-
+    '''
+    tree of tags with their builds.
+    Optional param node: # - tags only, tag node id - its builds; returned as json array of nodes for lazy loading
+    '''
+    node = request.args.get("node")
+    if node is not None:
+        return jsonify(get_builds_tree(node))
+    builds_json = [json.dumps(build_data) for build_data in get_builds_tree()] # in a form of : tag - child builds[]
     return jsonify(builds=builds_json)
 
 
@@ -767,11 +968,14 @@ def get_instrument_function_name():
 
 @app.route("/get_test_session_status")
 def get_test_session_status():
+    '''
+    is there a live session matching session_key/session_id/build param (session without routing key if no params given)
+    '''
     session_is_active = False
-    active_session = get_active_test_session()
+    active_session = route_request_to_session(request.args)
     if active_session is not None:
         session_is_active = True
-    return jsonify(test_session_status=session_is_active)
+    return jsonify(test_session_status=session_is_active, active_sessions_count=len(get_cached_active_test_sessions()))
 
 
 @app.route("/version")
@@ -781,6 +985,8 @@ def version():
 
 @app.route("/get_current_coverage")
 def get_current_coverage():
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     session = request.args["session_id"]
     is_session_over = check_if_session_is_over(session)
     if is_session_over == None or is_session_over == True:
@@ -827,6 +1033,44 @@ def get_current_coverage():
     return jsonify(covered_modules_list=covered_modules, covered_routes_list=covered_routes, test_coverage=file_details, executable=all_executable, executed=all_executed, total_coverage_value=total_coverage_percent, session_over=is_session_over)
 
 
+@app.route("/coverage_stream")
+def coverage_stream():
+    '''
+    Server-Sent Events stream of live coverage of the session.
+    First event is a full snapshot, then only deltas: newly covered probes, files whose coverage changed and total coverage.
+    Coverage is computed once for all subscribers of the session, at most COVERAGE_PUSH_MAX_PER_SECOND times per second.
+    '''
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
+    try:
+        session = int(request.args["session_id"])
+    except (KeyError, ValueError):
+        return "session_id param with session id is required", status.HTTP_400_BAD_REQUEST
+    subscriber = Queue()
+    COVERAGE_SUBSCRIBERS.setdefault(session, []).append(subscriber)
+
+    def stream():
+        try:
+            snapshot = LAST_PUSHED_COVERAGE.get(session)
+            if snapshot is None:
+                snapshot = calculate_session_coverage(session)
+                LAST_PUSHED_COVERAGE[session] = snapshot
+            yield format_coverage_event("snapshot", session, list(snapshot["files"].values()), [], snapshot)
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                except Empty:
+                    yield ": keepalive\n\n"  # comment line, keeps connection open through proxies
+                    continue
+                yield event
+                if '"type": "session_over"' in event:
+                    break
+        finally:
+            unsubscribe_from_coverage(session, subscriber)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/get_sessions")
 def get_sessions():
     sessions_list = get_all_sessions()
@@ -913,6 +1157,8 @@ def view_about():
 
 @app.route("/report/latest")
 def view_latest_report():
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     # get latest session id 
     latest_session_id=get_latest_finished_test_session_id()
     return redirect("/report/"+latest_session_id, code=302)
@@ -920,8 +1166,10 @@ def view_latest_report():
 
 @app.route("/report/<session>")
 def view_report(session=None):
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     output_template=prepare_report_page(session)
-    return output_template
+    return Response(stream_with_context(output_template))
 
 
 @app.route("/report/build/<build_number>/tag/<tag_name>")
@@ -930,10 +1178,11 @@ def view_build_report(build_number,tag_name):
     generate report for build number of specific tag
     and also save as html to drive
     '''
+    if stats_migration_pending():
+        return STATS_MIGRATION_PENDING_MESSAGE, status.HTTP_503_SERVICE_UNAVAILABLE
     output_template,export_template=prepare_report_page_for_build(build_number,tag_name)
-    with open("build_report.html", "wb") as f:
-        f.write(export_template.encode('utf-8').strip())
-    return output_template
+    write_report("build_report.html", export_template)
+    return Response(stream_with_context(output_template))
   
 ########################### /TEMPLATES ###################################
 
@@ -941,41 +1190,15 @@ def view_build_report(build_number,tag_name):
 ########################## /VIEWS #############################################
 
 #######UTIL############
-def execute_query(sql, params=None):
+def is_admin_request():
     '''
-    generic method used to execute sql query against db
-    :param sql:
-    :param params:
-    :return:
+    admin endpoints are allowed from localhost; when ADMIN_TOKEN config is set, only for requests
+    with matching token param or X-Admin-Token header
     '''
-    result = None
-    conn = sqlite3.connect(CONNECTION_STRING)
-    c = conn.cursor()
-    if params != None:
-        result = c.execute(sql, params)
-    else:
-        result = c.execute(sql)
-
-    conn.commit()
-    conn.close()
-    return result.lastrowid
-
-
-def execute_select(sql, params, fetchall):
-    rows = []
-    conn = sqlite3.connect(CONNECTION_STRING)
-    # conn.text_factory = lambda x: x.decode("utf-8")
-    cursor = conn.cursor()
-    if params is not None:
-        cursor.execute(sql, params)
-    else:
-        cursor.execute(sql)
-    if fetchall:
-        rows = cursor.fetchall()
-    else:
-        rows = cursor.fetchone()
-    conn.close()
-    return rows
+    admin_token = get_cached_config_value("ADMIN_TOKEN", "")
+    if admin_token != "":
+        return hmac.compare_digest(request.headers.get("X-Admin-Token", request.args.get("token", "")), admin_token)
+    return request.remote_addr in ("127.0.0.1", "::1")
 
 
 def get_execution_count_for_session(file_id, session_id):
@@ -987,7 +1210,7 @@ def get_execution_count_for_session(file_id, session_id):
     :param session_id:
     :return:
     '''
-    sql = "SELECT COUNT(DISTINCT line_guid) FROM stats WHERE session_id= :si AND file_id=:f"
+    sql = "SELECT COUNT(DISTINCT probe_id) FROM stats WHERE session_id= :si AND file_id=:f"
     param = {"si": int(session_id), "f": int(file_id)}
     executions = execute_select(sql, param, fetchall=False)
     return executions
@@ -996,26 +1219,17 @@ def get_execution_count_for_sessions(file_id, session_id_list):
     '''
     the same as get_execution_count_for_session but get stats for file across multiple sessions not 1
     '''
-    sql = "SELECT COUNT(DISTINCT line_guid) FROM stats WHERE session_id IN("+','.join(map(str, session_id_list))+") AND file_id=:f"
+    sql = "SELECT COUNT(DISTINCT probe_id) FROM stats WHERE session_id IN("+','.join(map(str, session_id_list))+") AND file_id=:f"
     param = {"f": int(file_id)}
     executions = execute_select(sql, param, fetchall=False)
     return executions
 
-def get_stats_asc_sorted(session_id):
+def get_stats_asc_sorted_for_multiple_sessions(session_id_list):
     '''
-    get list of stats for given session
-    sorted asc by date to get a list of stats
-    from least to most recent 
+    :return: generator of rows, read from the cursor while the caller iterates (see db.iter_select)
     '''
-    sql = "SELECT filename,line,send_time,custom_value FROM stats WHERE session_id= :si ORDER BY send_time ASC"
-    param = {"si": int(session_id)}
-    stats= execute_select(sql, param, fetchall=True)
-    return stats
-
-def get_stats_asc_sorted_for_multiple_sessions(session_id_list):
-    sql = "SELECT filename,line,send_time,custom_value FROM stats WHERE session_id IN ("+','.join(map(str, session_id_list))+") ORDER BY send_time ASC"
-    stats= execute_select(sql, None, fetchall=True)
-    return stats
+    sql = "SELECT filename,line,send_time,custom_value FROM stats_rows WHERE session_id IN ("+','.join(map(str, session_id_list))+") ORDER BY send_time ASC,date ASC"
+    return iter_select(sql, None)
 
 def get_latest_file_details(file_id):
     '''
@@ -1023,7 +1237,7 @@ def get_latest_file_details(file_id):
     :param file_id:
     :return:
     '''
-    sql = "SELECT * FROM file_details WHERE file_id=:fid ORDER BY updated DESC LIMIT 1;"
+    sql = "SELECT * FROM file_details WHERE file_id=:fid ORDER BY updated DESC, ID DESC LIMIT 1;"
     param = {"fid": file_id}
     row = execute_select(sql, param, fetchall=False)
     return row
@@ -1045,18 +1259,125 @@ def get_file_details(details_id):
     return row
 
 
-def get_file_id_by_filename(file_name, active_only=False):
-    sql = ""
-    if active_only:
-        sql = "SELECT ID,is_history FROM files WHERE name=:fn AND is_history=0"
+def get_folder_node_id(folder_path):
+    '''
+    stable id of folder node in sources tree, the path can be read back with get_folder_path
+    '''
+    return "folder_" + base64.urlsafe_b64encode(folder_path.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def get_folder_path(folder_node_id):
+    encoded = folder_node_id[len("folder_"):]
+    try:
+        return base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode("utf-8")
+    except ValueError:
+        return None
+
+
+def get_sources_tree(node=None):
+    '''
+    jsTree nodes of sources without module, grouped by folder
+    :param node: None - whole tree, # - folders (with children to be loaded), folder node id - files of the folder
+    '''
+    folders = {}  # folder path -> files, in order of first appearance
+    for row in get_all_active_files_without_module():
+        folders.setdefault(os.path.dirname(row[2]), []).append(row)
+
+    if node is not None and node != "#":
+        folder_path = get_folder_path(node)
+        return [{"id": row[0], "text": row[1], "parent": node, "type": "source"} for row in folders.get(folder_path, [])]
+
+    nodes = []
+    for folder_path, rows in folders.items():
+        folder_id = get_folder_node_id(folder_path)
+        if node == "#":
+            nodes.append({"id": folder_id, "text": folder_path, "parent": "#", "children": True})
+            continue
+        nodes.append({"id": folder_id, "text": folder_path, "parent": "#"})
+        nodes.extend({"id": row[0], "text": row[1], "parent": folder_id, "type": "source"} for row in rows)
+    return nodes
+
+
+def get_files_names(file_ids):
+    '''
+    :return: dict file id -> (name,is_history) of given files, 1 query
+    '''
+    if len(file_ids) == 0:
+        return {}
+    sql = "SELECT ID,name,is_history FROM files WHERE ID IN(" + ','.join(map(str, file_ids)) + ")"
+    return {row[0]: (row[1], row[2]) for row in execute_select(sql, None, fetchall=True)}
+
+
+def get_modules_tree(modules_list, with_files_only, active_files_only, node=None):
+    '''
+    jsTree nodes of modules with their files
+    :param with_files_only: only modules that have files, without the files
+    :param active_files_only: skip files that are history
+    :param node: None - whole tree, # - modules (with children to be loaded), module id - files of the module
+    '''
+    related_files = get_modules_files([row[0] for row in modules_list])  # module id -> file ids
+
+    if node is not None and node != "#":
+        module_ids = [row[0] for row in modules_list if str(row[0]) == node]
+    elif node is None and not with_files_only:
+        module_ids = list(related_files.keys())
     else:
-        sql = "SELECT ID,is_history FROM files WHERE name=:fn"
-    param = {"fn": file_name}
-    row = execute_select(sql, param, fetchall=False)
-    if row is not None:
-        return row[0], row[1]
+        module_ids = []
+    files_names = get_files_names(sorted(set(file_id for module_id in module_ids for file_id in related_files[module_id])))
+
+    nodes = []
+    for row in modules_list:
+        has_related_files = row[0] in related_files
+        if with_files_only and not has_related_files:
+            continue  # skip as we want all modules with files and this entry has no files
+        if node is None or node == "#":
+            modules_data = {"id": row[0], "text": row[1], "parent": "#"}
+            if node == "#" and has_related_files and not with_files_only:
+                modules_data["children"] = True
+            nodes.append(modules_data)
+        if row[0] not in module_ids:
+            continue
+        for related_file in related_files.get(row[0], []):
+            filename, is_history = files_names.get(related_file, (None, True))
+            if is_history and active_files_only:
+                continue  # if file is history,skip it; we want to show only active sources in module
+            nodes.append({"text": filename, "id": str(row[0]) + "_" + str(related_file), "parent": row[0], "type": "module_source",
+                          "state": {"opened": False, "disabled": False, "selected": False}})
+    return nodes
+
+
+def get_builds_tree(node=None):
+    '''
+    jsTree nodes of active tags with their builds, 1 query for tags and 1 for builds
+    :param node: None - whole tree, # - tags (with children to be loaded), tag node id (tag_<id>) - builds of the tag
+    '''
+    tags = get_all_active_tags()
+    if node is not None and node != "#":
+        tags = [tag_row for tag_row in tags if "tag_" + str(tag_row[0]) == node]
+    builds = {}  # tag id -> builds
+    if node != "#" and len(tags) > 0:
+        sql = "SELECT * FROM builds WHERE tag_id IN(" + ','.join(str(int(tag_row[0])) for tag_row in tags) + ") ORDER BY ID"
+        for build_row in execute_select(sql, None, fetchall=True):
+            builds.setdefault(build_row[2], []).append(build_row)
     else:
-        return None, True
+        sql = "SELECT DISTINCT tag_id FROM builds"
+        builds = {row[0]: True for row in execute_select(sql, None, fetchall=True)}
+
+    nodes = []
+    for tag_row in tags:
+        if node is None or node == "#":
+            tag_data = {"id": "tag_" + str(tag_row[0]), "tag_id": tag_row[0], "parent": "#", "text": tag_row[1],
+                        "a_attr": {"class": "jstree_hide_checkbox"}}
+            if node == "#":
+                tag_data["children"] = tag_row[0] in builds
+            nodes.append(tag_data) #parents must be present too
+            if node == "#":
+                continue
+        for build_row in builds.get(tag_row[0], []):
+            nodes.append({"id": "build_" + str(build_row[0]), "build_id": build_row[0], "text": str(build_row[1]),
+                          "parent": "tag_" + str(tag_row[0]), "parent_tag": tag_row[1], "type": "build",
+                          "state": {"opened": False, "disabled": False, "selected": False}})
+    return nodes
 
 
 def get_filename_by_id(file_id, active_only=False):
@@ -1075,36 +1396,36 @@ def get_filename_by_id(file_id, active_only=False):
 
 def get_stats_for_file(file_id, session_id):
     stats = []
-    sql = "SELECT * FROM stats WHERE file_id=:fid AND session_id=:sid"
+    sql = "SELECT * FROM stats_rows WHERE file_id=:fid AND session_id=:sid"
     param = {"fid": file_id, "sid": session_id}
     stats = execute_select(sql, param, fetchall=True)
     return stats
 
 def get_stats_for_file_for_multiple_sessions(file_id,session_id_list):
     stats = []
-    sql = "SELECT * FROM stats WHERE file_id=:fid AND session_id IN("+','.join(map(str, session_id_list))+")"
+    sql = "SELECT * FROM stats_rows WHERE file_id=:fid AND session_id IN("+','.join(map(str, session_id_list))+")"
     param = {"fid": file_id}
     stats = execute_select(sql,param, fetchall=True)
     return stats
 
 def get_stats_for_session(session_id):
     stats = []
-    sql = "SELECT * FROM stats WHERE session_id=:sid"
+    sql = "SELECT * FROM stats_rows WHERE session_id=:sid"
     param = {"sid": session_id}
     stats = execute_select(sql, param, fetchall=True)
 
     return stats
 
-def get_latest_stat_for_session(session_id):
-    stats = []
-    sql = "SELECT date FROM stats WHERE session_id=:sid ORDER BY date DESC"
+def get_last_hit_for_session(session_id):
+    '''
+    when the latest hit of the session was received, stored or not (see process_probe_hit): by this process (in memory),
+    by ingest service (saved with every batch) or before server restart (stats)
+    :return: unix epoch microseconds; 0 if there are no hits
+    '''
+    sql = "SELECT MAX(IFNULL((SELECT last_hit FROM session_last_hits WHERE session_id=:sid),0),IFNULL((SELECT MAX(date) FROM stats WHERE session_id=:sid),0))"
     param = {"sid": session_id}
-    stat = execute_select(sql, param, fetchall=False)
-    stat_date=datetime.datetime(1999,1,1)
-    if stat is not None:
-        stat_date=datetime.datetime.strptime(stat[0],"%Y-%m-%d %H:%M:%S")
-
-    return stat_date
+    last_hit = execute_select(sql, param, fetchall=False)[0]
+    return max(last_hit, SESSION_LAST_HITS.get(session_id, 0))
 
 def get_executable_lines_count_for_file(file_id):
     sql = "SELECT executable_lines_count,name,ID FROM files where ID= :id"
@@ -1194,21 +1515,14 @@ def get_session_by_name(session_name):
 
 
 def get_all_active_files_without_module(ids_only=False):
-    active_modules = get_all_active_modules()
     active_files = get_all_active_files()
     active_files_without_module = []
 
+    # 1 file can live only in 1 module
+    files_with_module = set(row[0] for row in execute_select("SELECT file_id FROM current_module_files", None, fetchall=True))
+
     for active_file in active_files:
-        found_file = False
-        for module in active_modules:  # 1 file can live only in 1 module
-            related_files = []
-            if module[2] is not None and len(module[2]) > 0:
-                related_files = module[2].split(',')
-                for related_file in related_files:
-                    if int(related_file) == int(active_file[0]):
-                        found_file = True
-                        break
-        if not found_file:
+        if int(active_file[0]) not in files_with_module:
             if ids_only:
                 active_files_without_module.append(int(active_file[0]))
             else:
@@ -1224,17 +1538,18 @@ def get_all_active_modules():
     return results
 
 
-def get_file_list_for_live_test_session():
+def get_file_list_for_live_test_session(session_id):
     '''
     return file list among with related file details for live session
-    empty if no live session
+    empty if session is not live
     :param session_id:
     :return:
     '''
     results = None
     files = []
-    sql = "SELECT file_id,file_details,session_id FROM sessions_files INNER JOIN sessions ON sessions_files.session_id=sessions.ID WHERE sessions.is_over=0"
-    results = execute_select(sql, None, fetchall=True)
+    sql = "SELECT file_id,file_details,session_id FROM sessions_files INNER JOIN sessions ON sessions_files.session_id=sessions.ID WHERE sessions.is_over=0 AND sessions.ID=:sid"
+    param = {"sid": session_id}
+    results = execute_select(sql, param, fetchall=True)
 
     live_session_id = None
 
@@ -1379,53 +1694,538 @@ def insert_session_user_tag_relation(session_id,user_id,tag_id):
 
 
 
-def get_config():
-    """
-    get config values from database
-    :return:
-    """
-    CONFIG.clear()  # clear config
-    sql = "SELECT * FROM config"
-    results = execute_select(sql, None, fetchall=True)
-    # iterate through the results now...
-    for result_row in results:
-        CONFIG[result_row[1]] = result_row[2]
+def get_metrics_gauges():
+    '''
+    values sampled at scrape time: (name, help, value) for metrics.render
+    '''
+    gauges = [("lava_stats_rows_inserted", "Rows ever inserted to stats table by server and ingest service processes (rate() gives rows per second).",
+               get_stats_rows_inserted()),
+              ("lava_live_sessions", "Live test sessions.", len(get_cached_active_test_sessions())),
+              ("lava_process_resident_memory_bytes", "Resident memory of the server process.", memory.get_rss()),
+              ("lava_process_peak_resident_memory_bytes", "Peak resident memory of the server process.", memory.get_peak_rss()),
+              ("lava_pending_rows", "Rows buffered in memory, not flushed to db yet.",
+               {(("buffer", "probe_hit_counts"),): len(PROBE_HIT_COUNTS), (("buffer", "test_probes"),): len(PENDING_TEST_PROBES)})]
+    ingest_service = sys.modules.get("ingest_service")  # imported only when ingest service was started
+    if ingest_service is not None and ingest_service.RECORDS_QUEUE is not None:
+        try:
+            depth = ingest_service.RECORDS_QUEUE.qsize()
+        except NotImplementedError:  # macOS
+            depth = None
+        gauges.append(("lava_ingest_queue_batches", "Batches of probe hits waiting in the queue between ingest workers and the writer.", depth))
+    return gauges
+
+
+def start_session_test(session_id, test_id, test_name):
+    '''
+    end test that was running in the session and start the new one
+    '''
+    end_session_test(session_id)
+    sql = "INSERT INTO session_tests(session_id,test_id,test_name,start_time,end_time) VALUES(?,?,?,?,?)"
+    execute_query(sql, (session_id, str(test_id), test_name, time.time_ns() // 1000, None))
+    count_session_change()
+
+
+def end_session_test(session_id):
+    sql = "UPDATE session_tests SET end_time=:now WHERE session_id=:sid AND end_time IS NULL"
+    execute_query(sql, {"now": time.time_ns() // 1000, "sid": session_id})
+    count_session_change()
+
 
+def find_tests_for_file(file_name, lines, session_id_list=None):
+    '''
+    tests that executed the file (file name or path), optionally only given lines
+    :return: list of (test id,test name,line)
+    '''
+    sql = "SELECT DISTINCT test_probes.test_id,(SELECT test_name FROM session_tests WHERE session_tests.test_id=test_probes.test_id ORDER BY ID DESC LIMIT 1),test_probes.line FROM test_probes INNER JOIN files ON files.ID=test_probes.file_id WHERE (files.name=:fn OR files.path=:fn)"
+    if lines:
+        sql += " AND test_probes.line IN(" + ','.join(str(int(l)) for l in lines) + ")"
+    if session_id_list:
+        sql += " AND test_probes.session_id IN(" + ','.join(str(int(s)) for s in session_id_list) + ")"
+    return execute_select(sql + " ORDER BY test_probes.test_id,test_probes.line", {"fn": file_name}, fetchall=True)
+
+
+def get_hit_counts_by_line(file_id, session_id_list):
+    '''
+    sum of hits for each line of the file across given sessions,
+    including hits counted in memory of this process but not flushed yet.
+    Hits counted by ingest service are included after it flushes them (PROBE_HITS_FLUSH_INTERVAL_SECONDS)
+    :return: dict line->hits
+    '''
+    sql = "SELECT line,SUM(hits) FROM probe_hits WHERE file_id=:fid AND session_id IN("+','.join(map(str, session_id_list))+") GROUP BY line"
+    param = {"fid": int(file_id)}
+    line_hits = {}
+    for r in execute_select(sql, param, fetchall=True):
+        line_hits[r[0]] = r[1]
+
+    for (session_id, hit_file_id, line_guid, line), hits in PROBE_HIT_COUNTS.items():
+        if hit_file_id == file_id and session_id in session_id_list:
+            line_hits[line] = line_hits.get(line, 0) + hits
+    return line_hits
+
+
+def compact_session_stats(session_id):
+    '''
+    reduce raw stats of finished session to first hit of each probe (all reports need) plus every n-th hit,
+    at most STATS_TIMELINE_MAX_ROWS of them for the timeline (0 = first hits only), and keep 1 row per visited route.
+    Rows are deleted in transactions of about RETENTION_BATCH_ROWS rows and other greenlets run in between.
+    Session is recorded in compacted_sessions table after the last batch, so interrupted compaction is repeated by retention job.
+    Skipped while rows of old stats table are being moved (see stats_table.move_old_rows), retention job compacts it later.
+    :return: number of removed stats rows
+    '''
+    max_timeline_rows = int(get_cached_config_value("STATS_TIMELINE_MAX_ROWS", "1000"))
+    connection, cursor = create_connection()
+    try:
+        if stats_table.has_old_rows(cursor):
+            return 0
+        probes = cursor.execute("SELECT file_id,probe_id,COUNT(*) FROM stats WHERE session_id=? GROUP BY file_id,probe_id", (session_id,)).fetchall()
+        count = sum(probe[2] for probe in probes)
+
+        sql = "DELETE FROM stats WHERE session_id=:sid AND file_id=:fid AND probe_id=:pid AND hit>0"
+        step = None
+        if max_timeline_rows > 0 and count > 0:
+            # hits of each probe are numbered in time order, every n-th one is a good enough sample of the timeline
+            sql += " AND hit%:step!=0"
+            step = max(1, -(-count // max_timeline_rows))
+        removed_stats = 0
+        batch = []
+        batch_rows = 0
+        for file_id, probe_id, rows in probes:
+            if rows < 2:
+                continue
+            batch.append({"sid": session_id, "fid": file_id, "pid": probe_id, "step": step})
+            batch_rows += rows
+            if batch_rows >= RETENTION_BATCH_ROWS:
+                removed_stats += delete_in_batch(connection, sql, batch)
+                batch = []
+                batch_rows = 0
+        if len(batch) > 0:
+            removed_stats += delete_in_batch(connection, sql, batch)
+
+        removed_routes = 0
+        sql = "SELECT ID FROM visited_routes WHERE session_id=:sid AND ID NOT IN(SELECT MIN(ID) FROM visited_routes WHERE session_id=:sid GROUP BY route_visited) LIMIT :n"
+        while True:
+            route_ids = cursor.execute(sql, {"sid": session_id, "n": RETENTION_BATCH_ROWS}).fetchall()
+            if len(route_ids) == 0:
+                break
+            removed_routes += delete_in_batch(connection, "DELETE FROM visited_routes WHERE ID=?", route_ids)
 
-def get_config_value(key_p):
-    get_config() # refresh config
-    for key, value in CONFIG.items():
-        if key == key_p:
-            return value
+        cursor.execute("INSERT OR REPLACE INTO compacted_sessions(session_id,compacted_date,removed_stats,removed_routes) VALUES(?,?,?,?)",
+                       (session_id, datetime.datetime.now(), removed_stats, removed_routes))
+        connection.commit()
+    finally:
+        connection.close()
+    return removed_stats
+
+
+def delete_in_batch(connection, sql, params):
+    '''
+    run delete statement for each params in 1 transaction and let other greenlets run
+    :return: number of removed rows
+    '''
+    removed = connection.executemany(sql, params).rowcount
+    connection.commit()
+    gevent.sleep(0)
+    return removed
+
+
+def delete_orphaned_rows():
+    '''
+    remove rows left by sessions that do not exist anymore (removed before remove_test_session cleaned them up)
+    '''
+    connection, cursor = create_connection()
+    for table in ("stats", "visited_routes", "sessions_files", "probe_hits", "hit_logs", "compacted_sessions",
+                  "session_tests", "test_probes", "sessions_builds", "sessions_users_tags"):
+        cursor.execute("DELETE FROM " + table + " WHERE session_id NOT IN(SELECT ID FROM sessions)")
+    close_connection(connection)
+
+
+def vacuum_db():
+    '''
+    return free pages to the file system, VACUUM_BATCH_PAGES pages at a time with other greenlets running in between.
+    Dbs created before incremental vacuum was enabled are not switched to it here: that takes full VACUUM
+    which blocks the db for long time on big db, operator runs it once with the server stopped (see CHANGELOG).
+    '''
+    connection, cursor = create_connection()
+    try:
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("free space is not returned to the file system: db is not in incremental vacuum mode. Stop the server and run once: "
+                  "python -c \"import sqlite3; c = sqlite3.connect('" + CONNECTION_STRING + "'); c.execute('PRAGMA auto_vacuum = INCREMENTAL'); c.execute('VACUUM')\"")
+            return
+        while cursor.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            cursor.execute("PRAGMA incremental_vacuum(" + str(VACUUM_BATCH_PAGES) + ")").fetchall()
+            connection.commit()
+            gevent.sleep(0)
+    finally:
+        connection.close()
+
+
+def run_stats_retention():
+    '''
+    compact all finished sessions that are not compacted yet, clean up after removed sessions and vacuum
+    '''
+    sql = "SELECT ID FROM sessions WHERE is_over=1 AND ID NOT IN(SELECT session_id FROM compacted_sessions)"
+    for row in execute_select(sql, None, fetchall=True):
+        compact_session_stats(row[0])
+    delete_orphaned_rows()
+    vacuum_db()
+
+
+def after_session_end(session_id):
+    '''
+    runs in background greenlet after session is stopped: export first, so raw hits are exported before retention
+    '''
+    with memory.track("job", "after_session_end"):
+        if get_config_value("EXPORT_STATS_ON_SESSION_END") == "1":
+            export_stats(session_id)
+        if get_cached_config_value("STATS_RETENTION_ENABLED", "0") == "1":
+            try:
+                compact_session_stats(session_id)
+            except Exception as e:
+                print(e)
+
+
+def stats_retention_job():
+    '''
+    runs in background greenlet for the lifetime of the server
+    '''
+    while True:
+        try:
+            interval = float(get_cached_config_value("STATS_RETENTION_INTERVAL_SECONDS", "3600"))
+        except ValueError:
+            interval = 3600
+        gevent.sleep(interval)
+        if get_cached_config_value("STATS_RETENTION_ENABLED", "0") != "1":
+            continue
+        try:
+            with memory.track("job", "stats_retention"):
+                run_stats_retention()
+        except Exception as e:
+            print(e)
+
+
+def stats_migration_pending():
+    '''
+    True while stats_migration_job moves rows of stats table from before current layout. Sessions with rows
+    not moved yet would look (partly) uncovered, so coverage, reports and export wait until it's done
+    '''
+    if STATS_MIGRATION["done"]:
+        return False
+    connection, cursor = create_connection()
+    try:
+        STATS_MIGRATION["done"] = not stats_table.has_old_rows(cursor)
+    finally:
+        close_connection(connection)
+    return not STATS_MIGRATION["done"]
+
+
+def stats_migration_job():
+    '''
+    runs in background greenlet after start until all rows of stats table from before current layout are moved,
+    in small batches so requests are served in between
+    '''
+    while True:
+        connection = sqlite3.connect(CONNECTION_STRING, timeout=30)
+        try:
+            moved = stats_table.move_old_rows(connection)
+        except Exception as e:
+            print("moving stats rows failed: " + str(e))
+            moved = None
+        finally:
+            connection.close()
+        if moved == 0:
+            return
+        gevent.sleep(0.05 if moved is not None else 60)
+
+
+def probe_hit_counts_flusher():
+    '''
+    runs in background greenlet for the lifetime of the server
+    '''
+    while True:
+        try:
+            interval = float(get_cached_config_value("PROBE_HITS_FLUSH_INTERVAL_SECONDS", "10"))
+        except ValueError:
+            interval = 10
+        gevent.sleep(interval)
+        try:
+            with memory.track("job", "probe_hit_counts_flusher"):
+                flush_pending_rows()
+        except Exception as e:
+            print(e)
+
+
+def calculate_session_coverage(session_id):
+    '''
+    coverage of each file of the session and total coverage, using 1 query for the files and 1 for executions
+    :return: dict with "files" (file id -> file coverage), "executable", "executed", "total_coverage_value"
+    '''
+    sql = "SELECT files.ID,files.path,file_details.executable_lines_count FROM sessions_files INNER JOIN files ON files.ID=sessions_files.file_id INNER JOIN file_details ON file_details.ID=sessions_files.file_details WHERE sessions_files.session_id=:sid"
+    param = {"sid": int(session_id)}
+    session_files = execute_select(sql, param, fetchall=True)
+
+    sql = "SELECT file_id,COUNT(DISTINCT probe_id) FROM stats WHERE session_id=:sid GROUP BY file_id"
+    executions = dict(execute_select(sql, param, fetchall=True))
+    for file_id, new_lines_count in get_new_probes_from_hit_log(session_id).items():
+        executions[file_id] = executions.get(file_id, 0) + new_lines_count
+
+    files = {}
+    all_executable = 0
+    all_executed = 0
+    for r in session_files:
+        file = {}
+        file["id"] = r[0]
+        file["filename"] = r[1]
+        file["executable"] = r[2] or 0
+        file["executed"] = executions.get(r[0], 0)
+        try:
+            file["percent_executed"] = round((file["executed"] / float(file["executable"])) * 100, 1)
+        except ZeroDivisionError:
+            file["percent_executed"] = 0
+        all_executable += file["executable"]
+        all_executed += file["executed"]
+        files[r[0]] = file
+
+    total_coverage_percent = 0
+    if all_executable > 0:
+        total_coverage_percent = round((all_executed / float(all_executable)) * 100, 1)
+    return {"files": files, "executable": all_executable, "executed": all_executed, "total_coverage_value": total_coverage_percent}
+
+
+def get_diff_side_sessions(data, side):
+    '''
+    :param side: "base" or "target"
+    :return: list of session ids of the side of coverage diff, None if side is not given
+    '''
+    try:
+        if data.get(side + "_session_id"):
+            session_id = int(data[side + "_session_id"])
+            if execute_select("SELECT ID FROM sessions WHERE ID=:sid", {"sid": session_id}, fetchall=False) is None:
+                return []
+            return [session_id]
+        if data.get(side + "_build_id"):
+            sql = "SELECT session_id FROM sessions_builds WHERE build_id=:bid"
+            return [r[0] for r in execute_select(sql, {"bid": int(data[side + "_build_id"])}, fetchall=True)]
+    except ValueError:
+        pass
     return None
 
-def set_config_value(key,value):
-    check_value = get_config_value(key)
-    if check_value != None:
-        sql = "UPDATE config SET value= :v WHERE name= :n"
-        param = {"n": key, "v": value}
-    else:
-        sql = "INSERT INTO config(name,value) VALUES(?,?)"
-        param = (key, value)
-    execute_query(sql, param)
 
-def get_active_test_session():
-    """
-    connect to db and get active test session if any
-    :return: active session ID or -1 if no active session
-    """
-    result = None
-    sql = "SELECT * FROM sessions WHERE is_over=0"
-    result = execute_select(sql, None, fetchall=False)
+def get_executed_probes(session_id_list):
+    '''
+    :return: dict file id -> dict line guid -> line, for probes hit in any of the sessions
+    '''
+    sql = "SELECT DISTINCT probes.file_id,probes.line_guid,probes.line FROM stats INNER JOIN probes ON probes.ID=stats.probe_id WHERE stats.session_id IN(" + ','.join(map(str, session_id_list)) + ")"
+    probes = {}
+    for file_id, line_guid, line in execute_select(sql, None, fetchall=True):
+        probes.setdefault(file_id, {})[line_guid] = line
+    return probes
+
+
+def get_executable_lines_counts(session_id_list):
+    '''
+    :return: dict file id -> (path,executable lines count), taken from the latest of the sessions that has the file
+    '''
+    sql = "SELECT sessions_files.file_id,files.path,file_details.executable_lines_count FROM sessions_files INNER JOIN files ON files.ID=sessions_files.file_id INNER JOIN file_details ON file_details.ID=sessions_files.file_details WHERE sessions_files.session_id IN(" + ','.join(map(str, session_id_list)) + ") ORDER BY sessions_files.session_id"
+    return {r[0]: (r[1], r[2] or 0) for r in execute_select(sql, None, fetchall=True)}
+
+
+def get_coverage_percent(executed, executable):
+    if executable > 0:
+        return round((executed / float(executable)) * 100, 1)
+    return 0
+
+
+def calculate_coverage_diff(base_sessions, target_sessions):
+    '''
+    set operations on executed probes of each file, 3 queries per side
+    :return: dict with "base" and "target" totals, "delta_coverage_value", "files" and "modules" that changed
+    '''
+    sides = {}
+    for side, sessions in (("base", base_sessions), ("target", target_sessions)):
+        sides[side] = {"sessions": sessions, "probes": get_executed_probes(sessions), "files": get_executable_lines_counts(sessions)}
+
+    files = []
+    totals = {"base": [0, 0], "target": [0, 0]}  # executed, executable
+    file_totals = {}
+    for file_id in sorted(set(sides["base"]["files"]) | set(sides["target"]["files"])):
+        base_probes = sides["base"]["probes"].get(file_id, {})
+        target_probes = sides["target"]["probes"].get(file_id, {})
+        base_lines = set(base_probes.values())
+        target_lines = set(target_probes.values())
+        file = {"id": file_id, "filename": (sides["target"]["files"].get(file_id) or sides["base"]["files"][file_id])[0]}
+        for side, probes in (("base", base_probes), ("target", target_probes)):
+            executable = sides[side]["files"].get(file_id, (None, 0))[1]
+            file[side + "_executed"] = len(probes)
+            file[side + "_executable"] = executable
+            file[side + "_percent_executed"] = get_coverage_percent(len(probes), executable)
+            totals[side][0] += len(probes)
+            totals[side][1] += executable
+        file["delta_percent_executed"] = round(file["target_percent_executed"] - file["base_percent_executed"], 1)
+        file["newly_covered_probes"] = sorted(set(target_probes) - set(base_probes))
+        file["newly_uncovered_probes"] = sorted(set(base_probes) - set(target_probes))
+        file["newly_covered_lines"] = sorted(target_lines - base_lines)
+        file["newly_uncovered_lines"] = sorted(base_lines - target_lines)
+        file_totals[file_id] = file
+        if file["newly_covered_probes"] or file["newly_uncovered_probes"] or file["delta_percent_executed"] != 0:
+            files.append(file)
+
+    modules = []
+    active_modules = get_all_active_modules()
+    modules_files = get_modules_files([module[0] for module in active_modules])
+    for module in active_modules:
+        module_files = [file_totals[f] for f in modules_files.get(module[0], []) if f in file_totals]
+        if len(module_files) == 0:
+            continue
+        module_diff = {"id": module[0], "module_name": module[1]}
+        for side in ("base", "target"):
+            module_diff[side + "_percent_executed"] = get_coverage_percent(
+                sum(f[side + "_executed"] for f in module_files), sum(f[side + "_executable"] for f in module_files))
+        module_diff["delta_percent_executed"] = round(module_diff["target_percent_executed"] - module_diff["base_percent_executed"], 1)
+        module_diff["newly_covered_probes_count"] = sum(len(f["newly_covered_probes"]) for f in module_files)
+        module_diff["newly_uncovered_probes_count"] = sum(len(f["newly_uncovered_probes"]) for f in module_files)
+        if module_diff["newly_covered_probes_count"] or module_diff["newly_uncovered_probes_count"] or module_diff["delta_percent_executed"] != 0:
+            modules.append(module_diff)
+
+    result = {"files": files, "modules": modules}
+    for side in ("base", "target"):
+        result[side] = {"sessions": sides[side]["sessions"], "executed": totals[side][0], "executable": totals[side][1],
+                        "total_coverage_value": get_coverage_percent(totals[side][0], totals[side][1])}
+    result["delta_coverage_value"] = round(result["target"]["total_coverage_value"] - result["base"]["total_coverage_value"], 1)
     return result
 
 
-def save_visited_route(url, session_id):
+def get_new_probes_from_hit_log(session_id):
+    '''
+    lines hit in the part of session's hit log that is not compacted into stats yet and are not in stats either
+    :return: dict file id -> number of lines
+    '''
+    if hit_log.get_log_size(HIT_LOG_DIR, session_id) == 0:
+        return {}
+    offset = execute_select("SELECT compacted_bytes FROM hit_logs WHERE session_id=:sid", {"sid": int(session_id)}, fetchall=False)
+    log_probes = hit_log.get_uncompacted_probes(HIT_LOG_DIR, session_id, offset[0] if offset else 0)
+    if len(log_probes) == 0:
+        return {}
+    file_ids = set(file_id for file_id, line_guid in log_probes)
+    sql = "SELECT DISTINCT probes.file_id,probes.line_guid FROM stats INNER JOIN probes ON probes.ID=stats.probe_id WHERE stats.session_id=:sid AND stats.file_id IN(" + ','.join(map(str, file_ids)) + ")"
+    stored_probes = set(execute_select(sql, {"sid": int(session_id)}, fetchall=True))
+    new_lines = {}
+    for file_id, line_guid in log_probes - stored_probes:
+        new_lines[file_id] = new_lines.get(file_id, 0) + 1
+    return new_lines
+
+
+def export_stats(session_id=None):
+    if stats_migration_pending():
+        # partly moved session would be exported without its old rows and never exported again
+        print("stats export skipped: " + STATS_MIGRATION_PENDING_MESSAGE)
+        return []
+    try:
+        return stats_export.export_finished_sessions(CONNECTION_STRING, get_config_value("STATS_EXPORT_DIR") or "exports", session_id)
+    except Exception as e:
+        print("stats export failed: " + str(e))
+        return []
+
+
+def compact_hit_log(session_id):
+    '''
+    save hits of the session still waiting in its hit log (see hit_log.py) to stats table
+    '''
+    if hit_log.get_log_size(HIT_LOG_DIR, session_id) == 0:
+        return
+    connection = sqlite3.connect(CONNECTION_STRING, timeout=30)
+    try:
+        hit_log.compact(connection, HIT_LOG_DIR, session_id)
+    finally:
+        connection.close()
+
+
+def format_coverage_event(event_type, session_id, changed_files, new_probes, coverage):
+    event = {"type": event_type, "session_id": session_id, "files": changed_files, "new_probes": new_probes,
+             "executable": coverage["executable"], "executed": coverage["executed"],
+             "total_coverage_value": coverage["total_coverage_value"]}
+    return "data: " + json.dumps(event) + "\n\n"
+
+
+def unsubscribe_from_coverage(session_id, subscriber):
+    subscribers = COVERAGE_SUBSCRIBERS.get(session_id, [])
+    if subscriber in subscribers:
+        subscribers.remove(subscriber)
+    if len(subscribers) == 0:
+        COVERAGE_SUBSCRIBERS.pop(session_id, None)
+        NEW_COVERED_PROBES.pop(session_id, None)
+        LAST_PUSHED_COVERAGE.pop(session_id, None)
+        LAST_PUSHED_LOG_SIZE.pop(session_id, None)
+
+
+def push_coverage_updates():
+    '''
+    compute coverage once for each session that has subscribers and new probes hit since last push,
+    and send the delta to all its subscribers. When session is over, subscribers get 'session_over' event.
+    '''
+    get_cached_active_test_sessions()
+    # hits received by ingest service are saved by another process, so they are not in NEW_COVERED_PROBES
+    stats_count = get_stats_rows_inserted()
+    stats_changed = stats_count != LAST_PUSHED_STATS_COUNT.get("count")
+    LAST_PUSHED_STATS_COUNT["count"] = stats_count
+
+    for session_id in list(COVERAGE_SUBSCRIBERS.keys()):
+        is_live = session_id in ACTIVE_SESSIONS["by_id"]
+        new_probes = NEW_COVERED_PROBES.pop(session_id, [])
+        log_size = hit_log.get_log_size(HIT_LOG_DIR, session_id)
+        log_changed = log_size != LAST_PUSHED_LOG_SIZE.get(session_id, 0)
+        LAST_PUSHED_LOG_SIZE[session_id] = log_size
+        if is_live and len(new_probes) == 0 and not stats_changed and not log_changed:
+            continue
+
+        coverage = calculate_session_coverage(session_id)
+        last_coverage = LAST_PUSHED_COVERAGE.get(session_id)
+        changed_files = []
+        for file_id, file in coverage["files"].items():
+            if last_coverage is None or last_coverage["files"].get(file_id) != file:
+                changed_files.append(file)
+        LAST_PUSHED_COVERAGE[session_id] = coverage
+
+        event_type = "delta"
+        if not is_live:
+            event_type = "session_over"
+        event = format_coverage_event(event_type, session_id, changed_files, new_probes, coverage)
+        for subscriber in COVERAGE_SUBSCRIBERS.get(session_id, []):
+            subscriber.put(event)
+
+
+def coverage_broadcaster():
+    '''
+    runs in background greenlet for the lifetime of the server
+    '''
+    while True:
+        try:
+            max_per_second = float(get_cached_config_value("COVERAGE_PUSH_MAX_PER_SECOND", "1"))
+        except ValueError:
+            max_per_second = 1
+        gevent.sleep(1 / max(max_per_second, 0.01))
+        if len(COVERAGE_SUBSCRIBERS) == 0:
+            continue
+        try:
+            with memory.track("job", "coverage_broadcaster"):
+                push_coverage_updates()
+        except Exception as e:
+            print(e)
+
+
+def format_epoch_microseconds(value):
     '''
-    save visited url
+    unix epoch microseconds as local time string, for reports
     '''
-    sql = "INSERT INTO visited_routes(route_visited,session_id) VALUES(?,?)"
-    execute_query(sql, (url, session_id))
+    if value is None:
+        return ""
+    return str(datetime.datetime.fromtimestamp(value // 1000000).replace(microsecond=value % 1000000))
+
+
+def get_stats_rows_inserted():
+    '''
+    rows ever inserted to stats table by server and ingest service processes
+    '''
+    return execute_select("SELECT inserted_rows FROM stats_counter WHERE ID=1", None, fetchall=False)[0]
 
 
 def get_covered_modules(session_id):
@@ -1459,54 +2259,104 @@ def get_covered_routes(session_id):
             routes_list.append(route_dict)
     return routes_list
 
-def get_covered_routes_for_sessions(session_id_list):
-    routes_list = []
-    route_dict = {}
-    sql = "SELECT route FROM routes"
-    routes = execute_select(sql, None, fetchall=True)
-    if routes != None:
-        for route in routes:
-            route_dict = {}
-            # get sessions that visited this route
-            sql = "SELECT ID FROM visited_routes WHERE session_id IN("+','.join(map(str, session_id_list))+") AND route_visited=:rv"
-            params = {"rv": route[0]}
-            route_ids = execute_select(sql, params, fetchall=True)
-            route_dict["route"] = route[0]
-            if route_ids is not None:
-                # some session visited this route because at least 1 route id was obtained from db
-                # this route was visited - set it to the dict entry
-                route_dict["visited"] = "true"
-            else:
-                route_dict["visited"] = "false"
-            routes_list.append(route_dict)
-    return routes_list
-
 def get_related_files_from_module(module_id):
     '''
-    get list of related files from [related_files] column for specified module_id
+    get list of related files for specified module_id
     files are obtained ofr active module
     :param module_id:
     :return:
     '''
-    sql = "SELECT related_files FROM modules WHERE ID=:mid AND is_history=0"
-    param = {"mid": module_id}
-    related_files = execute_select(sql, param, fetchall=False)
-    if related_files is not None:
-        return [int(file_id) for file_id in related_files[0].split(',')]
-    return []
+    sql = "SELECT file_id FROM current_module_files WHERE module_id=:mid ORDER BY added_in,ID"
+    param = {"mid": int(module_id)}
+    return [row[0] for row in execute_select(sql, param, fetchall=True)]
 
 
-def calculate_total_coverage_for_active_session():
+def get_modules_files(module_ids):
     '''
-    calculate total coverage percentage for active session only
-    :return:
+    files of given module versions (active or history), rebuilt from files each version added and removed (see module_files table), 1 query
+    :return: dict module id -> file ids in the order they were assigned; modules without files are left out
+    '''
+    if len(module_ids) == 0:
+        return {}
+    sql = "SELECT modules.ID,module_files.file_id FROM modules INNER JOIN module_files ON module_files.module_key=modules.module_key " \
+          "AND module_files.added_in<=modules.ID AND (module_files.removed_in IS NULL OR module_files.removed_in>modules.ID) " \
+          "WHERE modules.ID IN(" + ','.join(str(int(module_id)) for module_id in set(module_ids)) + ") ORDER BY module_files.added_in,module_files.ID"
+    modules_files = {}
+    for module_id, file_id in execute_select(sql, None, fetchall=True):
+        modules_files.setdefault(module_id, []).append(file_id)
+    return modules_files
+
+
+def save_module_version(name, added_files=(), removed_files=(), module=None, operation=None):
+    '''
+    insert new version of module, in one transaction.
+    Version saves only files it adds and removes (module_files table) instead of copy of all files
+    :param added_files: files that are not in the module yet
+    :param removed_files: files of the module to remove
+    :param module: row of active module that becomes history, None for a new module
+    :param operation: change of the module that made it history
+    :return: id of the new version
     '''
-    files, live_session_id = get_file_list_for_live_test_session()
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = sqlite3.connect(CONNECTION_STRING)
+    c = conn.cursor()
+    if module is not None:
+        c.execute("UPDATE modules SET is_history=1,last_update=:lupd,operation=:op WHERE ID=:mid",
+                  {"mid": int(module[0]), "lupd": now, "op": operation})
+    c.execute("INSERT INTO modules(module_name,related_files,last_update,is_removed,operation,is_history,module_key) VALUES(?,?,?,?,?,?,?)",
+              (name.lower(), None, now, False, "insert", False, module[7] if module is not None else None))
+    version_id = c.lastrowid
+    module_key = module[7] if module is not None else version_id
+    if module is None:
+        c.execute("UPDATE modules SET module_key=:mk WHERE ID=:mk", {"mk": module_key})
+    c.executemany("INSERT INTO module_files(module_key,file_id,added_in) VALUES(?,?,?)",
+                  [(module_key, file_id, version_id) for file_id in dict.fromkeys(int(file_id) for file_id in added_files)])
+    c.executemany("UPDATE module_files SET removed_in=? WHERE module_key=? AND file_id=? AND removed_in IS NULL",
+                  [(version_id, module_key, int(file_id)) for file_id in removed_files])
+    conn.commit()
+    conn.close()
+    return version_id
+
+
+def migrate_module_versions_to_deltas():
+    '''
+    module versions saved before module_files table keep all their files in related_files column:
+    link versions of each module (same name, until module is removed) with module_key and save
+    only files each version added and removed to module_files table
+    '''
+    conn = sqlite3.connect(CONNECTION_STRING)
+    c = conn.cursor()
+    modules = {}  # module name -> [module key, {file id -> index of its open row}]
+    rows = []  # [module key, file id, added in, removed in]
+    for module_id, name, related_files, is_removed in c.execute("SELECT ID,module_name,related_files,is_removed FROM modules ORDER BY ID").fetchall():
+        module_key, open_rows = modules.setdefault(name, [module_id, {}])
+        files = [int(file_id) for file_id in (related_files or "").split(',') if file_id != ""]
+        for file_id in list(open_rows):
+            if file_id not in files:
+                rows[open_rows.pop(file_id)][3] = module_id
+        for file_id in files:
+            if file_id not in open_rows:
+                open_rows[file_id] = len(rows)
+                rows.append([module_key, file_id, module_id, None])
+        c.execute("UPDATE modules SET module_key=:mk,related_files=NULL WHERE ID=:mid", {"mk": module_key, "mid": module_id})
+        if is_removed:
+            del modules[name]  # module created later with the same name is a new one
+    c.executemany("INSERT INTO module_files(module_key,file_id,added_in,removed_in) VALUES(?,?,?,?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def calculate_total_coverage_for_session(session_id):
+    '''
+    calculate total coverage percentage for given session, live or just ended
+    :return: (total coverage,executed,executable)
+    '''
+    files = get_file_and_file_details_list_for_test_session(session_id)
 
     total_coverage = 0
     total_executed=0
     total_executable=0
-    if live_session_id is not None:
+    if len(files) > 0:
         # stats=get_stats_for_session(live_session_id)
 
 
@@ -1517,12 +2367,12 @@ def calculate_total_coverage_for_active_session():
             total_executable += float(file_details[3])
 
             total_executed += get_execution_count_for_session(
-                source[0], live_session_id)[0]
+                source[0], session_id)[0]
 
         total_coverage = round(
             (float(total_executed) / total_executable) * 100, 1)
 
-    return total_coverage, live_session_id,total_executed,total_executable
+    return total_coverage,total_executed,total_executable
 
 
 def calculate_total_coverage_for_build(build_id):
@@ -1564,13 +2414,7 @@ def insert_new_module(name, related_files):
     :param related_files:
     :return:
     '''
-    related_files_string = None
-    if related_files is not None and len(related_files) > 0:
-        related_files_string = ','.join([str(i) for i in related_files])
-    sql = "INSERT INTO modules(module_name,related_files,last_update,is_removed,operation,is_history) VALUES(?,?,?,?,?,?)"
-    param = (name.lower(), related_files_string, datetime.datetime.now().strftime(
-        "%Y-%m-%d %H:%M:%S"), False, "insert", False)
-    execute_query(sql, param)
+    save_module_version(name, related_files or [])
 
 
 def insert_new_user(username):
@@ -1610,15 +2454,6 @@ def get_module_by_name(module_name,active_only=True):
     return module
 
 
-def get_session_build(session_id):
-    sql = "SELECT build FROM builds INNER JOIN sessions_builds ON builds.ID=sessions_builds.build_id WHERE sessions_builds.session_id=:sid"
-    param = {"sid": session_id}
-    results = execute_select(sql, param, fetchall=True)
-    if len(results)>0:
-        return results[0][0]
-    else:
-        return ""
-
 def get_session_tag_name(session_id):
     sql = "SELECT tag FROM tags INNER JOIN sessions_users_tags ON tags.ID=sessions_users_tags.tag_id WHERE sessions_users_tags.session_id=:sid"
     param = {"sid": session_id}
@@ -1658,29 +2493,18 @@ def unassign_source_from_module(param_files):
     :return:
     '''
 
-    for source_file in param_files:
-
-        all_modules = get_all_modules()  # all active modules
-        for module in all_modules:
-            related_files = module[2]
-
-            if related_files is None:
-                related_files = []
-            else:
-                # because related files are stored as comma separated string
-                related_files = related_files.split(',')
-
-            if str(source_file) in related_files:
-                related_files.remove(str(source_file))
-
-                # make current module a history
-                sql = "UPDATE modules SET is_history=1,last_update=:lupd,operation=:op WHERE ID=:mid"
-                param = {"mid": int(module[0]), "lupd": datetime.datetime.now().strftime(
-                    "%Y-%m-%d %H:%M:%S"), "op": "remove_sources"}
-                execute_query(sql, param)
-
-                # now new one
-                insert_new_module(module[1], related_files)
+    param_files = set(int(source_file) for source_file in param_files)
+    if len(param_files) == 0:
+        return
+    # active modules having any of the files, each gets 1 new version
+    removed_files = {}  # module id -> its files to remove
+    sql = "SELECT module_id,file_id FROM current_module_files WHERE file_id IN(" + ','.join(map(str, param_files)) + ")"
+    for module_id, file_id in execute_select(sql, None, fetchall=True):
+        removed_files.setdefault(module_id, []).append(file_id)
+    for module_id, files in removed_files.items():
+        module = get_module(module_id)
+        # make current module a history, new version is without the files
+        save_module_version(module[1], removed_files=files, module=module, operation="remove_sources")
 
 
 def get_all_modules(active_only=True):
@@ -1719,16 +2543,9 @@ def get_session_modules(session_id):
     :param session_id:
     :return:
     '''
-    related_modules = get_covered_modules(session_id)
-    modules = []
-
-    for related_module in related_modules:
-        sql = "SELECT * FROM modules WHERE ID=:mid"
-        param = {"mid": related_module[0]}
-        module_row=execute_select(sql, param, fetchall=False)
-        modules.append(module_row)
-
-
+    sql = "SELECT modules.* FROM covered_modules INNER JOIN modules ON modules.ID=covered_modules.module_id WHERE covered_modules.session_id=:sid ORDER BY covered_modules.rowid"
+    param = {"sid": session_id}
+    modules = execute_select(sql, param, fetchall=True)
     return modules
 
 
@@ -1778,14 +2595,16 @@ def make_all_files_historical():
     execute_query(sql)
 
 
-def make_all_sessions_inactive():
+def make_session_inactive(session_id):
     '''
-    turn all active sessions into inactive
+    turn active session into inactive
     :return:
     '''
-    sql = "UPDATE sessions SET is_over=1,end_time=:end WHERE is_over=0"
-    params = {"end": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    sql = "UPDATE sessions SET is_over=1,end_time=:end WHERE ID=:sid AND is_over=0"
+    params = {"end": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "sid": session_id}
     execute_query(sql, params)
+    count_session_change()
+    forget_seen_probes(session_id)
 
 
 def remove_test_session(session_id):
@@ -1808,6 +2627,15 @@ def remove_test_session(session_id):
     param = {"sid": session_id}
     execute_query(sql, param)
 
+    # hits, routes and coverage data of the session
+    for table in ("stats", "visited_routes", "sessions_files", "probe_hits", "hit_logs", "compacted_sessions", "session_tests", "test_probes", "session_last_hits"):
+        execute_query("DELETE FROM " + table + " WHERE session_id=:sid", param)
+    if stats_migration_pending():
+        execute_query("DELETE FROM stats_rowid WHERE session_id=:sid", param)
+
+    count_session_change()
+    forget_seen_probes(session_id)
+
 
 def count_module_related_files(module_row):
     '''
@@ -1816,20 +2644,19 @@ def count_module_related_files(module_row):
     :return:
     '''
     if module_row is not None:
-        if module_row[2] is not None:
-            related_files = module_row[2].split(',')
-            return len(related_files)
+        return len(get_modules_files([module_row[0]]).get(module_row[0], []))
 
     return 0
 
 
-def create_new_test_session(name, related_modules,build,user_id,tag_id):
+def create_new_test_session(name, related_modules,build,user_id,tag_id,routing_key=None):
     """
     add test session to db and set it to active
     @param related_modules: what modules this session instruments
     @param build: related build number
     @param user_id: user that created session/is responsible for the tests
     @param tag_id: tag for the session, for example release codename
+    @param routing_key: probes sent with this session_key are saved to this session; None for default session
     :return:
     """
     session = get_session_by_name(name)
@@ -1837,31 +2664,48 @@ def create_new_test_session(name, related_modules,build,user_id,tag_id):
         return False
 
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sql = "INSERT INTO sessions(is_over,name,total_coverage,start_time,end_time,current_active_modules_count,total_executable,total_executed) VALUES(?,?,?,?,?,?,?,?)"
-    inserted_session_id = execute_query(
-        sql, (0, name.lower(), "0", now, None, len(get_all_active_modules()),None,None))
-    # insert related files
-    # if did not specified related modules then assign all active modules to
-    # the session
-    if related_modules == None or len(related_modules) == 0 or related_modules[0]=="*":
-        related_modules = get_all_module_ids()
-    for module in related_modules:
-        print(("getting files for module: " + str(module)))
-        related_files = get_related_files_from_module(module)
-        for source_id in related_files:
-            file_details = get_latest_file_details(source_id)
-            sql = "INSERT INTO sessions_files VALUES(?,?,?)"
-            execute_query(sql, (inserted_session_id,
-                                source_id, file_details[0]))
-
-        sql = "INSERT INTO covered_modules(module_id,session_id) VALUES(?,?)"
-        execute_query(sql, (int(module), inserted_session_id))
-
-    # save build  
-    build_id=get_build_id(build,tag_id) # if build exists for this tag, then id will be returned, none otherwise
-    insert_session_build_relation(inserted_session_id,build_id)
-    # save session user & tag
-    insert_session_user_tag_relation(inserted_session_id,user_id,tag_id)
+    # whole session is created in one transaction on one connection
+    connection = sqlite3.connect(CONNECTION_STRING)
+    try:
+        cursor = connection.cursor()
+        active_modules_count = cursor.execute(
+            "SELECT COUNT(*) FROM modules WHERE is_history=0 AND is_removed=0").fetchone()[0]
+        sql = "INSERT INTO sessions(is_over,name,total_coverage,start_time,end_time,current_active_modules_count,total_executable,total_executed,routing_key) VALUES(?,?,?,?,?,?,?,?,?)"
+        cursor.execute(sql, (0, name.lower(), "0", now, None, active_modules_count, None, None, routing_key))
+        inserted_session_id = cursor.lastrowid
+        # insert related files
+        # if did not specified related modules then assign all active modules to
+        # the session
+        if related_modules == None or len(related_modules) == 0 or related_modules[0]=="*":
+            related_modules = [row[0] for row in cursor.execute("SELECT ID FROM modules WHERE is_history=0")]
+        for module in related_modules:
+            print(("getting files for module: " + str(module)))
+            # snapshot of latest details of every file of the module in one statement
+            # (correlated subquery instead of window function - works with sqlite older than 3.25)
+            sql = "INSERT INTO sessions_files(session_id,file_id,file_details) " \
+                  "SELECT :sid,details.file_id,(SELECT latest.ID FROM file_details AS latest WHERE latest.file_id=details.file_id ORDER BY latest.updated DESC, latest.ID DESC LIMIT 1) " \
+                  "FROM (SELECT DISTINCT file_id FROM file_details WHERE file_id IN (SELECT file_id FROM current_module_files WHERE module_id=:mid)) AS details"
+            cursor.execute(sql, {"sid": inserted_session_id, "mid": int(module)})
+
+            sql = "INSERT INTO covered_modules(module_id,session_id) VALUES(?,?)"
+            cursor.execute(sql, (int(module), inserted_session_id))
+
+        # save build
+        # if build exists for this tag, then its id is used, inserted otherwise
+        row = cursor.execute("SELECT ID from builds WHERE build= :b AND tag_id=:tid", {"b": build, "tid": tag_id}).fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO builds(build,tag_id,update_date) VALUES(?,?,?)", (build, tag_id, now))
+            build_id = cursor.lastrowid
+        else:
+            build_id = row[0]
+        cursor.execute("INSERT INTO sessions_builds(session_id,build_id) VALUES(?,?)", (inserted_session_id, build_id))
+        # save session user & tag
+        cursor.execute("INSERT INTO sessions_users_tags(session_id,user_id,tag_id) VALUES(?,?,?)", (inserted_session_id, user_id, tag_id))
+        connection.commit()
+    finally:
+        connection.close()
+
+    count_session_change()
 
     return True
 
@@ -1964,317 +2808,253 @@ def get_sessions_for_build(build_id):
         sessions.append(get_session(session_id_row[0]))
     return sessions
 
-def prepare_report_page(session,use_embeded_template=False):
-    file_details = []
-    template_details = []
-    all_executable = 0
-    all_executed = 0
-    total_coverage_percent = 0
-    timeline_entries=[]
-    has_timeline_entries=False
-
-    modules_coverage = []
+def get_report_data_version(session_id_list):
+    '''
+    changes whenever anything shown in the report of the sessions changes: hits, visited routes,
+    session state (live/over), routes, modules or details of session files (updated in place, see file_details.changes)
+    '''
+    sessions = ','.join(map(str, session_id_list))
+    version = execute_select("SELECT COUNT(*),MAX(date) FROM stats WHERE session_id IN(" + sessions + ")", None, fetchall=False)
+    version += execute_select("SELECT COUNT(*),MAX(ID) FROM visited_routes WHERE session_id IN(" + sessions + ")", None, fetchall=False)
+    version += execute_select("SELECT GROUP_CONCAT(is_over) FROM sessions WHERE ID IN(" + sessions + ")", None, fetchall=False)
+    version += execute_select("SELECT COUNT(*),MAX(ID) FROM routes", None, fetchall=False)
+    version += execute_select("SELECT COUNT(*),MAX(last_update) FROM modules", None, fetchall=False)
+    version += execute_select("SELECT SUM(file_details.changes) FROM sessions_files INNER JOIN file_details ON file_details.ID=sessions_files.file_details "
+                              "WHERE sessions_files.session_id IN(" + sessions + ")", None, fetchall=False)
+    return version
 
-    template_to_use="report.html"
 
-    if use_embeded_template:
-        template_to_use="report_printable.html" # if creating output html, that is saved to disk, then use report 
-        # html template but with all of the JS and CSS embeded in the html (no dependencies referenced) so it's a 
-        # standalone html file
+def get_report_model(session_id_list):
+    '''
+    everything report templates show for the sessions (1 session or all sessions of a build) except timeline,
+    cached until data of the sessions change (see get_report_data_version), so finished reports are computed once
+    '''
+    session_id_list = sorted(set(int(s) for s in session_id_list))
+    key = (tuple(session_id_list), get_report_data_version(session_id_list))
+    if key not in REPORT_MODELS:
+        if len(REPORT_MODELS) >= REPORT_MODELS_CACHE_SIZE:
+            REPORT_MODELS.pop(next(iter(REPORT_MODELS)))  # the oldest one
+        REPORT_MODELS[key] = build_report_model(session_id_list)
+    return REPORT_MODELS[key]
 
-    build_number=get_session_build(session)
-    session_tag=get_session_tag_name(session)
-    # modules
-    modules = []
-    modules_list = get_session_modules(session)
-    for module in modules_list:
-        module_entry = {}
-        module_entry["ID"] = module[0]
-        module_entry["name"] = module[1]
-        related_files = []
-        related_files = module[2].split(',')
-        module_entry["files"] = related_files
-        module_entry["files_count"] = len(related_files)
-        module_entry["coverage"] = 0
 
-        modules.append(module_entry)
+def build_report_model(session_id_list):
+    '''
+    files, modules and routes of the sessions, 1 query for each. Timeline has a row for every stored hit,
+    so it is not part of the cached model: render_report reads it for each render (see get_timeline_entries)
+    '''
+    sessions = ','.join(map(str, session_id_list))
 
-    all_files_to_instrument = get_all_files_for_session(session)
+    # modules covered by the sessions, in the order sessions were started
+    modules = []
+    module_by_file = {}
+    sql = "SELECT modules.ID,modules.module_name FROM covered_modules INNER JOIN modules ON modules.ID=covered_modules.module_id WHERE covered_modules.session_id IN(" + sessions + ") ORDER BY covered_modules.session_id,covered_modules.ID"
+    module_rows = execute_select(sql, None, fetchall=True)
+    modules_files = get_modules_files([module_row[0] for module_row in module_rows])
+    for module_row in module_rows:
+        if any(m["ID"] == module_row[0] for m in modules):
+            continue
+        related_files = [str(file_id) for file_id in modules_files.get(module_row[0], [])]
+        module = {"ID": module_row[0], "name": module_row[1], "files": related_files, "files_count": len(related_files), "coverage": 0}
+        modules.append(module)
+        for file_id in related_files:
+            module_by_file.setdefault(file_id, module)  # 1 file can be in 1 module
+
+    sql = "SELECT file_id,COUNT(DISTINCT probe_id) FROM stats WHERE session_id IN(" + sessions + ") GROUP BY file_id"
+    executions = dict(execute_select(sql, None, fetchall=True))
 
-    # loop for each file that was instrumented
-    for r in all_files_to_instrument:
+    file_details = []
+    template_details = []
+    all_executable = 0
+    all_executed = 0
+    modules_coverage = {}  # module id -> [executable,executed]
+    sql = "SELECT DISTINCT sessions_files.file_id,files.path,file_details.executable_lines_count FROM sessions_files INNER JOIN files ON files.ID=sessions_files.file_id INNER JOIN file_details ON file_details.ID=sessions_files.file_details WHERE sessions_files.session_id IN(" + sessions + ") ORDER BY sessions_files.rowid"
+    for file_id, path, executable_count in execute_select(sql, None, fetchall=True):
         file = {}
-        # now count line executions in this file and session
-        executions = 0
-        executions_result = get_execution_count_for_session(r[0][0], session)
-        if executions_result != None:
-            executions = float(executions_result[0])
-
-        file["filename"] = r[0][2]
-        file["id"] = str(r[0][0])
-
-        executable_count = r[1][3]
+        executed = float(executions.get(file_id, 0))
+        file["filename"] = path
+        file["id"] = str(file_id)
         file["executable"] = executable_count
-        file["executed"] = executions
-
+        file["executed"] = executed
         try:
-            file["percent_executed"] = round(
-                (executions / float(executable_count)) * 100, 1)
+            file["percent_executed"] = round((executed / float(executable_count)) * 100, 1)
         except:
             file["percent_executed"] = 0
-        # also, I want a total number of all executable lines across all files
         all_executable += float(executable_count)
-        # and total of executed lines across all files
-        all_executed += executions
+        all_executed += executed
 
         if os.path.splitext(file["filename"])[1] == ".html":
             template_details.append(file)
         else:
             file_details.append(file)
 
-        # update module
-        for m in modules:
-            if file["id"] in m["files"]:
-                file["module"] = m["name"]
-                record_found = False
-                for mc in modules_coverage:
-                    if mc["module_id"] == m["ID"]:
-                        record_found = True
-                        # increase executable count by summing up executable
-                        # count from all files of that module
-                        mc["sources_executable"] += executable_count
-                        mc["sources_executed"] += executions
-                        break
-                if not record_found:
-                    modules_cov = {}
-                    modules_cov["module_id"] = m["ID"]
-                    modules_cov["sources_executable"] = executable_count
-                    modules_cov["sources_executed"] = executions
-
-                    modules_coverage.append(modules_cov)
-
-                break  # 1 file can be in 1 module so do not iterate anymore if found
+        module = module_by_file.get(file["id"])
+        if module is not None:
+            file["module"] = module["name"]
+            module_coverage = modules_coverage.setdefault(module["ID"], [0, 0])
+            module_coverage[0] += executable_count
+            module_coverage[1] += executed
 
-    # covered routes
-    covered_routes = get_covered_routes(session)
-
-    # set total coverage by module
+    # total coverage by module
     for m in modules:
-        for mc in modules_coverage:
-            if mc["module_id"] == m["ID"]:
-                try:
-                    m["total_coverage"] = round(
-                        (mc["sources_executed"] / float(mc["sources_executable"])) * 100, 1)
-                except:
-                    m["total_coverage"] = 0
-                m["total_executable"] = mc["sources_executable"]
-                m["total_executed"] = mc["sources_executed"]
-
-    # return total coverage in percent also
-    if all_executable > 0 and all_executed > 0:
-        total_coverage_percent = round(
-            (all_executed / all_executable) * 100, 1)
-
-    is_web_inject_mode = False
-    inject_mode = get_config_value("CURRENT_INJECT_MODE")
-    if inject_mode == "web" or inject_mode == "angular":
-        is_web_inject_mode = True
+        if m["ID"] in modules_coverage:
+            executable_count, executed = modules_coverage[m["ID"]]
+            try:
+                m["total_coverage"] = round((executed / float(executable_count)) * 100, 1)
+            except:
+                m["total_coverage"] = 0
+            m["total_executable"] = executable_count
+            m["total_executed"] = executed
 
-    session_details = get_session(session)
-    is_history = bool(int(session_details[1]))
-
-    show_templates = False
-    if len(template_details) > 0:
-        show_templates = True
-
-    # timeline 
-    timeline_entries_temp=get_stats_asc_sorted(session)
-    for tm_entry in timeline_entries_temp:
-        timeline_entry={}
-        timeline_entry["filename"]=tm_entry[0]
-        timeline_entry["line"]=tm_entry[1]
-        timeline_entry["send_time"]=tm_entry[2]
-        timeline_entry["custom_value"]=tm_entry[3]
-        timeline_entries.append(timeline_entry)
-    if len(timeline_entries)>0:
-        has_timeline_entries=True
-
-    #return render_template('report.html', covered_modules=modules, covered_routes_list=covered_routes, file_details_list=file_details, template_details_list=template_details, total_executable=all_executable, total_executed=all_executed, session_id=session, total_coverage_value=total_coverage_percent, is_web_inject=is_web_inject_mode, is_history=is_history, session_name=session_details[2], session_start=session_details[4], session_end=session_details[5], show_templates=show_templates,timeline_entries=timeline_entries,has_timeline_entries=has_timeline_entries)
-    output_template = render_template(template_to_use, covered_modules=modules, covered_routes_list=covered_routes, file_details_list=file_details, template_details_list=template_details, total_executable=all_executable, total_executed=all_executed, session_id=session, total_coverage_value=total_coverage_percent, is_web_inject=is_web_inject_mode, is_history=is_history, session_name=session_details[2], session_start=session_details[4], session_end=session_details[5], show_templates=show_templates,timeline_entries=timeline_entries,has_timeline_entries=has_timeline_entries,build_number=build_number,session_tag=session_tag)
-    return output_template
-    
-def prepare_report_page_for_build(build_number,tag_name):
-    file_details = []
-    template_details = []
-    all_executable = 0
-    all_executed = 0
     total_coverage_percent = 0
-    timeline_entries=[]
-    has_timeline_entries=False
-
-    modules_coverage = []
-    session_ids=[]
-    session_tag=tag_name
-    modules = []
-
-    # get build id for pair: build_name,tag_name
-    build_id=get_build_id_by_number_and_tag_name(build_number,tag_name)
-    build_sessions=get_sessions_for_build(build_id)
+    if all_executable > 0 and all_executed > 0:
+        total_coverage_percent = round((all_executed / all_executable) * 100, 1)
 
-    session_list_string_array=[]
-    session_list_string=""
-
-    for session_row in build_sessions:
-        session=session_row[0] #id
-        if session not in session_ids:
-            session_ids.append(session)
-        if session not in session_list_string_array:
-            session_list_string_array.append(str(session)) #holds session ids in string format
-        # modules
-        modules_list = get_session_modules(session)
-        for module in modules_list:
-            module_entry = {}
-            module_entry["ID"] = module[0]
-            module_entry["name"] = module[1]
-            related_files = module[2].split(',')
-            module_entry["files"] = related_files
-            module_entry["files_count"] = len(related_files)
-            module_entry["coverage"] = 0
-
-            if module_entry not in modules:
-                modules.append(module_entry)
-
-    all_files_to_instrument = get_all_files_for_sessions(session_ids)
-    session_list_string=",".join(session_list_string_array)
+    # covered routes
+    sql = "SELECT DISTINCT route_visited FROM visited_routes WHERE session_id IN(" + sessions + ")"
+    visited_routes = set(r[0] for r in execute_select(sql, None, fetchall=True))
+    covered_routes = []
+    for route in execute_select("SELECT route FROM routes", None, fetchall=True):
+        covered_routes.append({"route": route[0], "visited": "true" if route[0] in visited_routes else "false"})
 
-    # loop for each file that was instrumented
-    for r in all_files_to_instrument:
-        file = {}
-        # now count line executions in this file and session
-        executions = 0
-        executions_result = get_execution_count_for_sessions(r[0][0], session_ids)
-        if executions_result != None:
-            executions = float(executions_result[0])
+    has_timeline_entries = execute_select("SELECT EXISTS(SELECT 1 FROM stats WHERE session_id IN(" + sessions + "))", None, fetchall=False)[0] == 1
 
-        file["filename"] = r[0][2]
-        file["id"] = str(r[0][0])
+    return {"session_ids": session_id_list, "covered_modules": modules, "covered_routes_list": covered_routes, "file_details_list": file_details,
+            "template_details_list": template_details, "total_executable": all_executable, "total_executed": all_executed,
+            "total_coverage_value": total_coverage_percent, "show_templates": len(template_details) > 0,
+            "has_timeline_entries": has_timeline_entries}
 
-        executable_count = r[1][3]
-        file["executable"] = executable_count
-        file["executed"] = executions
 
-        try:
-            file["percent_executed"] = round(
-                (executions / float(executable_count)) * 100, 1)
-        except:
-            file["percent_executed"] = 0
-        # also, I want a total number of all executable lines across all files
-        all_executable += float(executable_count)
-        # and total of executed lines across all files
-        all_executed += executions
+def render_report(template_name, model, **session_args):
+    '''
+    render report template from report model and timeline of its sessions in chunks, so whole report is never in memory as 1 string.
+    Timeline rows are streamed from the db into the template, so memory used does not grow with number of hits
+    :param session_args: session related template variables
+    :return: generator of html chunks, for streamed response (wrapped in stream_with_context) or write_report
+    '''
+    inject_mode = get_config_value("CURRENT_INJECT_MODE")
+    context = dict(model, timeline_entries=get_timeline_entries(model["session_ids"]), is_web_inject=inject_mode == "web" or inject_mode == "angular", **session_args)
+    app.update_template_context(context)
+    return join_chunks(app.jinja_env.get_template(template_name).generate(**context), REPORT_CHUNK_SIZE)
 
 
-        if os.path.splitext(file["filename"])[1] == ".html":
-            template_details.append(file)
-        else:
-            file_details.append(file)
+def get_timeline_entries(session_id_list):
+    '''
+    stored hits of the sessions in the order they were sent, for report timeline
+    :return: generator of entries, each one is read from the db when the template gets to it
+    '''
+    for tm_entry in get_stats_asc_sorted_for_multiple_sessions(session_id_list):
+        yield {"filename": tm_entry[0], "line": tm_entry[1], "send_time": format_epoch_microseconds(tm_entry[2]), "custom_value": tm_entry[3]}
 
-        # update module
-        for m in modules:
-            if file["id"] in m["files"]:
-                file["module"] = m["name"]
-                record_found = False
-                for mc in modules_coverage:
-                    if mc["module_id"] == m["ID"]:
-                        record_found = True
-                        # increase executable count by summing up executable
-                        # count from all files of that module
-                        mc["sources_executable"] += executable_count
-                        mc["sources_executed"] += executions
-                        break
-                if not record_found:
-                    modules_cov = {}
-                    modules_cov["module_id"] = m["ID"]
-                    modules_cov["sources_executable"] = executable_count
-                    modules_cov["sources_executed"] = executions
-
-                    modules_coverage.append(modules_cov)
-
-                break  # 1 file can be in 1 module so do not iterate anymore if found
 
-    # covered routes
-    covered_routes = get_covered_routes_for_sessions(session_ids)
+def join_chunks(chunks, size):
+    '''
+    template yields thousands of tiny chunks and each one would be a separate socket write,
+    join them into pieces of about size characters
+    '''
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield "".join(pending)
+            pending = []
+            pending_size = 0
+    if len(pending) > 0:
+        yield "".join(pending)
 
-    # set total coverage by module
-    for m in modules:
-        for mc in modules_coverage:
-            if mc["module_id"] == m["ID"]:
-                try:
-                    m["total_coverage"] = round(
-                        (mc["sources_executed"] / float(mc["sources_executable"])) * 100, 1)
-                except:
-                    m["total_coverage"] = 0
-                m["total_executable"] = mc["sources_executable"]
-                m["total_executed"] = mc["sources_executed"]
 
-    # return total coverage in percent also
-    if all_executable > 0 and all_executed > 0:
-        total_coverage_percent = round(
-            (float(all_executed)/ all_executable) * 100, 1)
+def write_report(path, chunks):
+    '''
+    write rendered report chunk by chunk, without leading and trailing whitespace
+    '''
+    with open(path, "wb") as f:
+        pending_whitespace = None  # whitespace after the last content, written only if more content follows
+        for chunk in chunks:
+            if pending_whitespace is None:
+                chunk = chunk.lstrip()
+                if chunk == "":
+                    continue
+                pending_whitespace = ""
+            content = chunk.rstrip()
+            if content == "":
+                pending_whitespace += chunk
+                continue
+            # chunks may be Markup, which escapes plain strings added to it, so they are not concatenated
+            f.write(pending_whitespace.encode('utf-8'))
+            f.write(content.encode('utf-8'))
+            pending_whitespace = chunk[len(content):]
 
-    is_web_inject_mode = False
-    inject_mode = get_config_value("CURRENT_INJECT_MODE")
-    if inject_mode == "web" or inject_mode == "angular":
-        is_web_inject_mode = True
 
+def prepare_report_page(session,use_embeded_template=False):
+    template_to_use="report.html"
 
-    found_active_session=False
-    for session in session_ids:
-        session_details=get_session(session)
-        if bool(int(session_details[1])):
-            found_active_session=True
-            break
+    if use_embeded_template:
+        template_to_use="report_printable.html" # if creating output html, that is saved to disk, then use report 
+        # html template but with all of the JS and CSS embeded in the html (no dependencies referenced) so it's a 
+        # standalone html file
 
-    is_history = found_active_session
+    session_details = get_session(session)
+    return render_report(template_to_use, get_report_model([session]), session_id=session, is_history=bool(int(session_details[1])),
+                         session_name=session_details[2], session_start=session_details[4], session_end=session_details[5],
+                         build_number=get_session_build(session), session_tag=get_session_tag_name(session))
 
-    show_templates = False
-    if len(template_details) > 0:
-        show_templates = True
 
-    # timeline 
-    timeline_entries_temp=get_stats_asc_sorted_for_multiple_sessions(session_ids)
-    for tm_entry in timeline_entries_temp:
-        timeline_entry={}
-        timeline_entry["filename"]=tm_entry[0]
-        timeline_entry["line"]=tm_entry[1]
-        timeline_entry["send_time"]=tm_entry[2]
-        timeline_entry["custom_value"]=tm_entry[3]
-        timeline_entries.append(timeline_entry)
-    if len(timeline_entries)>0:
-        has_timeline_entries=True
+def prepare_report_page_for_build(build_number,tag_name):
+    '''
+    :return: report view and standalone html report to save, both rendered in chunks from the same report model
+    '''
+    # get build id for pair: build_name,tag_name
+    build_id=get_build_id_by_number_and_tag_name(build_number,tag_name)
+    session_ids=[]
+    for session_row in get_sessions_for_build(build_id):
+        if session_row[0] not in session_ids:
+            session_ids.append(session_row[0])
 
+    model = get_report_model(session_ids)
+    session_args = dict(session_id=",".join(map(str, session_ids)), is_history=True, session_name="TOTAL COVERAGE FOR BUILD",
+                        session_start="N/A", session_end="N/A", build_number=build_number, session_tag=tag_name)
     # this will be saved to drive as html report
-    export_template = render_template("report_printable.html", covered_modules=modules, covered_routes_list=covered_routes, file_details_list=file_details, template_details_list=template_details, total_executable=all_executable, total_executed=all_executed, session_id=session_list_string, total_coverage_value=total_coverage_percent, is_web_inject=is_web_inject_mode, is_history=True, session_name="TOTAL COVERAGE FOR BUILD", session_start="N/A", session_end="N/A", show_templates=show_templates,timeline_entries=timeline_entries,has_timeline_entries=has_timeline_entries,build_number=build_number,session_tag=session_tag)
+    export_template = render_report("report_printable.html", model, **session_args)
     # this will be shown to user as view
-    output_template = render_template("report.html", covered_modules=modules, covered_routes_list=covered_routes, file_details_list=file_details, template_details_list=template_details, total_executable=all_executable, total_executed=all_executed, session_id=session_list_string, total_coverage_value=total_coverage_percent, is_web_inject=is_web_inject_mode, is_history=True, session_name="TOTAL COVERAGE FOR BUILD", session_start="N/A", session_end="N/A", show_templates=show_templates,timeline_entries=timeline_entries,has_timeline_entries=has_timeline_entries,build_number=build_number,session_tag=session_tag)
+    output_template = render_report("report.html", model, **session_args)
     return output_template,export_template
 
-def can_session_be_ended():
+def can_session_be_ended(live_session_id):
     buffer_before_closing_session_seconds=get_config_value("BUFFER_TIME_BEFORE_CLOSING_SESSION_SECONDS")
     if buffer_before_closing_session_seconds==None:
         set_config_value("BUFFER_TIME_BEFORE_CLOSING_SESSION_SECONDS",5) # 5 is default
         buffer_before_closing_session_seconds=5
     else:
         buffer_before_closing_session_seconds=int(buffer_before_closing_session_seconds)
-    live_session_id=get_active_test_session()
     if live_session_id is not None:
-        live_session_id=live_session_id[0]
-        latest_stat=get_latest_stat_for_session(live_session_id)
-        if(datetime.datetime.now()-latest_stat).total_seconds()>buffer_before_closing_session_seconds:
-            return True 
+        last_hit=get_last_hit_for_session(live_session_id)
+        if (time.time_ns() // 1000 - last_hit) / 1000000 > buffer_before_closing_session_seconds:
+            return True
     return False
 
 
+def start_ingest_service():
+    '''
+    start dedicated probe hits listener (see ingest_service.py) in separate process, on INGEST_PORT.
+    Not started if INGEST_PORT is not set or is 0.
+    With INGEST_WORKERS > 1 (0 = 1 per core) listener is pre-forked into that many worker processes and 1 writer process.
+    '''
+    ingest_port = get_config_value("INGEST_PORT")
+    if ingest_port is None or int(ingest_port) == 0:
+        return None
+    import ingest_service
+    ingest_workers = int(get_config_value("INGEST_WORKERS") or 1)
+    if ingest_workers == 0:
+        ingest_workers = multiprocessing.cpu_count()
+    if ingest_workers > 1:
+        return ingest_service.start_workers(CONFIG["SERVER_HOST"], int(ingest_port), ingest_workers, SESSION_CHANGES)
+    ingest_process = multiprocessing.Process(target=ingest_service.run, args=(CONFIG["SERVER_HOST"], int(ingest_port), SESSION_CHANGES), daemon=True)
+    ingest_process.start()
+    return ingest_process
+
+
 def init_db():
     '''
     if db does not exist, create
@@ -2362,6 +3142,47 @@ def init_db():
             update_sessions_table_to_v3(cursor)
             close_connection(connection)
 
+        # stats table with strings in every row, its rows are moved by stats_migration_job (hit times saved as strings are converted then)
+        try:
+            execute_select("SELECT probe_id FROM stats", None, fetchall=False)
+        except:
+            connection,cursor=create_connection()
+            update_stats_table_to_slim(cursor)
+            close_connection(connection)
+
+        # tables and columns added after 3.1.0
+        connection,cursor=create_connection()
+        create_probe_hits_table(cursor)
+        create_hit_logs_table(cursor)
+        create_compacted_sessions_table(cursor)
+        create_ingest_counters_table(cursor)
+        create_session_last_hits_table(cursor)
+        create_stats_indexes(cursor)
+        create_file_details_indexes(cursor)
+        create_test_impact_tables(cursor)
+        update_session_tests_times_to_epoch(cursor)
+        create_module_files_table(cursor)
+        close_connection(connection)
+        try:
+            execute_select("SELECT routing_key FROM sessions", None, fetchall=False)
+        except:
+            connection,cursor=create_connection()
+            update_sessions_table_to_v3_2(cursor)
+            close_connection(connection)
+        try:
+            execute_select("SELECT module_key FROM modules", None, fetchall=False)
+        except:
+            connection,cursor=create_connection()
+            update_modules_table_to_v3_3(cursor)
+            close_connection(connection)
+            migrate_module_versions_to_deltas()
+        try:
+            execute_select("SELECT changes FROM file_details", None, fetchall=False)
+        except:
+            connection,cursor=create_connection()
+            update_file_details_table_to_v3_3(cursor)
+            close_connection(connection)
+
             
 
            
@@ -2375,6 +3196,17 @@ def init_db():
 if __name__ == "__main__":
     init_db()
     get_config()
+    reset_ingest_counters()
+    start_ingest_service()
     #app.run(host=CONFIG["SERVER_HOST"], port=int(CONFIG["PORT"]), threaded=True)
+    gevent.spawn(probe_hit_counts_flusher)
+    gevent.spawn(coverage_broadcaster)
+    gevent.spawn(stats_retention_job)
+    gevent.spawn(stats_migration_job)
     http_server = WSGIServer((CONFIG["SERVER_HOST"], int(CONFIG["PORT"])), app)
-    http_server.serve_forever()
+    # exit normally on SIGTERM, so pending rows are saved and ingest processes are terminated and save theirs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        http_server.serve_forever()
+    finally:
+        flush_pending_rows()
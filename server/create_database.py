@@ -4,7 +4,9 @@ PATH = 'instrument.db'
 
 
 def create_db(c):
-    
+    # space freed by removed sessions and retention job is returned with PRAGMA incremental_vacuum,
+    # has to be set before any table is created
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
 
     ##########################################################################
     ##################  T A B L E       C R E A T I O N S   ##################
@@ -14,12 +16,12 @@ def create_db(c):
     '''
     [SESSIONS] table
     '''
-    c.execute('''CREATE TABLE IF NOT EXISTS sessions(ID INTEGER PRIMARY KEY AUTOINCREMENT,is_over INTEGER,name VARCHAR(160),total_coverage VARCHAR(10),start_time DATETIME,end_time DATETIME,current_active_modules_count INTEGER,total_executable INTEGER,total_executed INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions(ID INTEGER PRIMARY KEY AUTOINCREMENT,is_over INTEGER,name VARCHAR(160),total_coverage VARCHAR(10),start_time DATETIME,end_time DATETIME,current_active_modules_count INTEGER,total_executable INTEGER,total_executed INTEGER,routing_key VARCHAR(200))''')
 
     '''
     [STATS] table
     '''
-    c.execute('''CREATE TABLE IF NOT EXISTS stats(ID INTEGER PRIMARY KEY AUTOINCREMENT,file_id INTEGER, session_id INTEGER, date DATETIME, filename VARCHAR(4000), line INTEGER, line_guid VARCHAR(1000), coverage_type VARCHAR(200),send_time DATETIME,custom_value VARCHAR(200))''')
+    create_stats_table(c)
 
     '''
    [CONFIG] table
@@ -55,7 +57,8 @@ def create_db(c):
 
     '''
     c.execute(
-        '''CREATE TABLE IF NOT EXISTS file_details(ID INTEGER PRIMARY KEY AUTOINCREMENT,file_id INTEGER, file_content BLOB, executable_lines_count INTEGER,updated DATETIME,executable_lines VARCHAR(4000))''')
+        '''CREATE TABLE IF NOT EXISTS file_details(ID INTEGER PRIMARY KEY AUTOINCREMENT,file_id INTEGER, file_content BLOB, executable_lines_count INTEGER,updated DATETIME,executable_lines VARCHAR(4000),changes INTEGER DEFAULT 0)''')
+    create_file_details_indexes(c)
 
     '''
     [ROUTES] table
@@ -71,14 +74,16 @@ def create_db(c):
 
     ID
     module_name - unique module name given by user in Modules section of the dashboard
-    related_files - comma separated file id's
+    related_files - not used anymore, was comma separated file id's; files of module versions are in module_files table
     last_update - date when last update was performed which resulted in revision being increased
     is_removed - true if user completely removed it (0/1); can set history=1 as well.
     operation - files_update,rename,delete
     is_history -when user updates module, eg: renames or file assignment then current module's entry becomes history; new entry is inserted for updated state.
+    module_key - ID of the first version of the module, same for all its versions
     '''
     c.execute(
-        '''CREATE TABLE IF NOT EXISTS modules(ID INTEGER PRIMARY KEY AUTOINCREMENT,module_name VARCHAR(100),related_files VARCHAR(4000),last_update DATETIME,is_removed INTEGER,operation VARCHAR(100),is_history INTEGER)''')
+        '''CREATE TABLE IF NOT EXISTS modules(ID INTEGER PRIMARY KEY AUTOINCREMENT,module_name VARCHAR(100),related_files VARCHAR(4000),last_update DATETIME,is_removed INTEGER,operation VARCHAR(100),is_history INTEGER,module_key INTEGER)''')
+    create_module_files_table(c)
 
     '''
     [COVERED_MODULES] table
@@ -133,6 +138,36 @@ def create_db(c):
     '''
     create_session_build_table(c)
 
+    '''
+    [PROBE_HITS] table
+    '''
+    create_probe_hits_table(c)
+
+    '''
+    [HIT_LOGS] table
+    '''
+    create_hit_logs_table(c)
+
+    '''
+    [COMPACTED_SESSIONS] table
+    '''
+    create_compacted_sessions_table(c)
+
+    '''
+    [SESSION_TESTS] and [TEST_PROBES] tables
+    '''
+    create_test_impact_tables(c)
+
+    '''
+    [INGEST_COUNTERS] table
+    '''
+    create_ingest_counters_table(c)
+
+    '''
+    [SESSION_LAST_HITS] table
+    '''
+    create_session_last_hits_table(c)
+
 
     ##########################################################################
     ##################  C O N F I G     E N T R I E S   ######################
@@ -154,6 +189,38 @@ def create_db(c):
               ("DEFAULT_MIN_COVERAGE_PERCENT", 60))
     c.execute("INSERT INTO config(name,value) VALUES(?,?)",
               ("BUFFER_TIME_BEFORE_CLOSING_SESSION_SECONDS", 10))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("INGEST_POLICY", "first_hit"))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("COUNT_PROBE_HITS", 0))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("PROBE_HITS_FLUSH_INTERVAL_SECONDS", 10))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("COVERAGE_PUSH_MAX_PER_SECOND", 1))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("INGEST_PORT", 5001))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("INGEST_WORKERS", 1))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("HIT_LOG_ENABLED", 0))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("HIT_LOG_COMPACT_INTERVAL_SECONDS", 5))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("STATS_EXPORT_DIR", "exports"))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("EXPORT_STATS_ON_SESSION_END", 0))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("STATS_RETENTION_ENABLED", 0))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("STATS_RETENTION_INTERVAL_SECONDS", 3600))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("STATS_TIMELINE_MAX_ROWS", 1000))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("SQL_TRACE_ENABLED", 0))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("SQL_SLOW_QUERY_MS", 100))
+    c.execute("INSERT INTO config(name,value) VALUES(?,?)",
+              ("ADMIN_TOKEN", ""))
 
    
     
@@ -190,6 +257,128 @@ def create_session_build_table(cursor):
         '''CREATE TABLE IF NOT EXISTS sessions_builds(session_id INTEGER,build_id INTEGER)''')
 
 
+def create_probe_hits_table(cursor):
+    '''
+    aggregated number of executions of each probe in a session.
+    Repeated hits are not stored in stats (only the first one is), they are counted in memory
+    and added to this table periodically.
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS probe_hits(session_id INTEGER,file_id INTEGER,line_guid VARCHAR(1000),line INTEGER,hits INTEGER)''')
+    cursor.execute(
+        '''CREATE UNIQUE INDEX IF NOT EXISTS probe_hits_probe ON probe_hits(session_id,file_id,line_guid)''')
+
+
+def create_test_impact_tables(cursor):
+    '''
+    session_tests - tests run in session (set by /set_current_test), test with no end_time is running now,
+        start_time, end_time - unix epoch microseconds, hits received in between are attributed to the test
+    test_probes - probes executed by each test, 1 row per test, session and probe
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS session_tests(ID INTEGER PRIMARY KEY AUTOINCREMENT,session_id INTEGER,test_id VARCHAR(200),test_name VARCHAR(400),start_time INTEGER,end_time INTEGER)''')
+    cursor.execute(
+        '''CREATE INDEX IF NOT EXISTS session_tests_session ON session_tests(session_id,start_time)''')
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS test_probes(test_id VARCHAR(200),session_id INTEGER,file_id INTEGER,line_guid VARCHAR(1000),line INTEGER)''')
+    cursor.execute(
+        '''CREATE UNIQUE INDEX IF NOT EXISTS test_probes_probe ON test_probes(test_id,session_id,file_id,line_guid)''')
+    cursor.execute(
+        '''CREATE INDEX IF NOT EXISTS test_probes_file ON test_probes(file_id,line)''')
+
+
+def create_module_files_table(cursor):
+    '''
+    files of modules, 1 row per file and period it was in the module: file is in module version V
+    when added_in<=V and (removed_in is null or removed_in>V), both are ID's of module versions (modules table).
+    Module version adds rows for files it adds and sets removed_in of files it removes, instead of copying all files.
+    current_module_files - files of active modules
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS module_files(ID INTEGER PRIMARY KEY AUTOINCREMENT,module_key INTEGER,file_id INTEGER,added_in INTEGER,removed_in INTEGER)''')
+    cursor.execute(
+        '''CREATE INDEX IF NOT EXISTS module_files_module ON module_files(module_key,removed_in)''')
+    cursor.execute(
+        '''CREATE VIEW IF NOT EXISTS current_module_files AS SELECT modules.ID AS module_id,module_files.file_id AS file_id,module_files.added_in AS added_in,module_files.ID AS ID FROM modules INNER JOIN module_files ON module_files.module_key=modules.module_key AND module_files.removed_in IS NULL WHERE modules.is_history=0''')
+
+
+def create_stats_table(cursor):
+    '''
+    stats - 1 row per stored probe hit, clustered by session, file and probe (WITHOUT ROWID), so executed probes
+        of a session are read from 1 range of the table without separate index.
+        hit - number of the hit of the probe in the session, first hit is 0
+        date, send_time - when hit was received by server and sent by helper, unix epoch microseconds
+        coverage_type, custom_value - ID's in stats_values
+    probes - line guid and line of each probe of a file
+    stats_values - coverage types and custom values of hits, each distinct string is saved once
+    stats_counter - rows ever inserted to stats
+    stats_rows - hits with probes and values resolved, in the layout stats table had before
+    Rows are inserted with stats_table.insert_stats_rows.
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS stats(session_id INTEGER,file_id INTEGER,probe_id INTEGER,hit INTEGER,date INTEGER,send_time INTEGER,coverage_type INTEGER,custom_value INTEGER,PRIMARY KEY(session_id,file_id,probe_id,hit)) WITHOUT ROWID''')
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS probes(ID INTEGER PRIMARY KEY,file_id INTEGER,line_guid VARCHAR(1000),line INTEGER,UNIQUE(file_id,line_guid))''')
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS stats_values(ID INTEGER PRIMARY KEY,value VARCHAR(200) UNIQUE)''')
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS stats_counter(ID INTEGER PRIMARY KEY,inserted_rows INTEGER)''')
+    cursor.execute(
+        '''INSERT OR IGNORE INTO stats_counter(ID,inserted_rows) VALUES(1,0)''')
+    cursor.execute(
+        '''CREATE VIEW IF NOT EXISTS stats_rows AS SELECT stats.file_id AS file_id,stats.session_id AS session_id,stats.date AS date,files.name AS filename,probes.line AS line,probes.line_guid AS line_guid,coverage_types.value AS coverage_type,stats.send_time AS send_time,custom_values.value AS custom_value,stats.probe_id AS probe_id,stats.hit AS hit FROM stats INNER JOIN probes ON probes.ID=stats.probe_id LEFT JOIN files ON files.ID=stats.file_id LEFT JOIN stats_values AS coverage_types ON coverage_types.ID=stats.coverage_type LEFT JOIN stats_values AS custom_values ON custom_values.ID=stats.custom_value''')
+    create_stats_indexes(cursor)
+
+
+def create_stats_indexes(cursor):
+    '''
+    hit times of sessions (end of session, report versions) are read without scanning whole stats table
+    '''
+    cursor.execute(
+        '''CREATE INDEX IF NOT EXISTS stats_session_date ON stats(session_id,date)''')
+
+
+def create_file_details_indexes(cursor):
+    '''
+    latest details of each file (session start snapshot) are found without scanning whole file_details table
+    '''
+    cursor.execute(
+        '''CREATE INDEX IF NOT EXISTS file_details_file_updated ON file_details(file_id,updated)''')
+
+
+def create_hit_logs_table(cursor):
+    '''
+    how much of the append-only hit log of the session (see hit_log.py) is already saved in stats table
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS hit_logs(session_id INTEGER PRIMARY KEY,compacted_bytes INTEGER)''')
+
+
+def create_compacted_sessions_table(cursor):
+    '''
+    finished sessions whose raw stats were reduced by retention job to first hit of each probe and sampled timeline
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS compacted_sessions(session_id INTEGER PRIMARY KEY,compacted_date DATETIME,removed_stats INTEGER,removed_routes INTEGER)''')
+
+
+def create_ingest_counters_table(cursor):
+    '''
+    probe hits received, stored and dropped by ingest policy since server start, summed over Flask and ingest service processes
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS ingest_counters(name VARCHAR(200) PRIMARY KEY,value INTEGER)''')
+
+
+def create_session_last_hits_table(cursor):
+    '''
+    when the last probe hit of the session was received (unix epoch microseconds), repeated hits included,
+    also the ones not stored because of ingest policy
+    '''
+    cursor.execute(
+        '''CREATE TABLE IF NOT EXISTS session_last_hits(session_id INTEGER PRIMARY KEY,last_hit INTEGER)''')
+
+
 def update_stats_table_to_v3(cursor):
     cursor.execute(
         '''ALTER TABLE stats ADD COLUMN send_time DATETIME''')
@@ -197,6 +386,31 @@ def update_stats_table_to_v3(cursor):
         '''ALTER TABLE stats ADD COLUMN custom_value VARCHAR(200)''')
 
 
+def update_session_tests_times_to_epoch(cursor):
+    '''
+    start_time and end_time of tests saved as local time strings to unix epoch microseconds
+    '''
+    for column in ("start_time", "end_time"):
+        cursor.execute(
+            "UPDATE session_tests SET " + column + "=CAST(strftime('%s'," + column + ",'utc') AS INTEGER)*1000000+CAST(ROUND(strftime('%f'," + column + ")*1000) AS INTEGER)%1000*1000 WHERE typeof(" + column + ")='text'")
+
+
+def update_stats_table_to_slim(cursor):
+    '''
+    stats table with row per hit and strings in every row is renamed to stats_rowid and the new one is created,
+    rows are moved to it in background by stats_table.move_old_rows
+    '''
+    cursor.execute(
+        '''DROP INDEX IF EXISTS stats_session_probe''')
+    cursor.execute(
+        '''DROP INDEX IF EXISTS stats_session_date''')
+    cursor.execute(
+        '''ALTER TABLE stats RENAME TO stats_rowid''')
+    create_stats_table(cursor)
+    cursor.execute(
+        '''UPDATE stats_counter SET inserted_rows=IFNULL((SELECT seq FROM sqlite_sequence WHERE name='stats_rowid'),0)''')
+
+
 def update_sessions_table_to_v3(cursor):
     cursor.execute(
         '''ALTER TABLE sessions ADD COLUMN total_executable INTEGER''')
@@ -204,6 +418,24 @@ def update_sessions_table_to_v3(cursor):
         '''ALTER TABLE sessions ADD COLUMN total_executed INTEGER''')
 
 
+def update_sessions_table_to_v3_2(cursor):
+    cursor.execute(
+        '''ALTER TABLE sessions ADD COLUMN routing_key VARCHAR(200)''')
+
+
+def update_modules_table_to_v3_3(cursor):
+    cursor.execute(
+        '''ALTER TABLE modules ADD COLUMN module_key INTEGER''')
+
+
+def update_file_details_table_to_v3_3(cursor):
+    '''
+    changes - how many times content or executable lines of the row were updated, part of report data version
+    '''
+    cursor.execute(
+        '''ALTER TABLE file_details ADD COLUMN changes INTEGER DEFAULT 0''')
+
+
 def create_connection():
     conn = sqlite3.connect(PATH)
     c = conn.cursor()
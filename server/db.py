@@ -0,0 +1,176 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+
+Db access and config shared by the Flask process (Instrument_server.py) and ingest service processes (ingest_service.py).
+Every query opens its own connection. Statements run in a Flask request are counted and traced, see sql_trace.py.
+'''
+
+import sqlite3
+import time
+
+from flask import g, has_request_context
+
+import metrics
+import sql_trace
+
+
+CONNECTION_STRING = 'instrument.db'
+CONFIG = {}  # dict holding key/value of config entries
+
+
+def count_sql_statement():
+    '''
+    :return: list collecting statements of the current request if it's traced (see sql_trace.py), else None
+    '''
+    metrics.count("sql_statements")
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        return g.get("sql_trace")
+    return None
+
+
+def execute_query(sql, params=None):
+    '''
+    generic method used to execute sql query against db
+    :param sql:
+    :param params:
+    :return:
+    '''
+    traced_statements = count_sql_statement()
+    started = time.perf_counter()
+    result = None
+    conn = sqlite3.connect(CONNECTION_STRING)
+    c = conn.cursor()
+    if params != None:
+        result = c.execute(sql, params)
+    else:
+        result = c.execute(sql)
+
+    conn.commit()
+    conn.close()
+    if traced_statements is not None:
+        sql_trace.record(traced_statements, sql, time.perf_counter() - started, max(result.rowcount, 0))
+    return result.lastrowid
+
+
+def execute_select(sql, params, fetchall):
+    traced_statements = count_sql_statement()
+    started = time.perf_counter()
+    rows = []
+    conn = sqlite3.connect(CONNECTION_STRING)
+    # conn.text_factory = lambda x: x.decode("utf-8")
+    cursor = conn.cursor()
+    if params is not None:
+        cursor.execute(sql, params)
+    else:
+        cursor.execute(sql)
+    if fetchall:
+        rows = cursor.fetchall()
+    else:
+        rows = cursor.fetchone()
+    conn.close()
+    if traced_statements is not None:
+        sql_trace.record(traced_statements, sql, time.perf_counter() - started, len(rows) if fetchall else int(rows is not None))
+    return rows
+
+
+def iter_select(sql, params):
+    '''
+    like execute_select with fetchall, but rows are read from the cursor one by one while the caller iterates,
+    for results too big to hold in memory. Connection is closed when all rows are read or the generator is closed
+    '''
+    traced_statements = count_sql_statement()
+    started = time.perf_counter()
+    row_count = 0
+    conn = sqlite3.connect(CONNECTION_STRING)
+    try:
+        cursor = conn.cursor()
+        if params is not None:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        for row in cursor:
+            row_count += 1
+            yield row
+    finally:
+        conn.close()
+        if traced_statements is not None:
+            sql_trace.record(traced_statements, sql, time.perf_counter() - started, row_count)
+
+
+def get_config():
+    """
+    get config values from database
+    :return:
+    """
+    CONFIG.clear()  # clear config
+    sql = "SELECT * FROM config"
+    results = execute_select(sql, None, fetchall=True)
+    # iterate through the results now...
+    for result_row in results:
+        CONFIG[result_row[1]] = result_row[2]
+
+
+def get_cached_config_value(key_p, default=None):
+    '''
+    same as get_config_value but without reading config table again,
+    meant for code that runs for every probe hit. Values are refreshed on /refresh_config
+    and on every get_config_value call.
+    '''
+    value = CONFIG.get(key_p)
+    if value is None:
+        return default
+    return str(value)
+
+
+def get_config_value(key_p):
+    get_config() # refresh config
+    for key, value in CONFIG.items():
+        if key == key_p:
+            return value
+    return None
+
+
+def set_config_value(key,value):
+    check_value = get_config_value(key)
+    if check_value != None:
+        sql = "UPDATE config SET value= :v WHERE name= :n"
+        param = {"n": key, "v": value}
+    else:
+        sql = "INSERT INTO config(name,value) VALUES(?,?)"
+        param = (key, value)
+    execute_query(sql, param)
@@ -0,0 +1,212 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Append-only log of probe hits, 1 per live session, used by the ingest service writer instead of
+inserting every hit into stats table. Each hit is a fixed-size record appended to hit_logs/session_<id>.log,
+strings (filename, line guid, coverage type, custom value) are written once to session_<id>.strings
+(1 json string per line) and records keep only their index.
+
+Log is folded into stats table by compact(), position of the last compacted record is kept in hit_logs table
+in the same transaction, so each record is saved exactly once. Live coverage reads the part of the log
+that is not compacted yet directly from memory-mapped file (with numpy if it's installed).
+'''
+
+import json
+import mmap
+import os
+import struct
+
+import stats_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# file id, filename, line, line guid, coverage type, custom value (string refs), date, send time (unix epoch microseconds)
+RECORD = struct.Struct("<iiiiiiqq")
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([("file_id", "<i4"), ("filename", "<i4"), ("line", "<i4"), ("line_guid", "<i4"),
+                                ("coverage_type", "<i4"), ("custom_value", "<i4"), ("date", "<i8"), ("send_time", "<i8")])
+
+OPEN_LOGS = {}  # session id -> {"log": file, "strings_file": file, "strings": {string: ref}}
+
+
+def get_log_paths(log_dir, session_id):
+    '''
+    :return: path of records file and path of strings file of the session
+    '''
+    name = os.path.join(log_dir, "session_" + str(session_id))
+    return name + ".log", name + ".strings"
+
+
+def load_strings(strings_path):
+    '''
+    :return: list of strings, ref is the index
+    '''
+    strings = []
+    if os.path.exists(strings_path):
+        with open(strings_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # being written right now, records do not reference it yet
+                strings.append(json.loads(line))
+    return strings
+
+
+def open_log(log_dir, session_id):
+    if session_id not in OPEN_LOGS:
+        os.makedirs(log_dir, exist_ok=True)
+        log_path, strings_path = get_log_paths(log_dir, session_id)
+        strings = load_strings(strings_path)
+        OPEN_LOGS[session_id] = {"log": open(log_path, "ab"), "strings_file": open(strings_path, "a", encoding="utf-8"),
+                                 "strings": {s: ref for ref, s in enumerate(strings)}}
+    return OPEN_LOGS[session_id]
+
+
+def get_string_ref(session_log, value):
+    strings = session_log["strings"]
+    if value not in strings:
+        strings[value] = len(strings)
+        session_log["strings_file"].write(json.dumps(value) + "\n")
+    return strings[value]
+
+
+def append_stats_rows(log_dir, stats_rows):
+    '''
+    append hits to logs of their sessions
+    :param stats_rows: rows in the same form as for stats_table.insert_stats_rows
+    '''
+    records = {}
+    for file_id, session_id, date, filename, line, line_guid, coverage_type, send_time, custom_value in stats_rows:
+        session_log = open_log(log_dir, session_id)
+        records.setdefault(session_id, []).append(RECORD.pack(
+            file_id, get_string_ref(session_log, filename), line, get_string_ref(session_log, line_guid),
+            get_string_ref(session_log, coverage_type), get_string_ref(session_log, custom_value),
+            date, send_time))
+
+    for session_id, session_records in records.items():
+        session_log = OPEN_LOGS[session_id]
+        # strings first, so records never point to string that is not on disk
+        session_log["strings_file"].flush()
+        session_log["log"].write(b"".join(session_records))
+        session_log["log"].flush()
+
+
+def get_log_size(log_dir, session_id):
+    try:
+        return os.path.getsize(get_log_paths(log_dir, session_id)[0])
+    except OSError:
+        return 0
+
+
+def read_records(log_dir, session_id, offset):
+    '''
+    complete records written after offset
+    :return: list of RECORD tuples and offset of the end of the last one
+    '''
+    log_path = get_log_paths(log_dir, session_id)[0]
+    count = (get_log_size(log_dir, session_id) - offset) // RECORD.size
+    if count <= 0:
+        return [], offset
+    end = offset + count * RECORD.size
+    with open(log_path, "rb") as f:
+        with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as m:
+            return list(RECORD.iter_unpack(m[offset:end])), end
+
+
+def get_compacted_offset(cursor, session_id):
+    row = cursor.execute("SELECT compacted_bytes FROM hit_logs WHERE session_id=?", (session_id,)).fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def compact(connection, log_dir, session_id):
+    '''
+    fold records not compacted yet into stats table, in 1 transaction together with the new position
+    :return: number of records saved to stats
+    '''
+    if get_log_size(log_dir, session_id) == 0:
+        return 0
+    cursor = connection.cursor()
+    cursor.execute("BEGIN IMMEDIATE")  # only 1 compactor at a time (ingest writer or server ending the session)
+    try:
+        offset = get_compacted_offset(cursor, session_id)
+        records, end = read_records(log_dir, session_id, offset)
+        if len(records) > 0:
+            strings = load_strings(get_log_paths(log_dir, session_id)[1])
+            stats_table.insert_stats_rows(cursor, [
+                (r[0], session_id, r[6], strings[r[1]], r[2], strings[r[3]], strings[r[4]], r[7], strings[r[5]]) for r in records])
+            cursor.execute("INSERT OR REPLACE INTO hit_logs(session_id,compacted_bytes) VALUES(?,?)", (session_id, end))
+        connection.commit()
+    except:
+        connection.rollback()
+        stats_table.clear_cache()
+        raise
+    return len(records)
+
+
+def remove_log(log_dir, session_id):
+    '''
+    close and delete files of the session, call only when everything is compacted
+    '''
+    session_log = OPEN_LOGS.pop(session_id, None)
+    if session_log is not None:
+        session_log["log"].close()
+        session_log["strings_file"].close()
+    for path in get_log_paths(log_dir, session_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_uncompacted_probes(log_dir, session_id, offset):
+    '''
+    probes hit in the part of the log that is not in stats table yet
+    :return: set of (file id,line guid)
+    '''
+    log_path, strings_path = get_log_paths(log_dir, session_id)
+    count = (get_log_size(log_dir, session_id) - offset) // RECORD.size
+    if count <= 0:
+        return set()
+    if numpy is not None:
+        records = numpy.memmap(log_path, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(count,))
+        pairs = numpy.unique(numpy.stack([records["file_id"], records["line_guid"]], axis=1), axis=0).tolist()
+    else:
+        pairs = set((r[0], r[3]) for r in read_records(log_dir, session_id, offset)[0])
+    strings = load_strings(strings_path)
+    return set((file_id, strings[line_guid]) for file_id, line_guid in pairs)
@@ -0,0 +1,417 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+Dedicated listener for probe hits, running in its own process next to the Flask app,
+so rendering reports does not slow down ingest and the other way around.
+
+GET  /send_instrumentation_stats        - the same params as the Flask endpoint
+POST /send_instrumentation_stats_batch  - json list of hits, each one with the same params as above
+
+Requests are parsed as little as possible on the asyncio loop and hits are handed to a single writer
+thread that owns the db connection and saves them in batches, 1 transaction per batch, so the loop
+keeps accepting hits while a batch is being saved.
+
+With INGEST_WORKERS > 1 the service is pre-forked: N worker processes accept connections on
+one shared listening socket, parse and validate hits and forward compact records over a
+multiprocessing queue to 1 writer process, which is the only one touching the db.
+
+With HIT_LOG_ENABLED = 1 the writer appends hits to per-session hit logs (see hit_log.py) instead of
+inserting them to stats table and folds the logs into stats every HIT_LOG_COMPACT_INTERVAL_SECONDS.
+
+The writer keeps its own probe hit counts, tests executing probes and ingest counters (see probe_hits.py)
+and flushes them to db every PROBE_HITS_FLUSH_INTERVAL_SECONDS, when a session is over and when it's stopped.
+'''
+
+import asyncio
+import json
+import multiprocessing
+import queue
+import signal
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs
+
+import db
+import hit_log
+import probe_hits
+import stats_table
+
+
+MAX_BATCH_SIZE = 5000
+SESSIONS_REFRESH_SECONDS = 1  # how often config and live sessions are re-read; sessions are also re-read as soon as the Flask process changes them
+MAX_REQUEST_BODY_BYTES = 50 * 1024 * 1024
+FORWARD_INTERVAL_SECONDS = 0.05  # how often worker processes send buffered records to the writer process
+RECORDS_QUEUE = None  # queue between workers and writer in pre-fork mode, its depth is reported by /metrics
+SESSIONS_LOCK = threading.Lock()  # live sessions cache is read by the loop thread while the writer thread re-reads it
+
+# probe hit params kept in records passed to the writer, everything else is dropped after routing
+HIT_FIELDS = ("file", "line_guid_p", "related_code_line", "route", "inject_type", "send_date", "custom_value")
+
+RESPONSE_HEADERS = "Content-Type: text/plain\r\nAccess-Control-Allow-Origin: *\r\nAccess-Control-Allow-Headers: *\r\nAccess-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+STATUS_TEXT = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large"}
+
+
+def parse_query(query_string):
+    '''
+    query string -> dict with first value of each param, like request.args in Flask
+    '''
+    return {k: v[0] for k, v in parse_qs(query_string, keep_blank_values=True).items()}
+
+
+def to_record(session_id, received, data):
+    '''
+    probe hit params -> compact tuple for the writer: (session_id, receive time, values of HIT_FIELDS)
+    '''
+    return (session_id, received) + tuple(data.get(field) for field in HIT_FIELDS)
+
+
+def from_record(record):
+    '''
+    :return: (session id, receive time in unix epoch microseconds, probe hit params) - params are in the same form as request.args
+    '''
+    return record[0], record[1], {field: value for field, value in zip(HIT_FIELDS, record[2:]) if value is not None}
+
+
+def route_hit(submit, data):
+    '''
+    find live session for the hit, validate it and pass record to the writer
+    :param submit: callable taking record, see to_record
+    :return: response body, the same as the one returned by Flask endpoint
+    '''
+    with SESSIONS_LOCK:
+        active_session = probe_hits.route_request_to_session(data)
+    if active_session is None:
+        return "500"
+    if not data.get("file") or not data.get("line_guid_p"):
+        # would not be matched with any file anyway, do not bother the writer with it
+        return "invalid probe hit"
+    # hit is timestamped here, not by the writer, so it's attributed to the test that was running when it came
+    submit(to_record(active_session[0], time.time_ns() // 1000, data))
+    return "saved"
+
+
+def handle_request(submit, method, target, body):
+    '''
+    :return: status code and response body
+    '''
+    path, _, query = target.partition('?')
+    if method == "OPTIONS":
+        return 204, ""
+    if method == "GET" and path == "/send_instrumentation_stats":
+        return 200, route_hit(submit, parse_query(query))
+    if method == "POST" and path == "/send_instrumentation_stats_batch":
+        try:
+            hits = json.loads(body)
+        except ValueError:
+            return 400, "invalid json"
+        if not isinstance(hits, list):
+            return 400, "expected list of hits"
+        saved = 0
+        for hit in hits:
+            if isinstance(hit, dict) and route_hit(submit, {k: str(v) for k, v in hit.items()}) == "saved":
+                saved += 1
+        return 200, json.dumps({"received": len(hits), "saved": saved})
+    return 404, "not found"
+
+
+async def handle_connection(submit, reader, writer):
+    '''
+    minimal HTTP/1.1 server: request line, headers, optional body with Content-Length, keep-alive
+    '''
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = b""
+            content_length = int(headers.get("content-length", 0))
+            if content_length > MAX_REQUEST_BODY_BYTES:
+                status_code, response_body = 413, "too large"
+            else:
+                if content_length > 0:
+                    body = await reader.readexactly(content_length)
+                status_code, response_body = handle_request(submit, method, target, body)
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            response_bytes = response_body.encode("utf-8")
+            writer.write(("HTTP/1.1 %d %s\r\n%sContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+                status_code, STATUS_TEXT[status_code], RESPONSE_HEADERS, len(response_bytes),
+                "keep-alive" if keep_alive else "close")).encode("latin-1") + response_bytes)
+            await writer.drain()
+            if not keep_alive or status_code == 413:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def save_hits(connection, records):
+    '''
+    apply ingest policy to queued hits and save what's left in 1 transaction
+    :param records: list of records, see to_record
+    '''
+    route_rows = []
+    stats_rows = []
+    with SESSIONS_LOCK:
+        probe_hits.get_cached_active_test_sessions()
+        live_sessions = probe_hits.ACTIVE_SESSIONS["by_id"]
+    for record in records:
+        session_id, received, data = from_record(record)
+        active_session = live_sessions.get(session_id)
+        if active_session is None:
+            # session ended after the hit was routed
+            continue
+        route_row, stats_row = probe_hits.process_probe_hit(active_session, data, received)
+        if route_row is not None:
+            route_rows.append(route_row)
+        if stats_row is not None:
+            stats_rows.append(stats_row)
+
+    try:
+        if db.get_cached_config_value("HIT_LOG_ENABLED", "0") == "1":
+            hit_log.append_stats_rows(probe_hits.HIT_LOG_DIR, stats_rows)
+            stats_rows = []
+        with connection:
+            connection.executemany(probe_hits.INSERT_VISITED_ROUTE_SQL, route_rows)
+            stats_table.insert_stats_rows(connection.cursor(), stats_rows)
+            probe_hits.flush_ingest_counters(connection.cursor())
+            probe_hits.flush_session_last_hits(connection.cursor())
+    except:
+        stats_table.clear_cache()
+        probe_hits.forget_unsaved_hits([row[1] for row in route_rows] + [row[1] for row in stats_rows])
+        raise
+
+
+def compact_hit_logs(connection):
+    '''
+    fold open hit logs into stats table; logs of sessions that are over are removed once they are compacted
+    '''
+    with SESSIONS_LOCK:
+        live_sessions = probe_hits.ACTIVE_SESSIONS.get("by_id", {})
+    for session_id in list(hit_log.OPEN_LOGS.keys()):
+        hit_log.compact(connection, probe_hits.HIT_LOG_DIR, session_id)
+        if session_id not in live_sessions:
+            hit_log.remove_log(probe_hits.HIT_LOG_DIR, session_id)
+
+
+def refresh_sessions():
+    '''
+    sessions are started and ended by the Flask process; re-read them, save what's counted in memory
+    and forget state of the ones that are over
+    '''
+    with SESSIONS_LOCK:
+        db.get_config()
+        probe_hits.reset_active_test_session_cache()
+        probe_hits.get_cached_active_test_sessions()
+        ended_sessions = [session_id for session_id in probe_hits.SEEN_PROBES.keys() if session_id not in probe_hits.ACTIVE_SESSIONS["by_id"]]
+    if len(ended_sessions) > 0:
+        probe_hits.flush_pending_rows()
+    for session_id in ended_sessions:
+        probe_hits.forget_seen_probes(session_id)
+
+
+def open_writer_connection():
+    connection = sqlite3.connect(db.CONNECTION_STRING, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")  # readers (reports) do not block the writer
+    return connection
+
+
+def save_and_maintain(connection, records, last_runs):
+    '''
+    save batch of records and, when it's time, flush probe hit counts and re-read live sessions
+    :param last_runs: dict with monotonic time of last "flush", "compact" and "refresh", updated in place
+    '''
+    try:
+        if len(records) > 0:
+            save_hits(connection, records)
+        now = time.monotonic()
+        if now - last_runs["flush"] > float(db.get_cached_config_value("PROBE_HITS_FLUSH_INTERVAL_SECONDS", "10")):
+            probe_hits.flush_pending_rows()
+            last_runs["flush"] = now
+        if now - last_runs["compact"] > float(db.get_cached_config_value("HIT_LOG_COMPACT_INTERVAL_SECONDS", "5")):
+            compact_hit_logs(connection)
+            last_runs["compact"] = now
+        if now - last_runs["refresh"] > SESSIONS_REFRESH_SECONDS:
+            refresh_sessions()
+            last_runs["refresh"] = now
+    except Exception as e:
+        print(e)
+
+
+def write_records(records_queue):
+    '''
+    the only code writing hits to db - takes everything that is queued and saves it as 1 batch.
+    Runs in the writer process in pre-fork mode, otherwise in the writer thread of the ingest process
+    :param records_queue: queue of lists of records, None stops the writer after everything before it is saved
+    '''
+    connection = open_writer_connection()
+    last_runs = {"flush": time.monotonic(), "compact": time.monotonic(), "refresh": time.monotonic()}
+    stopping = False
+    while not stopping:
+        try:
+            records = records_queue.get(timeout=SESSIONS_REFRESH_SECONDS)
+        except queue.Empty:
+            records = []
+        if records is None:
+            records = []
+            stopping = True
+        while not stopping and len(records) < MAX_BATCH_SIZE:
+            try:
+                more_records = records_queue.get_nowait()
+            except queue.Empty:
+                break
+            if more_records is None:
+                stopping = True
+            else:
+                records.extend(more_records)
+        save_and_maintain(connection, records, last_runs)
+    connection.close()
+
+
+async def serve(host, port, records_queue):
+    listener = await asyncio.start_server(
+        lambda reader, writer: handle_connection(lambda record: records_queue.put([record]), reader, writer), host, port)
+    print("ingest service listening on " + host + ":" + str(port))
+    async with listener:
+        await listener.serve_forever()
+
+
+def stop_on_sigterm():
+    '''
+    the Flask process terminates ingest processes when it exits, turn SIGTERM into SystemExit so finally blocks run
+    '''
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+
+def run(host, port, session_changes):
+    '''
+    process entry point, see Instrument_server.start_ingest_service
+    :param session_changes: probe_hits.SESSION_CHANGES of the Flask process
+    '''
+    probe_hits.SESSION_CHANGES = session_changes
+    db.get_config()
+    stop_on_sigterm()
+    records_queue = queue.Queue()
+    writer = threading.Thread(target=write_records, args=(records_queue,), name="ingest writer")
+    writer.start()
+    try:
+        asyncio.run(serve(host, int(port), records_queue))
+    finally:
+        records_queue.put(None)
+        writer.join()
+        probe_hits.flush_pending_rows()
+
+
+async def forward_records(buffer, records_queue):
+    '''
+    worker process: send buffered records to the writer process in chunks and keep live sessions fresh
+    '''
+    last_refresh = time.monotonic()
+    while True:
+        await asyncio.sleep(FORWARD_INTERVAL_SECONDS)
+        if len(buffer) > 0:
+            records_queue.put(buffer[:])
+            del buffer[:]
+        if time.monotonic() - last_refresh > SESSIONS_REFRESH_SECONDS:
+            db.get_config()
+            probe_hits.reset_active_test_session_cache()
+            last_refresh = time.monotonic()
+
+
+async def serve_worker(listen_socket, records_queue):
+    buffer = []
+    forward_task = asyncio.ensure_future(forward_records(buffer, records_queue))
+    listener = await asyncio.start_server(
+        lambda reader, writer: handle_connection(buffer.append, reader, writer), sock=listen_socket)
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), forward_task)
+
+
+def run_worker(listen_socket, records_queue, session_changes):
+    '''
+    worker process entry point - accepts connections on the shared socket, nothing is written to db here
+    :param session_changes: probe_hits.SESSION_CHANGES of the Flask process
+    '''
+    probe_hits.SESSION_CHANGES = session_changes
+    db.get_config()
+    asyncio.run(serve_worker(listen_socket, records_queue))
+
+
+def run_writer(records_queue, session_changes):
+    '''
+    writer process entry point - the only process saving hits from the workers
+    :param session_changes: probe_hits.SESSION_CHANGES of the Flask process
+    '''
+    probe_hits.SESSION_CHANGES = session_changes
+    db.get_config()
+    stop_on_sigterm()
+    try:
+        write_records(records_queue)
+    finally:
+        probe_hits.flush_pending_rows()
+
+
+def start_workers(host, port, workers_count, session_changes):
+    '''
+    pre-fork mode: bind listening socket once and share it with workers_count worker processes,
+    which forward hits to 1 writer process
+    :return: list of started processes
+    '''
+    listen_socket = socket.create_server((host, int(port)), backlog=1024)
+    global RECORDS_QUEUE
+    records_queue = RECORDS_QUEUE = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_writer, args=(records_queue, session_changes), daemon=True)]
+    for _ in range(workers_count):
+        processes.append(multiprocessing.Process(target=run_worker, args=(listen_socket, records_queue, session_changes), daemon=True))
+    for process in processes:
+        process.start()
+    listen_socket.close()  # workers have their own copies
+    print("ingest service listening on " + host + ":" + str(port) + " with " + str(workers_count) + " workers")
+    return processes
@@ -0,0 +1,185 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Memory accounting of the server process, used by /admin/memory endpoints and /metrics.
+
+Every request and background job records how much resident memory (RSS) changed and how much it pushed
+the peak RSS of the process up, per route / job name. When tracemalloc is tracing (started by taking
+the first snapshot), allocated bytes left after the request or job are recorded too. Snapshots are grouped
+by source line and can be diffed to see which lines hold memory allocated in between.
+'''
+
+import contextlib
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+MEMORY_STATS = {}  # (kind,name) -> totals of requests of the route / runs of the job, see finish
+SNAPSHOTS = {}  # snapshot id -> (date,tracemalloc snapshot)
+MAX_SNAPSHOTS = 10
+SNAPSHOT_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                    tracemalloc.Filter(False, "<unknown>")]
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def get_rss():
+    '''
+    :return: current resident memory of the process in bytes, None where /proc is not available
+    '''
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def get_peak_rss():
+    '''
+    :return: peak resident memory of the process in bytes, None on windows
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on linux
+
+
+def start():
+    '''
+    :return: state at the start of the request or job, for finish
+    '''
+    return get_rss(), get_peak_rss(), tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+
+def finish(kind, name, started):
+    '''
+    add memory used by the request or job to MEMORY_STATS
+    :param kind: request or job
+    :param name: url rule of the request or name of the job
+    :param started: result of start()
+    '''
+    rss_before, peak_before, allocated_before = started
+    rss, peak, allocated = start()
+    totals = MEMORY_STATS.get((kind, name))
+    if totals is None:
+        totals = MEMORY_STATS[(kind, name)] = {"kind": kind, "name": name, "count": 0, "rss_delta_max": 0, "rss_delta_total": 0,
+                                               "peak_rss_growth_max": 0, "peak_rss_growth_total": 0, "allocated_delta_max": None}
+    totals["count"] += 1
+    if rss is not None and rss_before is not None:
+        totals["rss_delta_max"] = max(totals["rss_delta_max"], rss - rss_before)
+        totals["rss_delta_total"] += rss - rss_before
+    if peak is not None and peak_before is not None:
+        totals["peak_rss_growth_max"] = max(totals["peak_rss_growth_max"], peak - peak_before)
+        totals["peak_rss_growth_total"] += peak - peak_before
+    if allocated is not None and allocated_before is not None:
+        totals["allocated_delta_max"] = max(totals["allocated_delta_max"] or 0, allocated - allocated_before)
+
+
+@contextlib.contextmanager
+def track(kind, name):
+    started = start()
+    try:
+        yield
+    finally:
+        finish(kind, name, started)
+
+
+def get_stats():
+    '''
+    :return: process memory and per request/job totals, the ones growing peak RSS the most first
+    '''
+    traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+    stats = sorted(MEMORY_STATS.values(), key=lambda totals: (totals["peak_rss_growth_total"], totals["rss_delta_max"]), reverse=True)
+    return {"rss": get_rss(), "peak_rss": get_peak_rss(), "tracemalloc": tracemalloc.is_tracing(),
+            "traced_current": traced[0] if traced else None, "traced_peak": traced[1] if traced else None,
+            "snapshots": [{"id": snapshot_id, "date": date} for snapshot_id, (date, snapshot) in sorted(SNAPSHOTS.items())],
+            "stats": stats}
+
+
+def format_statistics(statistics, top, diff=False):
+    lines = []
+    for statistic in statistics[:top]:
+        frame = statistic.traceback[0]
+        line = {"file": frame.filename, "line": frame.lineno, "size": statistic.size, "count": statistic.count}
+        if diff:
+            line.update(size_diff=statistic.size_diff, count_diff=statistic.count_diff)
+        lines.append(line)
+    return lines
+
+
+def take_snapshot(frames=1, top=30):
+    '''
+    take tracemalloc snapshot, starts tracing with given number of frames if it's not tracing yet
+    (the first snapshot then contains only what was allocated since this moment)
+    :return: snapshot id and top source lines by allocated size
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+    snapshot_id = max(SNAPSHOTS.keys(), default=0) + 1
+    SNAPSHOTS[snapshot_id] = (time.strftime("%Y-%m-%d %H:%M:%S"), snapshot)
+    while len(SNAPSHOTS) > MAX_SNAPSHOTS:
+        del SNAPSHOTS[min(SNAPSHOTS.keys())]
+    return {"id": snapshot_id, "total_size": sum(trace.size for trace in snapshot.traces),
+            "top": format_statistics(snapshot.statistics("lineno"), top)}
+
+
+def diff_snapshots(from_id, to_id=None, top=30):
+    '''
+    :param to_id: None = compare with new snapshot taken now
+    :return: source lines sorted by growth of allocated size between the snapshots, None if a snapshot is missing
+    '''
+    if from_id not in SNAPSHOTS:
+        return None
+    from_snapshot = SNAPSHOTS[from_id][1]  # taking new snapshot may drop the oldest one
+    if to_id is None:
+        to_id = take_snapshot(top=0)["id"]
+    elif to_id not in SNAPSHOTS:
+        return None
+    statistics = SNAPSHOTS[to_id][1].compare_to(from_snapshot, "lineno")
+    return {"from": from_id, "to": to_id, "size_diff": sum(statistic.size_diff for statistic in statistics),
+            "top": format_statistics(statistics, top, diff=True)}
+
+
+def stop_tracing():
+    SNAPSHOTS.clear()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
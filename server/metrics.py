@@ -0,0 +1,150 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+In-process metrics of the server exposed in Prometheus text format by /metrics endpoint:
+request counts, latency and sql statements histograms per route, requests in flight and stats rows written.
+Recording a request is a few dict updates, so metrics are always on.
+'''
+
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+SQL_STATEMENTS_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+REQUESTS = {}  # (route,method,status) -> requests count
+LATENCY = {}  # route -> histogram of request duration, see observe
+SQL_STATEMENTS = {}  # route -> histogram of sql statements executed by 1 request
+COUNTERS = {"in_flight": 0, "sql_statements": 0, "stats_rows_written": 0}
+LOCK = threading.Lock()
+
+
+def observe(histograms, key, buckets, value):
+    '''
+    add value to histogram; histogram is [count per bucket (last one is +Inf), sum, count]
+    '''
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+    histogram[0][bisect.bisect_left(buckets, value)] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+
+def request_started():
+    with LOCK:
+        COUNTERS["in_flight"] += 1
+
+
+def request_finished(route, method, status_code, duration, sql_statements):
+    '''
+    :param route: url rule of the view (not the path, so labels do not grow with ids in urls)
+    :param duration: seconds, until the last byte of streamed responses
+    '''
+    with LOCK:
+        COUNTERS["in_flight"] -= 1
+        key = (route, method, str(status_code))
+        REQUESTS[key] = REQUESTS.get(key, 0) + 1
+        observe(LATENCY, route, LATENCY_BUCKETS, duration)
+        observe(SQL_STATEMENTS, route, SQL_STATEMENTS_BUCKETS, sql_statements)
+
+
+def count(counter, value=1):
+    with LOCK:
+        COUNTERS[counter] += value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(k + "=\"" + v + "\"" for k, v in zip(labels.keys(), escaped)) + "}"
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render_histograms(lines, name, histograms, buckets):
+    for route, (bucket_counts, total, count_value) in sorted(histograms.items()):
+        cumulative = 0
+        for le, bucket_count in zip(list(buckets) + ["+Inf"], bucket_counts):
+            cumulative += bucket_count
+            lines.append(name + "_bucket" + format_labels({"route": route, "le": le}) + " " + str(cumulative))
+        lines.append(name + "_sum" + format_labels({"route": route}) + " " + format_number(total))
+        lines.append(name + "_count" + format_labels({"route": route}) + " " + str(count_value))
+
+
+def render(gauges=None):
+    '''
+    :param gauges: list of (name, help, value) sampled by the caller at scrape time, value can be
+    a number or dict of labels dict (as tuple of pairs) -> number; gauges with None value are skipped
+    :return: metrics in Prometheus text exposition format
+    '''
+    lines = []
+    with LOCK:
+        lines.append("# HELP lava_http_requests_total Requests handled by the server.")
+        lines.append("# TYPE lava_http_requests_total counter")
+        for (route, method, status_code), value in sorted(REQUESTS.items()):
+            lines.append("lava_http_requests_total" + format_labels({"route": route, "method": method, "status": status_code}) + " " + str(value))
+        lines.append("# HELP lava_http_request_duration_seconds Request duration, until the last byte of streamed responses.")
+        lines.append("# TYPE lava_http_request_duration_seconds histogram")
+        render_histograms(lines, "lava_http_request_duration_seconds", LATENCY, LATENCY_BUCKETS)
+        lines.append("# HELP lava_http_request_sql_statements Sql statements executed by 1 request.")
+        lines.append("# TYPE lava_http_request_sql_statements histogram")
+        render_histograms(lines, "lava_http_request_sql_statements", SQL_STATEMENTS, SQL_STATEMENTS_BUCKETS)
+        lines.append("# HELP lava_http_requests_in_flight Requests being handled right now.")
+        lines.append("# TYPE lava_http_requests_in_flight gauge")
+        lines.append("lava_http_requests_in_flight " + str(COUNTERS["in_flight"]))
+        lines.append("# HELP lava_sql_statements_total Sql statements executed by the server process.")
+        lines.append("# TYPE lava_sql_statements_total counter")
+        lines.append("lava_sql_statements_total " + str(COUNTERS["sql_statements"]))
+        lines.append("# HELP lava_stats_rows_written_total Rows written to stats table by the server process (rate() gives rows per second).")
+        lines.append("# TYPE lava_stats_rows_written_total counter")
+        lines.append("lava_stats_rows_written_total " + str(COUNTERS["stats_rows_written"]))
+    for name, help_text, value in gauges or []:
+        if value is None:
+            continue
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " gauge")
+        if isinstance(value, dict):
+            for labels, labeled_value in sorted(value.items()):
+                lines.append(name + format_labels(dict(labels)) + " " + format_number(labeled_value))
+        else:
+            lines.append(name + " " + format_number(value))
+    return "\n".join(lines) + "\n"
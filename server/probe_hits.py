@@ -0,0 +1,507 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+
+Processing of probe hits shared by the Flask process (Instrument_server.py) and the ingest service (ingest_service.py):
+routing hits to live sessions, ingest policy, seen probes, hit counts and tests executing the probes.
+
+Each process keeps its own in-memory state and flushes it to db itself (flush_pending_rows):
+the Flask process periodically, ingest service periodically, when a session it holds state for is over and when it exits.
+'''
+
+import datetime
+import multiprocessing
+import random
+import sqlite3
+import time
+
+import stats_table
+from db import CONNECTION_STRING, execute_query, execute_select, get_cached_config_value
+
+
+HIT_LOG_DIR = 'hit_logs'  # append-only hit logs of live sessions written by ingest service, see hit_log.py
+ACTIVE_SESSIONS = {}  # cached rows of live test sessions, see get_cached_active_test_sessions
+SEEN_PROBES = {}  # session id -> {(filename,line_guid): [file_id,stored hits count]} of probes already saved to stats
+SEEN_ROUTES = {}  # session id -> set of routes already saved to visited_routes
+PROBE_HIT_COUNTS = {}  # (session id,file id,line_guid,line) -> hits not flushed to probe_hits table yet
+SEEN_TEST_PROBES = {}  # session id -> set of (test id,file id,line_guid) already attributed to the test
+PENDING_TEST_PROBES = []  # rows for test_probes table not flushed yet
+INGEST_TOKEN_BUCKETS = {}  # session id -> [tokens left,last refill time] for 'rate_limit' ingest policy
+INGEST_COUNTERS = {"received": 0, "first_hits": 0, "repeats_stored": 0, "dropped": {}}  # since last flush, dropped: policy -> hits count
+SESSION_TESTS = {}  # "changes" - SESSION_CHANGES when loaded, "by_session" - session id -> tests run in it, see get_session_tests
+SESSION_CHANGES = multiprocessing.RawValue("q", 0)  # shared with ingest service, incremented when a session or a test in it starts or ends
+SESSION_LAST_HITS = {}  # session id -> receive time (epoch microseconds) of its last hit not flushed to session_last_hits table yet
+INGEST_POLICIES = ["first_hit", "all", "first_n", "rate_limit", "sample"]
+INSERT_VISITED_ROUTE_SQL = "INSERT INTO visited_routes(route_visited,session_id) VALUES(?,?)"
+COVERAGE_SUBSCRIBERS = {}  # session id -> list of queues of clients connected to /coverage_stream (Flask process only)
+NEW_COVERED_PROBES = {}  # session id -> probes first hit since last coverage push, only for sessions with subscribers
+
+
+def get_file_id_by_filename(file_name, active_only=False):
+    sql = ""
+    if active_only:
+        sql = "SELECT ID,is_history FROM files WHERE name=:fn AND is_history=0"
+    else:
+        sql = "SELECT ID,is_history FROM files WHERE name=:fn"
+    param = {"fn": file_name}
+    row = execute_select(sql, param, fetchall=False)
+    if row is not None:
+        return row[0], row[1]
+    else:
+        return None, True
+
+
+def get_session_build(session_id):
+    sql = "SELECT build FROM builds INNER JOIN sessions_builds ON builds.ID=sessions_builds.build_id WHERE sessions_builds.session_id=:sid"
+    param = {"sid": session_id}
+    results = execute_select(sql, param, fetchall=True)
+    if len(results)>0:
+        return results[0][0]
+    else:
+        return ""
+
+
+def get_active_test_session():
+    """
+    connect to db and get active test session if any
+    :return: active session ID or -1 if no active session
+    """
+    result = None
+    sql = "SELECT * FROM sessions WHERE is_over=0"
+    result = execute_select(sql, None, fetchall=False)
+    return result
+
+
+def get_active_test_sessions():
+    '''
+    all live test sessions, oldest first
+    '''
+    sql = "SELECT * FROM sessions WHERE is_over=0 ORDER BY ID"
+    return execute_select(sql, None, fetchall=True)
+
+
+def get_cached_active_test_sessions():
+    '''
+    the same as get_active_test_sessions but rows are kept in memory until
+    session is started, stopped or removed in any process (see count_session_change), so probe hits do not query sessions table
+    '''
+    changes = SESSION_CHANGES.value
+    if ACTIVE_SESSIONS.get("changes") != changes:
+        ACTIVE_SESSIONS.clear()
+        ACTIVE_SESSIONS["changes"] = changes
+    if "rows" not in ACTIVE_SESSIONS:
+        rows = get_active_test_sessions()
+        ACTIVE_SESSIONS["rows"] = rows
+        ACTIVE_SESSIONS["by_id"] = {r[0]: r for r in rows}
+        ACTIVE_SESSIONS["by_key"] = {r[9]: r for r in rows}
+        ACTIVE_SESSIONS["by_build"] = {}
+        for r in rows:
+            ACTIVE_SESSIONS["by_build"].setdefault(str(get_session_build(r[0])), r)
+    return ACTIVE_SESSIONS["rows"]
+
+
+def route_request_to_session(data):
+    '''
+    find live session the request (probe hit or session command) belongs to:
+    session_key param - session started with that routing key,
+    session_id param - that session if it's live,
+    build param - session of that build number,
+    otherwise session started without routing key
+    :param data: request args
+    :return: session row or None
+    '''
+    get_cached_active_test_sessions()
+    if data.get("session_key"):
+        return ACTIVE_SESSIONS["by_key"].get(data["session_key"])
+    if data.get("session_id"):
+        try:
+            return ACTIVE_SESSIONS["by_id"].get(int(data["session_id"]))
+        except ValueError:
+            return None
+    if data.get("build") and data["build"] in ACTIVE_SESSIONS["by_build"]:
+        return ACTIVE_SESSIONS["by_build"][data["build"]]
+    return ACTIVE_SESSIONS["by_key"].get(None)
+
+
+def reset_active_test_session_cache():
+    ACTIVE_SESSIONS.clear()
+
+
+def get_seen_probes_for_session(session_id):
+    '''
+    return probes and routes already saved for the session.
+    On first use (eg. after server restart in the middle of a session) they are loaded from db.
+    :return: dict (filename,line_guid)->[file_id,stored hits] and set of routes
+    '''
+    if session_id not in SEEN_PROBES:
+        sql = "SELECT filename,line_guid,file_id,COUNT(*) FROM stats_rows WHERE session_id=:sid GROUP BY file_id,probe_id"
+        param = {"sid": session_id}
+        SEEN_PROBES[session_id] = {(r[0], r[1]): [r[2], r[3]] for r in execute_select(sql, param, fetchall=True)}
+
+        sql = "SELECT DISTINCT route_visited FROM visited_routes WHERE session_id=:sid"
+        SEEN_ROUTES[session_id] = set(r[0] for r in execute_select(sql, param, fetchall=True))
+    return SEEN_PROBES[session_id], SEEN_ROUTES[session_id]
+
+
+def forget_seen_probes(session_id):
+    '''
+    drop in-memory state of session that is not live anymore
+    '''
+    SEEN_PROBES.pop(session_id, None)
+    SEEN_ROUTES.pop(session_id, None)
+    SEEN_TEST_PROBES.pop(session_id, None)
+    INGEST_TOKEN_BUCKETS.pop(session_id, None)
+    SESSION_LAST_HITS.pop(session_id, None)
+    SESSION_TESTS.get("by_session", {}).pop(session_id, None)
+
+
+def get_ingest_policy():
+    '''
+    what to do with repeated hits of the probe that was already hit in the session:
+    first_hit - drop all repeats (default)
+    all - store every hit
+    first_n - store first INGEST_FIRST_N hits of each probe
+    rate_limit - store repeats as long as session does not exceed INGEST_RATE_LIMIT_PER_SECOND (token bucket with INGEST_RATE_LIMIT_BURST size)
+    sample - store INGEST_SAMPLE_PERCENT % of repeats
+    '''
+    ingest_policy = get_cached_config_value("INGEST_POLICY", "first_hit")
+    if ingest_policy not in INGEST_POLICIES:
+        return "first_hit"
+    return ingest_policy
+
+
+def should_store_repeated_hit(ingest_policy, session_id, seen_probe):
+    '''
+    :param seen_probe: [file_id,stored hits count] of the probe
+    :return: True if repeated hit should be saved to stats
+    '''
+    try:
+        if ingest_policy == "all":
+            return True
+        elif ingest_policy == "first_n":
+            return seen_probe[1] < int(get_cached_config_value("INGEST_FIRST_N", "10"))
+        elif ingest_policy == "rate_limit":
+            rate = float(get_cached_config_value("INGEST_RATE_LIMIT_PER_SECOND", "50"))
+            burst = float(get_cached_config_value("INGEST_RATE_LIMIT_BURST", "100"))
+            now = time.monotonic()
+            bucket = INGEST_TOKEN_BUCKETS.setdefault(session_id, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            return False
+        elif ingest_policy == "sample":
+            return random.random() * 100 < float(get_cached_config_value("INGEST_SAMPLE_PERCENT", "1"))
+    except ValueError:
+        print("invalid value of config entry for ingest policy: " + ingest_policy)
+    return False
+
+
+def count_probe_hit(session_id, file_id, data):
+    '''
+    if COUNT_PROBE_HITS is on, count probe execution in memory;
+    counts are added to probe_hits table by flush_probe_hit_counts
+    '''
+    if get_cached_config_value("COUNT_PROBE_HITS", "0") != "1":
+        return
+    try:
+        key = (session_id, file_id, data["line_guid_p"], int(data["related_code_line"]))
+    except:
+        return
+    PROBE_HIT_COUNTS[key] = PROBE_HIT_COUNTS.get(key, 0) + 1
+
+
+def flush_probe_hit_counts():
+    '''
+    add hits counted in memory to probe_hits table, in one transaction
+    '''
+    if len(PROBE_HIT_COUNTS) == 0:
+        return
+    counts = dict(PROBE_HIT_COUNTS)
+    PROBE_HIT_COUNTS.clear()
+
+    conn = sqlite3.connect(CONNECTION_STRING)
+    c = conn.cursor()
+    for (session_id, file_id, line_guid, line), hits in counts.items():
+        params = {"sid": session_id, "fid": file_id, "g": line_guid, "l": line, "h": hits}
+        c.execute("UPDATE probe_hits SET hits=hits+:h WHERE session_id=:sid AND file_id=:fid AND line_guid=:g", params)
+        if c.rowcount == 0:
+            c.execute("INSERT INTO probe_hits(session_id,file_id,line_guid,line,hits) VALUES(:sid,:fid,:g,:l,:h)", params)
+    conn.commit()
+    conn.close()
+
+
+def get_session_tests(session_id):
+    '''
+    tests run in the session, kept in memory until a session or test is started or ended in any process (see count_session_change)
+    :return: list of (start time,end time or None,test id), latest first, times in unix epoch microseconds
+    '''
+    changes = SESSION_CHANGES.value
+    if SESSION_TESTS.get("changes") != changes:
+        SESSION_TESTS["changes"] = changes
+        SESSION_TESTS["by_session"] = {}
+    if session_id not in SESSION_TESTS["by_session"]:
+        sql = "SELECT start_time,end_time,test_id FROM session_tests WHERE session_id=:sid ORDER BY start_time DESC,ID DESC"
+        SESSION_TESTS["by_session"][session_id] = execute_select(sql, {"sid": session_id}, fetchall=True)
+    return SESSION_TESTS["by_session"][session_id]
+
+
+def count_session_change():
+    '''
+    called after a session or a test in it is started, ended or removed,
+    so all processes re-read live sessions and their tests before routing next hit
+    '''
+    SESSION_CHANGES.value += 1
+
+
+def get_test_for_hit(session_id, received):
+    '''
+    :param received: when the hit was received, unix epoch microseconds
+    :return: id of the test that was running in the session at that time or None
+    '''
+    for start_time, end_time, test_id in get_session_tests(session_id):
+        if start_time <= received:
+            if end_time is None or received < end_time:
+                return test_id
+            return None
+    return None
+
+
+def attribute_probe_to_test(session_id, file_id, data, received):
+    '''
+    remember that the test running in the session when the hit was received executed the probe,
+    saved to test_probes by flush_test_probes. Every probe is queued once per test, regardless of ingest policy.
+    '''
+    test_id = get_test_for_hit(session_id, received)
+    if test_id is None:
+        return
+    seen = SEEN_TEST_PROBES.setdefault(session_id, set())
+    key = (test_id, file_id, data.get("line_guid_p"))
+    if key not in seen:
+        seen.add(key)
+        PENDING_TEST_PROBES.append((test_id, session_id, file_id, data.get("line_guid_p"), data.get("related_code_line")))
+
+
+def flush_test_probes():
+    '''
+    save probes attributed to tests in one transaction
+    '''
+    if len(PENDING_TEST_PROBES) == 0:
+        return
+    rows = PENDING_TEST_PROBES[:]
+    del PENDING_TEST_PROBES[:]
+    conn = sqlite3.connect(CONNECTION_STRING)
+    conn.executemany("INSERT OR IGNORE INTO test_probes(test_id,session_id,file_id,line_guid,line) VALUES(?,?,?,?,?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def flush_ingest_counters(cursor):
+    '''
+    add probe hits counted by this process since last flush to ingest_counters table, caller commits.
+    Both Flask process and ingest service count hits they process, /get_ingest_stats reads the sum.
+    '''
+    rows = [(name, INGEST_COUNTERS[name]) for name in ("received", "first_hits", "repeats_stored") if INGEST_COUNTERS[name] > 0]
+    rows += [("dropped_" + policy, hits) for policy, hits in INGEST_COUNTERS["dropped"].items()]
+    INGEST_COUNTERS.update({"received": 0, "first_hits": 0, "repeats_stored": 0, "dropped": {}})
+    for name, value in rows:
+        cursor.execute("UPDATE ingest_counters SET value=value+? WHERE name=?", (value, name))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO ingest_counters(name,value) VALUES(?,?)", (name, value))
+
+
+def flush_session_last_hits(cursor):
+    '''
+    save time of last hit of sessions that received hits since last flush to session_last_hits table, caller commits
+    '''
+    last_hits = list(SESSION_LAST_HITS.items())
+    SESSION_LAST_HITS.clear()
+    for session_id, last_hit in last_hits:
+        cursor.execute("UPDATE session_last_hits SET last_hit=MAX(last_hit,?) WHERE session_id=?", (last_hit, session_id))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO session_last_hits(session_id,last_hit) VALUES(?,?)", (session_id, last_hit))
+
+
+def get_ingest_counters():
+    '''
+    probe hits received, stored and dropped by ingest policy by all processes since server start
+    :return: dict with received, first_hits, repeats_stored and dropped (policy -> hits count)
+    '''
+    connection = sqlite3.connect(CONNECTION_STRING)
+    try:
+        flush_ingest_counters(connection.cursor())
+        connection.commit()
+        counters = {"received": 0, "first_hits": 0, "repeats_stored": 0, "dropped": {}}
+        for name, value in connection.execute("SELECT name,value FROM ingest_counters").fetchall():
+            if name.startswith("dropped_"):
+                counters["dropped"][name[len("dropped_"):]] = value
+            else:
+                counters[name] = value
+    finally:
+        connection.close()
+    return counters
+
+
+def reset_ingest_counters():
+    INGEST_COUNTERS.update({"received": 0, "first_hits": 0, "repeats_stored": 0, "dropped": {}})
+    execute_query("DELETE FROM ingest_counters")
+
+
+def flush_pending_rows():
+    '''
+    save everything this process keeps in memory: probe hit counts, probes attributed to tests, ingest counters
+    and time of last hit of sessions
+    '''
+    flush_probe_hit_counts()
+    flush_test_probes()
+    connection = sqlite3.connect(CONNECTION_STRING)
+    try:
+        flush_ingest_counters(connection.cursor())
+        flush_session_last_hits(connection.cursor())
+        connection.commit()
+    finally:
+        connection.close()
+
+
+
+def parse_send_date(send_date):
+    '''
+    :param send_date: send_date param of probe hit - unix epoch microseconds, older helpers send local time as '%Y-%m-%d %H:%M:%S:%f'
+    :return: unix epoch microseconds
+    '''
+    if send_date.isdigit():
+        return int(send_date)
+    return round(datetime.datetime.strptime(send_date, '%Y-%m-%d %H:%M:%S:%f').timestamp() * 1000000)
+
+
+def process_probe_hit(active_session, data, received=None):
+    '''
+    apply ingest policy to the probe hit and update in-memory state of the session (seen probes, hit counts, live coverage,
+    time of last hit). Does not write to db, so the caller can save rows right away or in batches.
+    send_date and custom_value of the hit are kept only if the hit is stored, repeats dropped by ingest policy are just counted.
+    :param active_session: row of the live session the hit was routed to
+    :param data: probe hit params
+    :param received: when the hit was received, unix epoch microseconds; now if not given
+    :return: (route_visited,session_id) row for visited_routes and row for stats (see stats_table.insert_stats_rows); None if nothing to save
+    '''
+    route_row = None
+    stats_row = None
+    ingest_policy = get_ingest_policy()
+    seen_probes, seen_routes = get_seen_probes_for_session(active_session[0])
+    if received is None:
+        received = time.time_ns() // 1000
+    INGEST_COUNTERS["received"] += 1
+    SESSION_LAST_HITS[active_session[0]] = received
+
+    try:
+        if ingest_policy == "all" or data["route"] not in seen_routes:
+            route_row = (data["route"], active_session[0])
+            seen_routes.add(data["route"])
+    except:
+        print("route not present in stats. Skipping saving route.")
+
+    file_id = None
+    probe = (data.get("file"), data.get("line_guid_p"))
+    if probe in seen_probes:
+        # probe was already hit in this session, coverage does not change so
+        # ingest policy decides if this hit is stored at all
+        seen_probe = seen_probes[probe]
+        count_probe_hit(active_session[0], seen_probe[0], data)
+        attribute_probe_to_test(active_session[0], seen_probe[0], data, received)
+        if not should_store_repeated_hit(ingest_policy, active_session[0], seen_probe):
+            INGEST_COUNTERS["dropped"][ingest_policy] = INGEST_COUNTERS["dropped"].get(ingest_policy, 0) + 1
+            return route_row, None
+        file_id = seen_probe[0]
+        seen_probe[1] += 1
+        INGEST_COUNTERS["repeats_stored"] += 1
+    else:
+        # first hit is always stored
+        file_id = get_file_id_by_filename(data.get("file"), True)[0]
+        if file_id is not None:
+            seen_probes[probe] = [file_id, 1]
+            count_probe_hit(active_session[0], file_id, data)
+            attribute_probe_to_test(active_session[0], file_id, data, received)
+            INGEST_COUNTERS["first_hits"] += 1
+            if active_session[0] in COVERAGE_SUBSCRIBERS:
+                NEW_COVERED_PROBES.setdefault(active_session[0], []).append(
+                    {"file_id": file_id, "line_guid": data["line_guid_p"], "line": data.get("related_code_line")})
+
+    if file_id is not None:
+        try:
+            stats_row = (file_id, active_session[0], received, data["file"],
+                int(data["related_code_line"]), data["line_guid_p"], data["inject_type"], parse_send_date(data["send_date"]), data["custom_value"])
+        except Exception as e:
+            print(e)
+            # hit is not stored, if it was the first one the next hit of the probe is stored as first hit
+            seen_probe = seen_probes[probe]
+            seen_probe[1] -= 1
+            if seen_probe[1] == 0:
+                del seen_probes[probe]
+    return route_row, stats_row
+
+
+def forget_unsaved_hits(session_ids):
+    '''
+    rows returned by process_probe_hit for the sessions were not saved: drop their seen probes and routes,
+    they are re-read from db on next hit, so probes and routes whose first hit was lost are stored again
+    '''
+    for session_id in set(session_ids):
+        SEEN_PROBES.pop(session_id, None)
+        SEEN_ROUTES.pop(session_id, None)
+
+
+def save_stats_rows(stats_rows):
+    '''
+    save rows returned by process_probe_hit to stats table
+    '''
+    connection = sqlite3.connect(CONNECTION_STRING)
+    try:
+        stats_table.insert_stats_rows(connection.cursor(), stats_rows)
+        connection.commit()
+    except:
+        connection.rollback()
+        stats_table.clear_cache()
+        raise
+    finally:
+        connection.close()
+
+
+def save_visited_route(url, session_id):
+    '''
+    save visited url
+    '''
+    execute_query(INSERT_VISITED_ROUTE_SQL, (url, session_id))
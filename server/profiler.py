@@ -0,0 +1,191 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+On-demand profiling of the running server, used by /admin/profile.
+
+sampling - a background thread takes stack of the main thread (the one running all greenlets) every interval,
+           overhead is a stack walk per sample, so it can be used in production
+cprofile - requests matching given route are profiled with cProfile (deterministic, slower while they run),
+           stacks are sampled only while such request is in progress
+
+Result has flamegraph-compatible collapsed stacks ("outer;inner count" lines, e.g. for flamegraph.pl or speedscope)
+and a table of top functions. Greenlets switch on the same thread, so a request profiled with cProfile includes
+work of greenlets that ran while it was waiting.
+'''
+
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+PROFILE = {"running": False}  # state of the current profiling, see start
+LOCK = threading.Lock()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")"
+
+
+def is_idle(frame):
+    '''
+    main thread waiting in gevent hub for io or timers
+    '''
+    return frame.f_code.co_filename.endswith(os.path.join("gevent", "hub.py"))
+
+
+def sample(thread_id, interval, stop_event):
+    while not stop_event.wait(interval):
+        if PROFILE["mode"] == "cprofile" and PROFILE["active_requests"] == 0:
+            continue
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        if is_idle(frame):
+            PROFILE["idle_samples"] += 1
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        PROFILE["samples"][tuple(reversed(stack))] += 1
+
+
+def start(mode, interval, route=None):
+    '''
+    :param mode: sampling or cprofile
+    :param interval: seconds between samples
+    :param route: cprofile mode - url rule (e.g. /report/<session>) or path prefix of profiled requests, None = all
+    :return: False if profiler is already running
+    '''
+    with LOCK:
+        if PROFILE["running"]:
+            return False
+        stop_event = threading.Event()
+        PROFILE.update(running=True, mode=mode, route=route, active_requests=0, profiled_requests=0, idle_samples=0,
+                       samples=collections.Counter(), stop_event=stop_event,
+                       profile=cProfile.Profile() if mode == "cprofile" else None)
+    sampler = threading.Thread(target=sample, args=(threading.get_ident(), interval, stop_event), daemon=True)
+    PROFILE["sampler"] = sampler
+    sampler.start()
+    return True
+
+
+def is_profiling_requests():
+    return PROFILE["running"] and PROFILE["mode"] == "cprofile"
+
+
+def request_started(route, path):
+    '''
+    :return: None if the request is not profiled, otherwise token for request_finished
+    '''
+    wanted = PROFILE["route"]
+    if wanted is not None and route != wanted and not path.startswith(wanted):
+        return None
+    with LOCK:
+        if not is_profiling_requests():
+            return None
+        PROFILE["active_requests"] += 1
+        PROFILE["profiled_requests"] += 1
+        if PROFILE["active_requests"] == 1:
+            PROFILE["profile"].enable()
+        return PROFILE["stop_event"]
+
+
+def request_finished(token):
+    with LOCK:
+        if token is not PROFILE["stop_event"]:
+            return  # profiling the request was started by has been stopped already
+        PROFILE["active_requests"] -= 1
+        if PROFILE["active_requests"] == 0 and PROFILE["profile"] is not None:
+            PROFILE["profile"].disable()
+
+
+def get_sampled_functions(samples, top):
+    '''
+    :return: functions with most samples on top of the stack (self), total = anywhere in the stack
+    '''
+    samples_count = sum(samples.values())
+    self_samples = collections.Counter()
+    total_samples = collections.Counter()
+    for stack, count in samples.items():
+        self_samples[stack[-1]] += count
+        for function in set(stack):
+            total_samples[function] += count
+    functions = []
+    for function, count in sorted(total_samples.items(), key=lambda item: (self_samples[item[0]], item[1]), reverse=True)[:top]:
+        functions.append({"function": function, "self_samples": self_samples[function], "total_samples": count,
+                          "self_percent": round(100.0 * self_samples[function] / samples_count, 2),
+                          "total_percent": round(100.0 * count / samples_count, 2)})
+    return functions
+
+
+def get_profiled_functions(profile, top):
+    '''
+    :return: functions with highest cumulative time in profiled requests
+    '''
+    stats = pstats.Stats(profile)
+    functions = []
+    for (filename, line, name), (primitive_calls, calls, self_time, total_time, callers) in stats.stats.items():
+        functions.append({"function": name + " (" + os.path.basename(filename) + ":" + str(line) + ")", "calls": calls,
+                          "self_seconds": round(self_time, 6), "total_seconds": round(total_time, 6)})
+    functions.sort(key=lambda function: function["total_seconds"], reverse=True)
+    return functions[:top]
+
+
+def stop(top=30):
+    '''
+    stop profiling
+    :param top: length of functions table
+    :return: dict with mode, samples counts, collapsed stacks and functions table
+    '''
+    PROFILE["stop_event"].set()
+    PROFILE["sampler"].join()
+    with LOCK:
+        if PROFILE["profile"] is not None and PROFILE["active_requests"] > 0:
+            PROFILE["profile"].disable()
+        PROFILE["running"] = False
+    samples = PROFILE["samples"]
+    result = {"mode": PROFILE["mode"], "samples": sum(samples.values()), "idle_samples": PROFILE["idle_samples"],
+              "collapsed": "\n".join(";".join(stack) + " " + str(count) for stack, count in samples.most_common())}
+    if PROFILE["mode"] == "cprofile":
+        result["profiled_requests"] = PROFILE["profiled_requests"]
+        result["functions"] = get_profiled_functions(PROFILE["profile"], top) if PROFILE["profiled_requests"] > 0 else []
+    else:
+        result["functions"] = get_sampled_functions(samples, top) if len(samples) > 0 else []
+    return result
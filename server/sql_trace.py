@@ -0,0 +1,179 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Opt-in tracing of sql statements executed by execute_query/execute_select during Flask requests
+(config: SQL_TRACE_ENABLED). For each request the normalized sql, duration and rows of every statement are kept,
+statements of the same shape repeated within 1 request are reported as N+1 candidates and statements slower than
+SQL_SLOW_QUERY_MS are appended to slow query log. Recent requests and totals per statement shape are returned
+by /debug/sql_trace.
+
+query_budget() turns tracing on for its block and fails if the requests made inside executed too many statements:
+
+    with sql_trace.query_budget(10):
+        app.test_client().get("/report/1")
+'''
+
+import collections
+import contextlib
+import datetime
+import json
+import re
+
+SLOW_QUERY_LOG = "slow_queries.log"
+RECENT_REQUESTS_COUNT = 50
+N_PLUS_1_MIN_REPEATS = 5  # the same statement shape executed this many times in 1 request is N+1 candidate
+
+RECENT_REQUESTS = collections.deque(maxlen=RECENT_REQUESTS_COUNT)  # summaries of last traced requests, see finish_request
+STATEMENTS = {}  # normalized sql -> {"count", "total_ms", "max_ms", "rows"} across all traced requests
+BUDGETS = []  # statement lists of active query_budget blocks
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+NAMED_PARAM = re.compile(r"[:@$]\w+")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    '''
+    shape of the statement: literals and params replaced with ?, IN lists collapsed to (?...),
+    so the same query built for different ids is counted as 1 shape
+    '''
+    sql = STRING_LITERAL.sub("?", sql)
+    sql = NAMED_PARAM.sub("?", sql)
+    sql = NUMBER_LITERAL.sub("?", sql)
+    sql = PLACEHOLDER_LIST.sub("(?...)", sql)
+    return WHITESPACE.sub(" ", sql).strip()
+
+
+def is_forced():
+    '''
+    tracing is on for all requests while any query_budget block is active
+    '''
+    return len(BUDGETS) > 0
+
+
+def record(request_statements, sql, duration, rows):
+    '''
+    :param request_statements: list collecting statements of the current request
+    :param duration: seconds
+    :param rows: rows returned (select) or changed
+    '''
+    statement = (normalize(sql), round(duration * 1000, 3), rows)
+    request_statements.append(statement)
+    for budget in BUDGETS:
+        budget.append(statement)
+
+
+def find_n_plus_one(statements, min_repeats=N_PLUS_1_MIN_REPEATS):
+    '''
+    :return: list of {"sql", "count", "total_ms"} of shapes repeated at least min_repeats times, most repeated first
+    '''
+    shapes = {}
+    for sql, duration_ms, rows in statements:
+        shape = shapes.setdefault(sql, {"sql": sql, "count": 0, "total_ms": 0})
+        shape["count"] += 1
+        shape["total_ms"] += duration_ms
+    candidates = [shape for shape in shapes.values() if shape["count"] >= min_repeats]
+    for shape in candidates:
+        shape["total_ms"] = round(shape["total_ms"], 3)
+    return sorted(candidates, key=lambda shape: shape["count"], reverse=True)
+
+
+def finish_request(method, path, route, statements, slow_query_ms):
+    '''
+    keep summary of traced request, add its statements to totals and write slow ones to SLOW_QUERY_LOG
+    :return: request summary
+    '''
+    summary = {"date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "method": method, "path": path, "route": route,
+               "statements_count": len(statements), "sql_ms": round(sum(s[1] for s in statements), 3),
+               "n_plus_one": find_n_plus_one(statements),
+               "statements": [{"sql": sql, "ms": duration_ms, "rows": rows} for sql, duration_ms, rows in statements]}
+    RECENT_REQUESTS.append(summary)
+
+    slow = []
+    for sql, duration_ms, rows in statements:
+        totals = STATEMENTS.setdefault(sql, {"count": 0, "total_ms": 0, "max_ms": 0, "rows": 0})
+        totals["count"] += 1
+        totals["total_ms"] = round(totals["total_ms"] + duration_ms, 3)
+        totals["max_ms"] = max(totals["max_ms"], duration_ms)
+        totals["rows"] += rows
+        if slow_query_ms is not None and duration_ms >= slow_query_ms:
+            slow.append({"date": summary["date"], "method": method, "path": path, "sql": sql, "ms": duration_ms, "rows": rows})
+    if len(slow) > 0:
+        try:
+            with open(SLOW_QUERY_LOG, "a") as f:
+                for entry in slow:
+                    f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(e)
+    return summary
+
+
+def get_report(limit=None):
+    '''
+    :return: recent requests (newest first) and statement shapes sorted by total time
+    '''
+    requests = list(RECENT_REQUESTS)[::-1]
+    statements = [dict(totals, sql=sql) for sql, totals in STATEMENTS.items()]
+    statements.sort(key=lambda totals: totals["total_ms"], reverse=True)
+    if limit is not None:
+        requests = requests[:limit]
+        statements = statements[:limit]
+    return {"requests": requests, "statements": statements}
+
+
+def reset():
+    RECENT_REQUESTS.clear()
+    STATEMENTS.clear()
+
+
+@contextlib.contextmanager
+def query_budget(max_statements):
+    '''
+    trace requests made inside the block and raise AssertionError if they executed more than max_statements statements
+    :return: list the statements are collected to, (normalized sql, ms, rows) each
+    '''
+    statements = []
+    BUDGETS.append(statements)
+    try:
+        yield statements
+    finally:
+        BUDGETS.remove(statements)
+    if len(statements) > max_statements:
+        shapes = collections.Counter(sql for sql, duration_ms, rows in statements)
+        raise AssertionError("query budget exceeded: " + str(len(statements)) + " statements > " + str(max_statements) +
+                             ", most repeated: " + json.dumps(shapes.most_common(5)))
@@ -459,18 +459,21 @@ function showAbout() {
     dialog.getModalHeader().css('background-color', '#1ABC9C');
 }
 
-function stopLiveTestSession() {
-    sendStopTestSessionRequest();
+function stopLiveTestSession(sessionID) {
+    sendStopTestSessionRequest(sessionID);
 
 
 }
 
 
-function sendStopTestSessionRequest() {
+function sendStopTestSessionRequest(sessionID) {
     $.ajax({
         url: "/set_test_session_end",
         type: "get",
-        async: false
+        async: false,
+        data: {
+            session_id: sessionID
+        }
     }).done(function (data, textStatus, xhr) {
         if (xhr.status == 200) {
             //refresh
@@ -96,6 +96,24 @@ function doCleanup() {
     modulesSettingsCheckedModuleSources = [];
 }
 
+//files of a module are loaded when the module is opened (or checked) for the first time
+function loadModulesTreeNode(node, callback) {
+    var tree = this;
+    $.ajax({
+        url: "/get_modules",
+        type: "get",
+        data: {
+            "with_files_only": "False",
+            "session_id": "None",
+            "node": node.id
+        }
+
+
+    }).done(function (nodes) {
+        callback.call(tree, nodes);
+    });
+}
+
 function showModulesTree() {
 
 
@@ -104,31 +122,23 @@ function showModulesTree() {
         type: "get",
         data: {
             "with_files_only": "False",
-            "session_id": "None"
+            "session_id": "None",
+            "node": "#"
         }
 
 
-    }).done(function (data) {
-        var modules = data["modules"];
+    }).done(function (modules) {
 
         if (modules.length > 0) {
             hasModules = true;
 
-            //modules come from backend as strings, convert to json objects
-            var module_jsons = []
-            for (var i = 0; i < modules.length; i++) {
-                var modulesJson = JSON.parse(modules[i]);
-
-                module_jsons.push(modulesJson);
-            }
-
 
             if (modulesSettingsModulesTree == undefined) {
 
                 //show a tree with saved modules
                 modulesSettingsModulesTree = $('#jstree_1').jstree({
                         'core': {
-                            'data': module_jsons
+                            'data': loadModulesTreeNode
                         },
                         'types': {
                             "module_source": {
@@ -154,7 +164,6 @@ function showModulesTree() {
                     });
             } else {
 
-                $('#jstree_1').jstree(true).settings.core.data = module_jsons;
                 $('#jstree_1').jstree(true).refresh();
             }
 
@@ -189,10 +198,9 @@ function onModuleChecked(data) {
         addToList(modulesSettingsCheckedModules, data.node.id);
         isModuleChecked = true;
 
-        for (var i = 0; i < data.node.children.length; i++) {
-            data.instance.check_node(data.node.children[i]);
-
-        }
+        forEachChildNode(data.instance, data.node, function (child) {
+            data.instance.check_node(child);
+        });
     } else {
         //source checked
         addToList(modulesSettingsCheckedModuleSources, data.node.id);
@@ -235,30 +243,55 @@ function onModuleUnchecked(data) {
 }
 
 
-function showUnassignedFilesTree() {
+//children of lazy loaded node are fetched first if the node was not opened yet
+function forEachChildNode(instance, node, action) {
+    var runAction = function (loadedNode) {
+        for (var i = 0; i < loadedNode.children.length; i++) {
+            action(loadedNode.children[i]);
+        }
+    };
+    if (instance.is_loaded(node)) {
+        runAction(node);
+    } else {
+        instance.load_node(node, runAction);
+    }
+}
+
+//files of a folder are loaded when the folder is opened (or checked) for the first time
+function loadSourcesTreeNode(node, callback) {
+    var tree = this;
     $.ajax({
         url: "/get_sources",
         type: "get",
-        async: false
+        data: {
+            "node": node.id
+        }
 
 
-    }).done(function (data) {
-        var sources = data["sources"];
+    }).done(function (nodes) {
+        callback.call(tree, nodes);
+    });
+}
 
-        //sources come from backend as strings, convert to json objects
-        var source_jsons = []
-        for (var i = 0; i < sources.length; i++) {
-            var sourcesJson = JSON.parse(sources[i]);
-            source_jsons.push(sourcesJson);
+function showUnassignedFilesTree() {
+    $.ajax({
+        url: "/get_sources",
+        type: "get",
+        async: false,
+        data: {
+            "node": "#"
         }
 
+
+    }).done(function (sources) {
+
         if (sources.length > 0) {
 
             if (modulesSettingsSourcesTree == undefined) {
                 //and the one with yet unassigned souce files
                 modulesSettingsSourcesTree = $('#jstree_2').jstree({
                         'core': {
-                            'data': source_jsons
+                            'data': loadSourcesTreeNode
                         },
                         'types': {
                             "source": {
@@ -281,7 +314,6 @@ function showUnassignedFilesTree() {
                     });
 
             } else {
-                $('#jstree_2').jstree(true).settings.core.data = source_jsons;
                 $('#jstree_2').jstree(true).refresh();
             }
         } else {
@@ -304,11 +336,11 @@ function showUnassignedFilesTree() {
 function onSourceSelected(data) {
 
     if (data.node.children.length > 0 || data.node.parent == "#") {
-        for (var i = 0; i < data.node.children.length; i++) {
+        forEachChildNode(data.instance, data.node, function (child) {
 
-            data.instance.check_node(data.node.children[i]);
-            addToList(modulesSettingsLastCheckedSources, data.node.children[i]);
-        }
+            data.instance.check_node(child);
+            addToList(modulesSettingsLastCheckedSources, child);
+        });
 
 
 
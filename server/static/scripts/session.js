@@ -39,6 +39,8 @@ var templateCoverageTable;
 var routeCoverageTable;
 var modulesCoverageTable;
 var callTimelineTable;
+var coverageChart;
+var coverageStream;
 
 
 $(document).ready(function () {
@@ -92,6 +94,46 @@ function initReportPage() {
         showExecutedLines($(this).closest('tr').find('td:eq(0)').text());
 
     });
+
+    //session in progress - server pushes coverage changes, no need to reload the page
+    if (is_history == "False" && typeof (EventSource) !== "undefined") {
+        subscribeToLiveCoverage();
+    }
+}
+
+function subscribeToLiveCoverage() {
+    coverageStream = new EventSource("/coverage_stream?session_id=" + CURRENT_SESSION_ID);
+    coverageStream.onmessage = function (e) {
+        var coverage = JSON.parse(e.data);
+        updateLiveCoverage(coverage);
+        if (coverage["type"] == "session_over") {
+            coverageStream.close();
+        }
+    };
+}
+
+function updateLiveCoverage(coverage) {
+    //total
+    coverageChart.data.datasets[0].data[0] = coverage["total_coverage_value"];
+    coverageChart.update();
+
+    //files whose coverage changed
+    var changedFiles = {};
+    for (var i = 0; i < coverage["files"].length; i++) {
+        changedFiles[coverage["files"][i]["filename"]] = coverage["files"][i];
+    }
+    [filesCoverageTable, templateCoverageTable].forEach(function (table) {
+        table.rows().every(function () {
+            var row = this.data();
+            var file = changedFiles[row[0]];
+            if (file !== undefined) {
+                row[3] = file["executed"];
+                row[4] = file["percent_executed"] + "%";
+                this.data(row);
+            }
+        });
+        table.draw(false);
+    });
 }
 
 function createPieChartForTotals(executed, executable) {
@@ -159,6 +201,19 @@ function backToDashboard() {
 }
 
 
+/**
+Color for line executed [hits] times, on log scale from green (1 hit) to red (max hits)
+**/
+function getHeatColor(hits, max_hits) {
+    var ratio = 0;
+    if (max_hits > 1) {
+        ratio = Math.log(hits) / Math.log(max_hits);
+    }
+    var hue = Math.round(170 - 170 * ratio);
+    return "hsl(" + hue + ", 75%, 40%)";
+}
+
+
 /**
 Given a filename, get filecontent and show which lines of the file were executed
 **/
@@ -168,6 +223,8 @@ function showExecutedLines(filename_p) {
     var fileContent = "";
     var executedLines = [];
     var executableLines = [];
+    var lineHits = {};
+    var maxHits = 0;
 
 
     //get file content
@@ -186,6 +243,25 @@ function showExecutedLines(filename_p) {
         executableLines = data["executable_lines"]
     });
 
+    //get hit counts per line (only if hit counting is enabled on server)
+    $.ajax({
+        url: "/get_probe_hit_counts",
+        type: "get",
+        async: false,
+        data: {
+            filename: filename_p,
+            session_id: CURRENT_SESSION_ID
+        }
+
+    }).done(function (data) {
+        lineHits = data["line_hits"];
+        maxHits = data["max_hits"];
+    });
+
+    var dialogTitle = filename_p + " (green - executed, yellow- missed)";
+    if (maxHits > 0) {
+        dialogTitle = filename_p + " (executed lines shaded by hit count, max: " + maxHits + " hits, yellow- missed)";
+    }
 
 
 
@@ -196,7 +272,7 @@ function showExecutedLines(filename_p) {
 
     //https://nakupanda.github.io/bootstrap3-dialog/
     var dialog = BootstrapDialog.show({
-        title: filename_p + " (green - executed, yellow- missed)",
+        title: dialogTitle,
         draggable: true,
         message: modalHtml,
         onshown: function (dialogRef) {
@@ -234,6 +310,22 @@ function showExecutedLines(filename_p) {
                 });
             }
 
+            //heat overlay - the more hits line has, the more red it gets
+            if (maxHits > 0) {
+                for (var line in lineHits) {
+                    myCodeMirror.markText({
+                        line: line - 1,
+                        ch: 0
+                    }, {
+                        line: line - 1,
+                        ch: 10000
+                    }, {
+                        css: "background-color:" + getHeatColor(lineHits[line], maxHits) + ";",
+                        title: lineHits[line] + " hits"
+                    });
+                }
+            }
+
 
 
         },
@@ -0,0 +1,166 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Coverage metrics computed from sessions exported by stats_export.py, without access to the live db.
+Partitions are read whole and metrics are computed with vectorized numpy operations when numpy is installed.
+
+    python stats_analytics.py <export dir> [tag]   - prints coverage trend of each tag (or just the given one) over builds
+'''
+
+import glob
+import json
+import os
+import sys
+
+from stats_export import read_table, numpy, SESSION_INFO_FILE
+
+
+def list_partitions(export_dir, tag=None, build=None):
+    '''
+    exported sessions, optionally only of given tag and build
+    :return: list of session.json contents with "dir" of the partition added, ordered by session id
+    '''
+    pattern = os.path.join(export_dir, "tag=" + ("*" if tag is None else str(tag)),
+                           "build=" + ("*" if build is None else str(build)), "session=*", SESSION_INFO_FILE)
+    partitions = []
+    for path in glob.glob(pattern):
+        with open(path, "r", encoding="utf-8") as f:
+            partition = json.load(f)
+        partition["dir"] = os.path.dirname(path)
+        partitions.append(partition)
+    return sorted(partitions, key=lambda p: p["session_id"])
+
+
+def coverage(partitions):
+    '''
+    union coverage of given sessions: a line is executed if it was executed in any of them,
+    executable lines of a file are taken from the latest session that has the file
+    :return: dict with "files" (file id -> file coverage), "executable", "executed", "total_coverage_value",
+    the same as Instrument_server.calculate_session_coverage
+    '''
+    probes = [read_table(p["dir"], "probes") for p in partitions]
+    files = [read_table(p["dir"], "files") for p in partitions]
+    if numpy is not None:
+        executed, executable, paths = union_coverage_vectorized(probes, files)
+    else:
+        executed, executable, paths = union_coverage_python(probes, files)
+
+    result = {"files": {}, "executable": 0, "executed": 0, "total_coverage_value": 0}
+    for file_id, file_executable in executable.items():
+        file = {"id": file_id, "filename": paths[file_id], "executable": file_executable, "executed": executed.get(file_id, 0)}
+        try:
+            file["percent_executed"] = round((file["executed"] / float(file["executable"])) * 100, 1)
+        except ZeroDivisionError:
+            file["percent_executed"] = 0
+        result["files"][file_id] = file
+        result["executable"] += file["executable"]
+        result["executed"] += file["executed"]
+    if result["executable"] > 0:
+        result["total_coverage_value"] = round((result["executed"] / float(result["executable"])) * 100, 1)
+    return result
+
+
+def union_coverage_vectorized(probes, files):
+    '''
+    :return: file id -> number of unique probes hit, file id -> executable lines, file id -> path
+    '''
+    executed = {}
+    if len(probes) > 0:
+        unique_probes = numpy.unique(numpy.rec.fromarrays(
+            [numpy.concatenate([p["file_id"] for p in probes]), numpy.concatenate([p["line_guid"] for p in probes])],
+            names="file_id,line_guid"))
+        file_ids, counts = numpy.unique(unique_probes["file_id"], return_counts=True)
+        executed = dict(zip(file_ids.tolist(), counts.tolist()))
+
+    executable = {}
+    paths = {}
+    if len(files) > 0:
+        # latest session wins: first occurrence in reversed arrays is the last one
+        file_ids = numpy.concatenate([f["file_id"] for f in files])[::-1]
+        file_ids, latest = numpy.unique(file_ids, return_index=True)
+        counts = numpy.concatenate([f["executable_lines_count"] for f in files])[::-1][latest]
+        file_paths = numpy.concatenate([f["path"] for f in files])[::-1][latest]
+        executable = dict(zip(file_ids.tolist(), counts.tolist()))
+        paths = dict(zip(file_ids.tolist(), file_paths.tolist()))
+    return executed, executable, paths
+
+
+def union_coverage_python(probes, files):
+    unique_probes = set()
+    for p in probes:
+        unique_probes.update(zip(p["file_id"], p["line_guid"]))
+    executed = {}
+    for file_id, line_guid in unique_probes:
+        executed[file_id] = executed.get(file_id, 0) + 1
+
+    executable = {}
+    paths = {}
+    for f in files:
+        executable.update(zip(f["file_id"], f["executable_lines_count"]))
+        paths.update(zip(f["file_id"], f["path"]))
+    return executed, executable, paths
+
+
+def build_sort_key(build):
+    try:
+        return 0, int(build), ""
+    except ValueError:
+        return 1, 0, str(build)
+
+
+def trend(export_dir, tag):
+    '''
+    union coverage of all sessions of each build of the tag
+    :return: list of dicts with "build", "sessions", "executable", "executed", "total_coverage_value", ordered by build
+    '''
+    builds = {}
+    for partition in list_partitions(export_dir, tag=tag):
+        builds.setdefault(str(partition["build"]), []).append(partition)
+    result = []
+    for build in sorted(builds.keys(), key=build_sort_key):
+        build_coverage = coverage(builds[build])
+        result.append({"build": build, "sessions": [p["session_id"] for p in builds[build]],
+                       "executable": build_coverage["executable"], "executed": build_coverage["executed"],
+                       "total_coverage_value": build_coverage["total_coverage_value"]})
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python stats_analytics.py <export dir> [tag]")
+        sys.exit(1)
+    tags = sys.argv[2:] or sorted(set(str(p["tag"]) for p in list_partitions(sys.argv[1])))
+    print(json.dumps({tag: trend(sys.argv[1], tag) for tag in tags}, indent=4))
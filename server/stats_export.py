@@ -0,0 +1,173 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+Export of finished sessions to columnar files for offline analysis (see stats_analytics.py),
+so history can be queried without touching the live db.
+
+Every session gets its own partition: <export dir>/tag=<tag>/build=<build>/session=<id>/ with
+    session.json - session name, times and coverage
+    stats        - raw hits: file_id, line, line_guid, coverage_type, send_time (unix epoch microseconds), custom_value
+    files        - files of the session: file_id, path, executable_lines_count
+    probes       - probes hit in the session: file_id, line_guid, line, hits (0 if hits were not counted)
+
+Tables are written as Parquet if pyarrow is installed, numpy .npz if numpy is installed,
+json with 1 list per column otherwise.
+'''
+
+import json
+import os
+import sqlite3
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+TABLES = {
+    "stats": "SELECT file_id,line,line_guid,coverage_type,send_time,custom_value FROM stats_rows WHERE session_id=:sid ORDER BY date,hit",
+    "files": "SELECT files.ID,files.path,file_details.executable_lines_count FROM sessions_files INNER JOIN files ON files.ID=sessions_files.file_id INNER JOIN file_details ON file_details.ID=sessions_files.file_details WHERE sessions_files.session_id=:sid",
+    "probes": "SELECT stats.file_id,probes.line_guid,probes.line,IFNULL(MAX(probe_hits.hits),0) FROM stats INNER JOIN probes ON probes.ID=stats.probe_id LEFT JOIN probe_hits ON probe_hits.session_id=stats.session_id AND probe_hits.file_id=stats.file_id AND probe_hits.line_guid=probes.line_guid WHERE stats.session_id=:sid GROUP BY stats.file_id,stats.probe_id",
+}
+COLUMNS = {
+    "stats": (("file_id", int), ("line", int), ("line_guid", str), ("coverage_type", str), ("send_time", int), ("custom_value", str)),
+    "files": (("file_id", int), ("path", str), ("executable_lines_count", int)),
+    "probes": (("file_id", int), ("line_guid", str), ("line", int), ("hits", int)),
+}
+SESSION_INFO_FILE = "session.json"
+
+
+def get_partition_dir(export_dir, tag, build, session_id):
+    return os.path.join(export_dir, "tag=" + str(tag), "build=" + str(build), "session=" + str(session_id))
+
+
+def rows_to_columns(table, rows):
+    '''
+    :return: dict column name -> list of values, None replaced with 0 or ""
+    '''
+    columns = {}
+    for i, (name, column_type) in enumerate(COLUMNS[table]):
+        columns[name] = [column_type(r[i]) if r[i] is not None else column_type() for r in rows]
+    return columns
+
+
+def write_table(partition_dir, table, columns):
+    if pyarrow is not None:
+        pyarrow.parquet.write_table(pyarrow.table(columns), os.path.join(partition_dir, table + ".parquet"))
+    elif numpy is not None:
+        numpy.savez_compressed(os.path.join(partition_dir, table + ".npz"),
+                               **{name: numpy.array(values, dtype=numpy.int64 if column_type is int else str)
+                                  for (name, column_type), values in zip(COLUMNS[table], columns.values())})
+    else:
+        with open(os.path.join(partition_dir, table + ".json"), "w", encoding="utf-8") as f:
+            json.dump(columns, f)
+
+
+def read_table(partition_dir, table):
+    '''
+    read table in whichever format it was written
+    :return: dict column name -> numpy array if numpy is installed, list otherwise
+    '''
+    path = os.path.join(partition_dir, table)
+    if os.path.exists(path + ".parquet"):
+        columns = pyarrow.parquet.read_table(path + ".parquet").to_pydict()
+    elif os.path.exists(path + ".npz"):
+        with numpy.load(path + ".npz") as data:
+            return {name: data[name] for name, column_type in COLUMNS[table]}
+    else:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            columns = json.load(f)
+    if numpy is not None:
+        return {name: numpy.array(columns[name], dtype=numpy.int64 if column_type is int else str)
+                for name, column_type in COLUMNS[table]}
+    return columns
+
+
+def get_finished_sessions(connection):
+    '''
+    :return: list of (session id,name,start time,end time,total coverage,total executable,total executed,tag,build)
+    '''
+    sql = "SELECT sessions.ID,sessions.name,sessions.start_time,sessions.end_time,sessions.total_coverage,sessions.total_executable,sessions.total_executed,IFNULL(tags.tag,''),IFNULL(builds.build,'') FROM sessions LEFT JOIN sessions_users_tags ON sessions_users_tags.session_id=sessions.ID LEFT JOIN tags ON tags.ID=sessions_users_tags.tag_id LEFT JOIN sessions_builds ON sessions_builds.session_id=sessions.ID LEFT JOIN builds ON builds.ID=sessions_builds.build_id WHERE sessions.is_over=1 ORDER BY sessions.ID"
+    return connection.execute(sql).fetchall()
+
+
+def export_session(connection, export_dir, session):
+    '''
+    write partition of 1 finished session; session.json is written last, so partition without it is incomplete
+    :param session: row from get_finished_sessions
+    :return: partition dir
+    '''
+    session_id, name, start_time, end_time, total_coverage, total_executable, total_executed, tag, build = session
+    partition_dir = get_partition_dir(export_dir, tag, build, session_id)
+    os.makedirs(partition_dir, exist_ok=True)
+    for table, sql in TABLES.items():
+        write_table(partition_dir, table, rows_to_columns(table, connection.execute(sql, {"sid": session_id}).fetchall()))
+    with open(os.path.join(partition_dir, SESSION_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump({"session_id": session_id, "name": name, "tag": tag, "build": build, "start_time": start_time,
+                   "end_time": end_time, "total_coverage": total_coverage, "total_executable": total_executable,
+                   "total_executed": total_executed}, f)
+    return partition_dir
+
+
+def is_exported(export_dir, session):
+    session_id, tag, build = session[0], session[7], session[8]
+    return os.path.exists(os.path.join(get_partition_dir(export_dir, tag, build, session_id), SESSION_INFO_FILE))
+
+
+def export_finished_sessions(connection_string, export_dir, session_id=None):
+    '''
+    export finished sessions that are not exported yet (or just the given one, exported again)
+    :return: list of exported session ids
+    '''
+    connection = sqlite3.connect(connection_string, timeout=30)
+    exported = []
+    try:
+        for session in get_finished_sessions(connection):
+            if session_id is not None and session[0] != int(session_id):
+                continue
+            if session_id is None and is_exported(export_dir, session):
+                continue
+            export_session(connection, export_dir, session)
+            exported.append(session[0])
+    finally:
+        connection.close()
+    return exported
@@ -0,0 +1,134 @@
+'''
+Copyright (c) 2016-2019 by Michal Sporna and contributors.  See AUTHORS
+for more details.
+
+Some rights reserved.
+
+Redistribution and use in source and binary forms of the software as well
+as documentation, with or without modification, are permitted provided
+that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following
+  disclaimer in the documentation and/or other materials provided
+  with the distribution.
+
+* The names of the contributors may not be used to endorse or
+  promote products derived from this software without specific
+  prior written permission.
+
+THIS SOFTWARE AND DOCUMENTATION IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE AND DOCUMENTATION, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+
+
+
+Writes to stats table (see create_database.create_stats_table). Hit rows do not repeat strings:
+probe (file id, line guid) and values (coverage type, custom value) are saved once in probes and stats_values
+tables and the hit row refers to them by ID. ID's are cached per process, server and ingest service
+get the same ID's because both insert with INSERT OR IGNORE and read the ID back.
+
+Stats table from before that layout is kept as stats_rowid until move_old_rows moves all its rows.
+'''
+
+PROBE_IDS = {}  # (file id,line guid) -> ID in probes table
+VALUE_IDS = {}  # value -> ID in stats_values table
+VALUE_IDS_CACHE_SIZE = 100000  # custom values can be unique per hit, cache is cleared when it grows above that
+MOVE_BATCH_SIZE = 10000
+# hit time saved as local time string (before times were unix epoch microseconds) to epoch microseconds, string precision is milliseconds
+OLD_TIME_SQL = "CASE WHEN typeof({0})='text' THEN CAST(strftime('%s',{0},'utc') AS INTEGER)*1000000+CAST(ROUND(strftime('%f',{0})*1000) AS INTEGER)%1000*1000 ELSE {0} END"
+
+INSERT_HIT_SQL = "INSERT INTO stats(session_id,file_id,probe_id,hit,date,send_time,coverage_type,custom_value) " \
+                 "SELECT :sid,:fid,:pid,IFNULL(MAX(hit)+1,0),:date,:send_time,:ct,:cv FROM stats WHERE session_id=:sid AND file_id=:fid AND probe_id=:pid"
+
+
+def clear_cache():
+    '''
+    forget cached ID's, must be called when transaction that could insert probes or values is rolled back
+    '''
+    PROBE_IDS.clear()
+    VALUE_IDS.clear()
+
+
+def get_probe_id(cursor, file_id, line_guid, line):
+    key = (file_id, line_guid)
+    probe_id = PROBE_IDS.get(key)
+    if probe_id is None:
+        cursor.execute("INSERT OR IGNORE INTO probes(file_id,line_guid,line) VALUES(?,?,?)", (file_id, line_guid, line))
+        probe_id = cursor.execute("SELECT ID FROM probes WHERE file_id IS ? AND line_guid IS ?", key).fetchone()[0]
+        PROBE_IDS[key] = probe_id
+    return probe_id
+
+
+def get_value_id(cursor, value):
+    if value is None:
+        return None
+    value_id = VALUE_IDS.get(value)
+    if value_id is None:
+        cursor.execute("INSERT OR IGNORE INTO stats_values(value) VALUES(?)", (value,))
+        value_id = cursor.execute("SELECT ID FROM stats_values WHERE value=?", (value,)).fetchone()[0]
+        if len(VALUE_IDS) >= VALUE_IDS_CACHE_SIZE:
+            VALUE_IDS.clear()
+        VALUE_IDS[value] = value_id
+    return value_id
+
+
+def insert_stats_rows(cursor, stats_rows, count=True):
+    '''
+    insert hits, caller commits.
+    :param stats_rows: (file_id,session_id,date,filename,line,line_guid,coverage_type,send_time,custom_value) tuples
+    :param count: add rows to stats_counter
+    '''
+    params = []
+    for file_id, session_id, date, filename, line, line_guid, coverage_type, send_time, custom_value in stats_rows:
+        params.append({"sid": session_id, "fid": file_id, "pid": get_probe_id(cursor, file_id, line_guid, line), "date": date,
+                       "send_time": send_time, "ct": get_value_id(cursor, coverage_type), "cv": get_value_id(cursor, custom_value)})
+    cursor.executemany(INSERT_HIT_SQL, params)
+    if count and len(params) > 0:
+        cursor.execute("UPDATE stats_counter SET inserted_rows=inserted_rows+? WHERE ID=1", (len(params),))
+
+
+def has_old_rows(cursor):
+    '''
+    :return: True while stats table from before current layout is not moved yet
+    '''
+    return cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='stats_rowid'").fetchone()[0] > 0
+
+
+def move_old_rows(connection, batch_size=MOVE_BATCH_SIZE):
+    '''
+    move oldest rows of stats_rowid to stats in 1 transaction, stats_rowid is dropped when it is empty.
+    Hit times saved as strings are converted to epoch microseconds on the way, so old db is not rewritten at start.
+    Rows were counted when they were inserted, so stats_counter does not change.
+    :return: number of moved rows, 0 when there is nothing left to move
+    '''
+    cursor = connection.cursor()
+    if not has_old_rows(cursor):
+        return 0
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        rows = cursor.execute("SELECT ID,file_id,session_id," + OLD_TIME_SQL.format("date") + ",filename,line,line_guid,coverage_type," + OLD_TIME_SQL.format("send_time") +
+                              ",custom_value FROM stats_rowid ORDER BY ID LIMIT ?", (batch_size,)).fetchall()
+        if len(rows) == 0:
+            cursor.execute("DROP TABLE stats_rowid")
+        else:
+            insert_stats_rows(cursor, [row[1:] for row in rows], count=False)
+            cursor.execute("DELETE FROM stats_rowid WHERE ID<=?", (rows[-1][0],))
+        connection.commit()
+    except:
+        connection.rollback()
+        clear_cache()
+        raise
+    return len(rows)